@@ -1,9 +1,24 @@
-from typing import List
+from typing import List, NotRequired, TypedDict
 
 from mypy_boto3_organizations.type_defs import AccountTypeDef
 
 class AccountType(AccountTypeDef):
     pass
 
+class Continuation(TypedDict):
+    '''Where a collector stopped processing an account'''
+    # Absent for accounts put back whole, which only count their deferrals
+    Region: NotRequired[str]
+    # Cluster the page belongs to, for collectors that page through clusters within a region
+    Cluster: NotRequired[str]
+    NextToken: NotRequired[str]
+    # Times the account has been put back with a delay while the downstream queue was backed up
+    Deferrals: NotRequired[int]
+
 class AccountTypeWithTags(AccountType):
-    Tags: List[dict]
\ No newline at end of file
+    Tags: List[dict]
+    # Tags the account inherits from its organizational units
+    InheritedTags: NotRequired[List[dict]]
+    SweepId: NotRequired[str]
+    NotBefore: NotRequired[int]
+    Continuation: NotRequired[Continuation]
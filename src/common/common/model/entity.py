@@ -22,6 +22,7 @@ class EntitySpec(TypedDict):
     system: str
     type: str
     lifecycle: str
+    dependsOn: NotRequired[List[str]]
 
 class Entity(TypedDict):
     apiVersion: str
@@ -0,0 +1,10 @@
+'''Catalog sweep generations'''
+from typing import List, NotRequired, TypedDict
+
+class CompletedSweep(TypedDict):
+    Generation: int
+    CompletedAt: int
+    # Accounts scanned by the sweep and all accounts in the organization at the time. Absent for
+    # sweeps that scanned the whole organization.
+    Accounts: NotRequired[List[str]]
+    OrgAccounts: NotRequired[List[str]]
@@ -0,0 +1,61 @@
+'''
+AWS client registry
+
+Creating a client loads its service model from disk, which is a large part of a handler's cold
+start. Clients are created here on first use rather than at import, so code paths that never call
+a service never pay for its client. Every client comes from one shared session, which keeps loaded
+service models and endpoint data for the next client of the same service, and every client is
+instrumented.
+'''
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+import boto3
+
+from common.util import instrumentation
+
+if TYPE_CHECKING:
+    from botocore.config import Config
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+
+_SESSION: Optional[boto3.session.Session] = None
+# (service, region) to its client
+_CLIENTS: Dict[Tuple[str, Optional[str]], Any] = {}
+
+
+def get_session() -> boto3.session.Session:
+    '''Return the shared session'''
+    global _SESSION     # pylint: disable=global-statement
+    if _SESSION is None:
+        _SESSION = boto3.session.Session()
+    return _SESSION
+
+
+def get_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    '''Return the client for a service and region, creating it on first use'''
+    key = (service_name, region_name)
+    if key not in _CLIENTS:
+        _CLIENTS[key] = instrumentation.instrument_client(
+            get_session().client(service_name, region_name=region_name)    # type: ignore[call-overload]
+        )
+    return _CLIENTS[key]
+
+
+def get_cross_account_client(
+    service_name: str,
+    credentials: 'CredentialsTypeDef',
+    region_name: str,
+    config: Optional['Config'] = None
+) -> Any:
+    '''Return a client using assumed role credentials
+
+    These are not kept since the credentials they hold expire.
+    '''
+    client = get_session().client(    # type: ignore[call-overload]
+        service_name,
+        region_name=region_name,
+        config=config,
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken']
+    )
+    return instrumentation.instrument_client(client)
@@ -1,3 +1,171 @@
 '''
 Utility functions for working with the ServerlessOps catalog
+
+Catalog requests go through a shared session so connections are kept alive across calls. Every
+request is timed and counted by route, and calls slower than CATALOG_SLOW_CALL_MS are logged with
+the entity they were for. instrumentation.emit_metrics() writes the counters as EMF at the end of
+each invocation. System owner lookups can be cached so collectors fetch each system once rather
+than once per entity.
+
+Entity names are at most 63 characters. Resource names are often only unique within an account,
+region or cluster and can be as long as the limit themselves, so get_entity_name() shortens them
+and appends a hash of an identifier that is unique, such as the resource ARN.
 '''
+import os
+from functools import wraps
+from hashlib import sha256
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+import requests
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+
+LOGGER = Logger(utc=True)
+
+SESSION = requests.Session()
+
+METRICS_NAMESPACE = os.environ.get('POWERTOOLS_METRICS_NAMESPACE', 'AwsResourceCollector')
+CATALOG_SLOW_CALL_MS = int(os.environ.get('CATALOG_SLOW_CALL_MS', '1000'))
+SYSTEM_OWNER_CACHE_SECONDS = int(os.environ.get('SYSTEM_OWNER_CACHE_SECONDS', '300'))
+# EMF accepts at most this many values per metric in a single document.
+MAX_METRIC_VALUES = 100
+# Catalog entity names are at most this many characters.
+ENTITY_NAME_MAX_LENGTH = 63
+# Characters of a resource's hashed identifier that keep shortened names unique.
+ENTITY_NAME_HASH_LENGTH = 8
+
+ROUTE_FETCH_TOKEN = 'FetchToken'
+ROUTE_GET_SYSTEM = 'GetSystem'
+ROUTE_PUT_ENTITY = 'PutEntity'
+ROUTE_LIST_ENTITIES = 'ListEntities'
+ROUTE_DELETE_ENTITY = 'DeleteEntity'
+
+
+class RouteStats:
+    '''Calls recorded for a single catalog route'''
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.response_bytes = 0
+        self.status_classes: Dict[str, int] = {}
+        self.connections_new = 0
+        self.connections_reused = 0
+
+
+# Route to its recorded calls
+_ROUTE_STATS: Dict[str, RouteStats] = {}
+# Connection pool to the number of connections it had opened when last seen
+_POOL_CONNECTIONS: 'WeakKeyDictionary[Any, int]' = WeakKeyDictionary()
+# ReconcileCatalog makes requests from several threads.
+_LOCK = Lock()
+# System to when its owner was looked up and the owner
+_SYSTEM_OWNERS: Dict[str, Tuple[float, str]] = {}
+# Collectors look up owners from several threads; a system missed by one is not looked up again by another.
+_SYSTEM_OWNERS_LOCK = Lock()
+
+
+def _is_new_connection(response: requests.Response) -> Optional[bool]:
+    '''Return whether a request opened a new connection, if it can be told'''
+    pool = getattr(response.raw, '_pool', None)
+    if pool is None:
+        return None
+
+    seen = _POOL_CONNECTIONS.get(pool, 0)
+    _POOL_CONNECTIONS[pool] = pool.num_connections
+    return pool.num_connections > seen
+
+
+def _record(route: str, response: requests.Response, elapsed_ms: float) -> None:
+    '''Record a completed request'''
+    with _LOCK:
+        stats = _ROUTE_STATS.setdefault(route, RouteStats())
+        stats.latencies.append(elapsed_ms)
+        stats.response_bytes += len(response.content)
+        status_class = '{}xx'.format(response.status_code // 100)
+        stats.status_classes[status_class] = stats.status_classes.get(status_class, 0) + 1
+
+        is_new_connection = _is_new_connection(response)
+        if is_new_connection is True:
+            stats.connections_new += 1
+        elif is_new_connection is False:
+            stats.connections_reused += 1
+
+
+def request(
+    method: str,
+    url: str,
+    route: str,
+    entity_ref: Optional[str] = None,
+    **kwargs
+) -> requests.Response:
+    '''Make a catalog request, recording its timing and outcome'''
+    start = perf_counter()
+    r = SESSION.request(method, url, **kwargs)
+    elapsed_ms = (perf_counter() - start) * 1000
+    _record(route, r, elapsed_ms)
+
+    if elapsed_ms >= CATALOG_SLOW_CALL_MS:
+        LOGGER.warning(
+            'Slow catalog call',
+            extra={
+                'route': route,
+                'method': method,
+                'status_code': r.status_code,
+                'elapsed_ms': round(elapsed_ms),
+                'entity_ref': entity_ref,
+            }
+        )
+
+    return r
+
+
+def get_entity_name(entity_type: str, resource_name: str, resource_id: str) -> str:
+    '''Return a catalog name for a resource, unique by resource_id and within the name limit'''
+    id_hash = sha256(resource_id.encode()).hexdigest()[:ENTITY_NAME_HASH_LENGTH]
+    name_length = ENTITY_NAME_MAX_LENGTH - len(entity_type) - len(id_hash) - 2
+    # Names may not end in a separator.
+    return '{}-{}-{}'.format(entity_type, resource_name[:name_length].rstrip('-_.'), id_hash)
+
+
+def cache_system_owner(get_system_owner: Callable[[str, Any], str]) -> Callable[[str, Any], str]:
+    '''Cache the owners returned by a system owner lookup for SYSTEM_OWNER_CACHE_SECONDS'''
+    @wraps(get_system_owner)
+    def _get_system_owner(system: str, auth: Any) -> str:
+        with _SYSTEM_OWNERS_LOCK:
+            cached = _SYSTEM_OWNERS.get(system)
+            if cached is not None and time() - cached[0] < SYSTEM_OWNER_CACHE_SECONDS:
+                return cached[1]
+
+            owner = get_system_owner(system, auth)
+            _SYSTEM_OWNERS[system] = (time(), owner)
+            return owner
+
+    return _get_system_owner
+
+
+def flush_metrics() -> None:
+    '''Write recorded catalog metrics and reset them'''
+    with _LOCK:
+        for route, stats in _ROUTE_STATS.items():
+            for i in range(0, max(len(stats.latencies), 1), MAX_METRIC_VALUES):
+                metrics = EphemeralMetrics(namespace=METRICS_NAMESPACE)
+                metrics.add_dimension('Route', route)
+                for latency in stats.latencies[i:i + MAX_METRIC_VALUES]:
+                    metrics.add_metric('CatalogCallLatency', MetricUnit.Milliseconds, latency)
+                if i == 0:
+                    metrics.add_metric('CatalogCalls', MetricUnit.Count, len(stats.latencies))
+                    metrics.add_metric('CatalogResponseBytes', MetricUnit.Bytes, stats.response_bytes)
+                    for status_class, count in sorted(stats.status_classes.items()):
+                        metrics.add_metric('CatalogResponses{}'.format(status_class), MetricUnit.Count, count)
+                    connections = stats.connections_new + stats.connections_reused
+                    if connections:
+                        metrics.add_metric(
+                            'CatalogConnectionReuse',
+                            MetricUnit.Percent,
+                            100 * stats.connections_reused / connections
+                        )
+                metrics.flush_metrics()
+
+        _ROUTE_STATS.clear()
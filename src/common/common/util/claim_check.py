@@ -0,0 +1,79 @@
+'''
+Claim-check offload
+
+SNS and SQS reject messages over 256 KiB. Publishers pass message bodies through offload() which
+stores bodies over a threshold in S3 and returns a small pointer in their place. Consumers pass
+received bodies through resolve() which returns non-pointer bodies untouched and downloads the
+rest. Objects are keyed by a hash of their content so identical payloads share an object, and
+downloads are cached so messages pointing at the same object only fetch it once.
+'''
+import json
+import os
+from functools import lru_cache
+from hashlib import sha256
+from typing import Optional
+
+from aws_lambda_powertools.logging import Logger
+
+from common.util import aws
+
+LOGGER = Logger(utc=True)
+
+# Offload is disabled when no bucket is configured.
+CLAIM_CHECK_BUCKET_NAME = os.environ.get('CLAIM_CHECK_BUCKET_NAME', '')
+# Leave headroom under the 256 KiB limit for message attributes and SNS overhead.
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', str(240 * 1024)))
+
+CLAIM_CHECK_KEY_PREFIX = 'claim-check/'
+# Pointers are always serialized with this prefix so resolve() can skip parsing other bodies.
+CLAIM_CHECK_POINTER_PREFIX = '{"ClaimCheck": '
+CLAIM_CHECK_CACHE_SIZE = 16
+
+
+def _get_key(body: bytes) -> str:
+    '''Return the content-addressed key for a body'''
+    return '{}{}'.format(CLAIM_CHECK_KEY_PREFIX, sha256(body).hexdigest())
+
+
+def is_pointer(body: str) -> bool:
+    '''Return whether a message body is a claim-check pointer'''
+    return body.startswith(CLAIM_CHECK_POINTER_PREFIX)
+
+
+def offload(
+    body: str,
+    bucket_name: Optional[str] = None,
+    threshold_bytes: Optional[int] = None
+) -> str:
+    '''Return the body, or a pointer to it in S3 when it is too large to send'''
+    bucket_name = bucket_name or CLAIM_CHECK_BUCKET_NAME
+    threshold_bytes = threshold_bytes or CLAIM_CHECK_THRESHOLD_BYTES
+    encoded_body = body.encode()
+    if not bucket_name or len(encoded_body) <= threshold_bytes:
+        return body
+
+    key = _get_key(encoded_body)
+    aws.get_client('s3').put_object(Bucket=bucket_name, Key=key, Body=encoded_body)
+    LOGGER.debug('Offloaded message body', extra={'key': key, 'size': len(encoded_body)})
+
+    return CLAIM_CHECK_POINTER_PREFIX + json.dumps({
+        'Bucket': bucket_name,
+        'Key': key,
+        'Size': len(encoded_body)
+    }) + '}'
+
+
+@lru_cache(maxsize=CLAIM_CHECK_CACHE_SIZE)
+def _get_object(bucket_name: str, key: str) -> str:
+    '''Return the contents of an offloaded body'''
+    LOGGER.debug('Downloading offloaded message body', extra={'key': key})
+    return aws.get_client('s3').get_object(Bucket=bucket_name, Key=key)['Body'].read().decode()
+
+
+def resolve(body: str) -> str:
+    '''Return the message body a pointer refers to, or the body itself'''
+    if not is_pointer(body):
+        return body
+
+    pointer = json.loads(body)['ClaimCheck']
+    return _get_object(pointer['Bucket'], pointer['Key'])
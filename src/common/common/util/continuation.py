@@ -0,0 +1,121 @@
+'''
+Deadline-aware work splitting
+
+Collectors check the time left in the invocation between pages of work. The deadline reserves the
+longest stretch of work seen between two checks on top of a fixed margin, so a page is only started
+when there is time to finish it. When the deadline is close they stop and put a continuation
+message carrying their cursor back on their own queue, so a large account is processed across
+several invocations instead of timing out and starting over. The same mechanism defers the rest of
+an account, with a delay, when the downstream queue is backed up, up to a limit so accounts are not
+put back indefinitely while the catalog stays unhealthy. Handlers without regions put the account
+back whole, with a continuation that only counts its deferrals.
+'''
+import json
+import os
+from typing import List, Optional, Tuple
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.account import AccountTypeWithTags, Continuation
+from common.util import JSONDateTimeEncoder
+from common.util import sqs
+
+LOGGER = Logger(utc=True)
+
+# Delayed continuations an account may be put back with before it is dropped until the next sweep.
+MAX_DEFERRALS = int(os.environ.get('MAX_DEFERRALS', '12'))
+
+
+class Deadline:
+    '''Time left in an invocation'''
+    def __init__(self, context: LambdaContext, margin_ms: int):
+        self.context = context
+        self.margin_ms = margin_ms
+        # Longest time between two checks, the cost of a unit of work.
+        self.unit_ms = 0
+        self._last_remaining_ms: Optional[int] = None
+
+    def expired(self) -> bool:
+        '''Return whether the invocation should stop starting new work'''
+        remaining_ms = self.context.get_remaining_time_in_millis()
+        if self._last_remaining_ms is not None:
+            self.unit_ms = max(self.unit_ms, self._last_remaining_ms - remaining_ms)
+        self._last_remaining_ms = remaining_ms
+
+        return remaining_ms < self.margin_ms + self.unit_ms
+
+
+def make_continuation(
+    region: str,
+    next_token: Optional[str] = None,
+    cluster: Optional[str] = None
+) -> Continuation:
+    '''Return a cursor for a region and page, and the cluster the page belongs to if any'''
+    continuation = Continuation({'Region': region})
+    if cluster:
+        continuation['Cluster'] = cluster
+    if next_token:
+        continuation['NextToken'] = next_token
+    return continuation
+
+
+def get_remaining_regions(
+    regions: List[str],
+    continuation: Optional[Continuation]
+) -> Tuple[List[str], Optional[str]]:
+    '''
+    Return the regions left to collect and the page token to resume the first of them at.
+
+    A cursor for a region that is no longer collected starts the account over rather than failing
+    every redelivery of the message.
+    '''
+    if continuation is None or 'Region' not in continuation:
+        return regions, None
+
+    if continuation['Region'] not in regions:
+        LOGGER.warning(
+            'Continuation region is not collected; starting over',
+            extra={'continuation': continuation, 'regions': regions}
+        )
+        return regions, None
+
+    return regions[regions.index(continuation['Region']):], continuation.get('NextToken')
+
+
+def send_continuation(
+    account_info: AccountTypeWithTags,
+    continuation: Continuation,
+    queue_url: str,
+    delay_seconds: int = 0
+) -> None:
+    '''Enqueue the rest of an account's work, unless it has been deferred too many times'''
+    deferrals = account_info.get('Continuation', {}).get('Deferrals', 0)
+    if delay_seconds > 0:
+        deferrals += 1
+        if deferrals > MAX_DEFERRALS:
+            LOGGER.error(
+                'Account deferred too many times; dropping until the next sweep',
+                extra={
+                    'account_id': account_info.get('Id'),
+                    'continuation': continuation,
+                    'deferrals': deferrals - 1
+                }
+            )
+            return
+    if deferrals:
+        continuation['Deferrals'] = deferrals
+
+    LOGGER.info(
+        'Continuing in a new invocation',
+        extra={
+            'account_id': account_info.get('Id'),
+            'continuation': continuation,
+            'delay': delay_seconds
+        }
+    )
+    sqs.send_message(
+        queue_url,
+        json.dumps({**account_info, 'Continuation': continuation}, cls=JSONDateTimeEncoder),
+        delay_seconds
+    )
@@ -0,0 +1,110 @@
+'''
+Entity envelopes
+
+Collectors pack many entities into a single SQS message instead of sending one message per
+entity. An envelope is either a plain JSON list of entities or, when compression is enabled, the
+same list compressed with zlib and base64 encoded. Messages that are not envelopes are treated as
+a single bare entity so older producers keep working.
+'''
+import json
+import os
+from base64 import b64decode, b64encode
+from typing import List
+from zlib import compress, decompress
+
+from common.model.entity import Entity
+from common.util import claim_check
+
+ENVELOPE_VERSION = 1
+ENCODING_JSON = 'json'
+ENCODING_ZLIB = 'zlib'
+
+# Envelopes fill up to the claim-check threshold so only entities too large to share an envelope
+# are offloaded to S3.
+MAX_ENVELOPE_BYTES = claim_check.CLAIM_CHECK_THRESHOLD_BYTES
+# The catalog writer PUTs an envelope's entities one at a time, so envelopes are also capped at what
+# a batch of them can write within its timeout.
+MAX_ENVELOPE_ENTITIES = int(os.environ.get('ENVELOPE_MAX_ENTITIES', '25'))
+# Bytes used by the envelope around its entities.
+ENVELOPE_OVERHEAD_BYTES = 64
+# Expected compression ratio used to size batches before compressing. Batches that still
+# compress too large are split.
+COMPRESSION_RATIO_ESTIMATE = 4
+
+
+def _encode(serialized_entities: List[str], use_compression: bool) -> str:
+    '''Return an envelope for already serialized entities'''
+    entities = '[{}]'.format(','.join(serialized_entities))
+    if not use_compression:
+        return '{{"Envelope": {}, "Encoding": "{}", "Entities": {}}}'.format(
+            ENVELOPE_VERSION,
+            ENCODING_JSON,
+            entities
+        )
+
+    return json.dumps({
+        'Envelope': ENVELOPE_VERSION,
+        'Encoding': ENCODING_ZLIB,
+        'Payload': b64encode(compress(entities.encode())).decode()
+    })
+
+
+def _split(serialized_entities: List[str], use_compression: bool, max_bytes: int) -> List[str]:
+    '''Return envelopes for a batch, halving it until each envelope fits'''
+    envelope = _encode(serialized_entities, use_compression)
+    if len(envelope.encode()) <= max_bytes or len(serialized_entities) == 1:
+        return [envelope]
+
+    middle = len(serialized_entities) // 2
+    return (
+        _split(serialized_entities[:middle], use_compression, max_bytes) +
+        _split(serialized_entities[middle:], use_compression, max_bytes)
+    )
+
+
+def pack_entities(
+    entities: List[Entity],
+    use_compression: bool = False,
+    max_bytes: int = MAX_ENVELOPE_BYTES,
+    max_entities: int = MAX_ENVELOPE_ENTITIES
+) -> List[str]:
+    '''
+    Pack entities into as few envelopes as fit the size and entity limits.
+
+    An entity that is too large on its own is still sent in an envelope by itself.
+    '''
+    if use_compression:
+        batch_bytes = max_bytes * COMPRESSION_RATIO_ESTIMATE
+    else:
+        batch_bytes = max_bytes - ENVELOPE_OVERHEAD_BYTES
+    envelopes: List[str] = []
+    batch: List[str] = []
+    size = 0
+    for entity in entities:
+        serialized_entity = json.dumps(entity)
+        entity_bytes = len(serialized_entity.encode()) + 1
+        if batch and (size + entity_bytes > batch_bytes or len(batch) >= max_entities):
+            envelopes += _split(batch, use_compression, max_bytes)
+            batch = []
+            size = 0
+        batch.append(serialized_entity)
+        size += entity_bytes
+
+    if batch:
+        envelopes += _split(batch, use_compression, max_bytes)
+
+    return envelopes
+
+
+def unpack_entities(body: str) -> List[Entity]:
+    '''Return the entities in a message body'''
+    message = json.loads(body)
+    if 'Envelope' not in message:
+        return [Entity(**message)]
+
+    if message.get('Encoding') == ENCODING_ZLIB:
+        entities = json.loads(decompress(b64decode(message['Payload'])))
+    else:
+        entities = message['Entities']
+
+    return [Entity(**entity) for entity in entities]
@@ -0,0 +1,142 @@
+'''
+AWS API call instrumentation
+
+Clients passed through instrument_client() record the latency, retries and throttles of every API
+call, grouped by service and operation. Handlers decorated with emit_metrics() write the recorded
+calls, along with the catalog's, as CloudWatch embedded metric format (EMF) at the end of each
+invocation, one metric set per operation, and start the next invocation from zero.
+'''
+import os
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+from aws_lambda_powertools.middleware_factory import lambda_handler_decorator
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from botocore.client import BaseClient
+
+from common.util import catalog
+
+METRICS_NAMESPACE = os.environ.get('POWERTOOLS_METRICS_NAMESPACE', 'AwsResourceCollector')
+# EMF accepts at most this many values per metric in a single document.
+MAX_METRIC_VALUES = 100
+THROTTLE_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+}
+
+_START_KEY = 'instrumentation_started_at'
+
+ClientT = TypeVar('ClientT', bound=BaseClient)
+
+
+class OperationStats:
+    '''Calls recorded for a single API operation'''
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+
+
+# (service, operation) to its recorded calls
+_OPERATION_STATS: Dict[Tuple[str, str], OperationStats] = {}
+# Collectors make calls from several threads.
+_LOCK = Lock()
+
+
+def _get_stats(model: Any) -> OperationStats:
+    '''Return the stats for an operation model'''
+    key = (model.service_model.service_id, model.name)
+    if key not in _OPERATION_STATS:
+        _OPERATION_STATS[key] = OperationStats()
+    return _OPERATION_STATS[key]
+
+
+def _before_call(model: Any, context: Dict[str, Any], **kwargs) -> None:
+    '''Note when a call started'''
+    context[_START_KEY] = perf_counter()
+
+
+def _after_call(model: Any, parsed: Dict[str, Any], context: Dict[str, Any], **kwargs) -> None:
+    '''Record a completed call'''
+    with _LOCK:
+        stats = _get_stats(model)
+        if _START_KEY in context:
+            stats.latencies.append((perf_counter() - context.pop(_START_KEY)) * 1000)
+        stats.retries += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if 'Error' in parsed:
+            stats.errors += 1
+
+
+def _after_call_error(model: Any, context: Dict[str, Any], **kwargs) -> None:
+    '''Record a call that failed without a response'''
+    with _LOCK:
+        stats = _get_stats(model)
+        if _START_KEY in context:
+            stats.latencies.append((perf_counter() - context.pop(_START_KEY)) * 1000)
+        stats.errors += 1
+
+
+def _needs_retry(operation: Any, response: Any = None, **kwargs) -> None:
+    '''Record throttled attempts'''
+    if response is None:
+        return
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in THROTTLE_ERROR_CODES:
+        with _LOCK:
+            _get_stats(operation).throttles += 1
+
+
+def instrument_client(client: ClientT) -> ClientT:
+    '''Record API call metrics for a client and return it'''
+    events = client.meta.events
+    events.register('before-call', _before_call, unique_id='instrumentation-before-call')
+    events.register('after-call', _after_call, unique_id='instrumentation-after-call')
+    events.register('after-call-error', _after_call_error, unique_id='instrumentation-after-call-error')
+    events.register('needs-retry', _needs_retry, unique_id='instrumentation-needs-retry')
+    return client
+
+
+def flush_metrics() -> None:
+    '''Write recorded API call metrics and reset them'''
+    with _LOCK:
+        _flush_metrics()
+
+
+def _flush_metrics() -> None:
+    '''Write recorded API call metrics and reset them, holding the lock'''
+    for (service, operation), stats in _OPERATION_STATS.items():
+        # Split long latency lists so no document exceeds the EMF value limit.
+        for i in range(0, max(len(stats.latencies), 1), MAX_METRIC_VALUES):
+            metrics = EphemeralMetrics(namespace=METRICS_NAMESPACE)
+            metrics.add_dimension('Service', service)
+            metrics.add_dimension('Operation', operation)
+            for latency in stats.latencies[i:i + MAX_METRIC_VALUES]:
+                metrics.add_metric('ApiCallLatency', MetricUnit.Milliseconds, latency)
+            if i == 0:
+                metrics.add_metric('ApiCalls', MetricUnit.Count, len(stats.latencies))
+                metrics.add_metric('ApiCallRetries', MetricUnit.Count, stats.retries)
+                metrics.add_metric('ApiCallThrottles', MetricUnit.Count, stats.throttles)
+                metrics.add_metric('ApiCallErrors', MetricUnit.Count, stats.errors)
+            metrics.flush_metrics()
+
+    _OPERATION_STATS.clear()
+
+
+@lambda_handler_decorator
+def emit_metrics(handler: Callable[..., Any], event: Dict[str, Any], context: LambdaContext) -> Any:
+    '''Write API call metrics when the handler returns or raises'''
+    try:
+        return handler(event, context)
+    finally:
+        flush_metrics()
+        catalog.flush_metrics()
@@ -1,9 +1,11 @@
 '''JWT Authentication'''
-from requests import post
 from requests.auth import AuthBase
 from time import time
 
 from aws_lambda_powertools.logging import Logger
+
+from common.util import catalog
+
 LOGGER = Logger(utc=True)
 
 AUTH_ENDPOINT = 'https://auth.serverlessops.io/oauth2/token'
@@ -29,8 +31,10 @@ class JwtAuth(AuthBase):
 
     def _fetch_jwt(self) -> None:
         LOGGER.info('Fetching JWT token')
-        response = post(
+        response = catalog.request(
+            'POST',
             AUTH_ENDPOINT,
+            catalog.ROUTE_FETCH_TOKEN,
             data={
                 'grant_type': 'client_credentials',
                 'client_id': self.client_id,
@@ -0,0 +1,110 @@
+'''
+Opt-in handler profiling
+
+Handlers decorated with profile_handler() run a sample of invocations under cProfile when
+PROFILING_ENABLED is set. The functions with the most cumulative time are logged as a structured
+record, and when PROFILING_BUCKET_NAME is set the raw profile is saved to S3 where it can be
+loaded with pstats for a closer look.
+'''
+import cProfile
+import marshal
+import os
+import pstats
+import random
+from typing import Any, Callable, Dict, List, Optional
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.middleware_factory import lambda_handler_decorator
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.util import aws
+
+LOGGER = Logger(utc=True)
+
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+# Fraction of invocations profiled when enabled.
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0.01'))
+PROFILING_TOP_N = int(os.environ.get('PROFILING_TOP_N', '25'))
+# Raw profiles are not saved when no bucket is configured.
+PROFILING_BUCKET_NAME = os.environ.get('PROFILING_BUCKET_NAME', '')
+
+PROFILE_KEY_PREFIX = 'profiles/'
+
+
+def _is_sampled() -> bool:
+    '''Return whether to profile this invocation'''
+    return PROFILING_ENABLED and random.random() < PROFILING_SAMPLE_RATE
+
+
+def _get_top_functions(stats: pstats.Stats, top_n: int) -> List[Dict[str, Any]]:
+    '''Return the functions with the most cumulative time'''
+    functions = sorted(
+        stats.stats.items(),    # type: ignore[attr-defined]
+        key=lambda item: item[1][3],
+        reverse=True
+    )
+    return [
+        {
+            'function': '{}:{}({})'.format(filename, line, name),
+            'calls': calls,
+            'total_ms': round(total_time * 1000, 3),
+            'cumulative_ms': round(cumulative_time * 1000, 3),
+        }
+        for (filename, line, name), (_, calls, total_time, cumulative_time, _) in functions[:top_n]
+    ]
+
+
+def _save_profile(stats: pstats.Stats, context: LambdaContext) -> Optional[str]:
+    '''Save the raw profile to S3 and return its key'''
+    if not PROFILING_BUCKET_NAME:
+        return None
+
+    key = '{}{}/{}.pstats'.format(PROFILE_KEY_PREFIX, context.function_name, context.aws_request_id)
+    aws.get_client('s3').put_object(
+        Bucket=PROFILING_BUCKET_NAME,
+        Key=key,
+        # The format pstats.Stats.dump_stats() writes and pstats.Stats() loads.
+        Body=marshal.dumps(stats.stats)    # type: ignore[attr-defined]
+    )
+    return key
+
+
+def _log_profile(profiler: cProfile.Profile, context: LambdaContext) -> None:
+    '''Log the top functions of a profile and save the raw profile'''
+    stats = pstats.Stats(profiler)
+    try:
+        key = _save_profile(stats, context)
+    except Exception as e:    # pylint: disable=broad-exception-caught
+        # Losing a profile must not fail the invocation.
+        LOGGER.warning('Failed to save profile', extra={'error': str(e)})
+        key = None
+
+    LOGGER.info(
+        'Handler profile',
+        extra={
+            'profile_total_ms': round(stats.total_tt * 1000, 3),    # type: ignore[attr-defined]
+            'profile_functions': _get_top_functions(stats, PROFILING_TOP_N),
+            'profile_key': key,
+        }
+    )
+
+
+@lambda_handler_decorator
+def profile_handler(handler: Callable[..., Any], event: Dict[str, Any], context: LambdaContext) -> Any:
+    '''Profile a sample of invocations when profiling is enabled'''
+    if not _is_sampled():
+        return handler(event, context)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Only one profiler can be active at a time.
+        LOGGER.warning('Profiler unavailable', extra={'error': str(e)})
+        return handler(event, context)
+
+    try:
+        return handler(event, context)
+    finally:
+        profiler.disable()
+        _log_profile(profiler, context)
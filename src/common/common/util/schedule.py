@@ -0,0 +1,78 @@
+'''
+Jittered sweep scheduling
+
+Rather than every account being processed the moment ListAccounts publishes it, each account is
+given a NotBefore time. Accounts are ordered by a stable hash of their ID and spaced out at a
+steady rate so each lands at roughly the same point of every sweep. Collectors receiving an
+account before it is due put it back on their own queue with a delay, re-enqueueing as many times
+as needed because SQS caps a single delay at 15 minutes.
+'''
+import json
+from hashlib import sha256
+from time import time
+from typing import Dict, List
+
+from aws_lambda_powertools.logging import Logger
+
+from common.model.account import AccountTypeWithTags
+from common.util import JSONDateTimeEncoder
+from common.util import sqs
+
+LOGGER = Logger(utc=True)
+
+SCHEDULE_MODE_BURST = 'burst'
+SCHEDULE_MODE_JITTERED = 'jittered'
+
+
+def _stable_hash(account_id: str) -> str:
+    '''Return a hash of the account ID that is stable across invocations'''
+    return sha256(account_id.encode()).hexdigest()
+
+
+def get_schedule_offsets(
+    account_ids: List[str],
+    accounts_per_minute: float,
+    interval_seconds: int
+) -> Dict[str, int]:
+    '''
+    Return the delay in seconds before each account should be processed.
+
+    Accounts are started at a steady rate. If that rate would not fit every account inside the
+    sweep interval the accounts are spread evenly over the interval instead.
+    '''
+    ordered_ids = sorted(account_ids, key=_stable_hash)
+    spacing = 60 / accounts_per_minute
+    if len(ordered_ids) * spacing > interval_seconds:
+        LOGGER.warning(
+            'Schedule rate cannot fit all accounts in the sweep interval; spreading evenly',
+            extra={'accounts': len(ordered_ids), 'accounts_per_minute': accounts_per_minute}
+        )
+        spacing = interval_seconds / len(ordered_ids)
+
+    return {account_id: int(slot * spacing) for slot, account_id in enumerate(ordered_ids)}
+
+
+def defer_until_due(account_info: AccountTypeWithTags, queue_url: str) -> bool:
+    '''
+    Put an account that is not yet due back on the queue.
+
+    Returns True when the account was deferred and should not be processed now.
+    '''
+    not_before = account_info.get('NotBefore')
+    if not_before is None:
+        return False
+
+    delay = not_before - int(time())
+    if delay <= 0:
+        return False
+
+    LOGGER.debug(
+        'Deferring account until due',
+        extra={'account_id': account_info.get('Id'), 'delay': delay}
+    )
+    sqs.send_message(
+        queue_url,
+        json.dumps(account_info, cls=JSONDateTimeEncoder),
+        delay
+    )
+    return True
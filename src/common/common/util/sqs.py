@@ -0,0 +1,54 @@
+'''SQS messaging'''
+from time import monotonic
+from typing import TYPE_CHECKING, Dict, Tuple
+
+from aws_lambda_powertools.logging import Logger
+
+from common.util import aws, claim_check
+
+if TYPE_CHECKING:
+    from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
+
+LOGGER = Logger(utc=True)
+
+# SQS rejects larger per-message delays.
+MAX_DELAY_SECONDS = 900
+# Queue depth samples are reused for this long to keep GetQueueAttributes calls down.
+QUEUE_DEPTH_CACHE_SECONDS = 5
+
+# Queue URL to the time it was sampled and its depth.
+_QUEUE_DEPTH_SAMPLES: Dict[str, Tuple[float, int]] = {}
+
+
+def send_message(queue_url: str, body: str, delay_seconds: int = 0) -> 'SendMessageResultTypeDef':
+    '''Send a message to SQS, optionally delaying its delivery'''
+    return aws.get_client('sqs').send_message(
+        QueueUrl=queue_url,
+        MessageBody=claim_check.offload(body),
+        DelaySeconds=max(0, min(delay_seconds, MAX_DELAY_SECONDS))
+    )
+
+
+def get_queue_depth(queue_url: str) -> int:
+    '''Return the approximate number of messages waiting on a queue'''
+    sample = _QUEUE_DEPTH_SAMPLES.get(queue_url)
+    if sample is not None and monotonic() - sample[0] < QUEUE_DEPTH_CACHE_SECONDS:
+        return sample[1]
+
+    attributes = aws.get_client('sqs').get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']
+    depth = int(attributes['ApproximateNumberOfMessages'])
+    _QUEUE_DEPTH_SAMPLES[queue_url] = (monotonic(), depth)
+    return depth
+
+
+def is_backed_up(queue_url: str, max_depth: int) -> bool:
+    '''Return whether a queue holds more messages than its consumers are keeping up with'''
+    depth = get_queue_depth(queue_url)
+    if depth <= max_depth:
+        return False
+
+    LOGGER.warning('Queue backed up', extra={'queue_url': queue_url, 'depth': depth, 'max_depth': max_depth})
+    return True
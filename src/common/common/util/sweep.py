@@ -0,0 +1,345 @@
+'''
+Sweep generation tracking
+
+Every ListAccounts run is a sweep identified by a generation ID. Collectors stamp the generation
+into the annotations of every entity they emit and mark each account complete when they finish
+with it. Once every collector has completed every account the sweep is recorded as the last
+completed sweep and any collector owned entity still carrying an older generation is stale.
+
+The catalog writer skips entities it wrote within its idempotency window, so an entity unchanged
+since an overlapping sweep keeps that sweep's older generation in the catalog. The writer records
+the newer generation that saw it in the state table instead, and the reconciler checks those
+records before treating an entity as stale.
+
+Resources shared through RAM, such as VPCs, are visible in every participant account but are only
+emitted from their owner account. Participants record themselves in a per-sweep index of shared
+resources, one item per owner account, which the owner reads to annotate its entities. A resource
+whose owner is outside the organization is never collected from its owner, so participants emit it.
+'''
+from time import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+
+from botocore.exceptions import ClientError
+from aws_lambda_powertools.logging import Logger
+
+from common.model.entity import Entity
+from common.model.sweep import CompletedSweep
+from common.util import aws
+
+if TYPE_CHECKING:
+    from mypy_boto3_dynamodb.type_defs import AttributeValueTypeDef
+
+LOGGER = Logger(utc=True)
+
+SWEEP_ANNOTATION = 'io.serverlessops/sweep-id'
+LAST_COMPLETED_KEY = 'sweep#last-completed'
+# BatchGetItem takes at most this many keys.
+BATCH_GET_MAX_KEYS = 100
+# Sweep items are only needed until the next few sweeps have completed.
+SWEEP_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def _sweep_key(sweep_id: str) -> str:
+    '''Return the state table key for a sweep'''
+    return 'sweep#{}'.format(sweep_id)
+
+
+def _completion_key(sweep_id: str, collector: str, account_id: str) -> str:
+    '''Return the state table key for a collector's completion of an account in a sweep'''
+    return '{}#completed#{}#{}'.format(_sweep_key(sweep_id), collector, account_id)
+
+
+def _seen_key(entity_ref: str) -> str:
+    '''Return the state table key for the latest sweep to see an entity'''
+    return 'seen#{}'.format(entity_ref)
+
+
+def _shared_key(sweep_id: str, resource_type: str, owner_account_id: str) -> str:
+    '''Return the state table key for the shared resources of an owner account in a sweep'''
+    return '{}#shared#{}#{}'.format(_sweep_key(sweep_id), resource_type, owner_account_id)
+
+
+def new_sweep_id() -> str:
+    '''Return a new, monotonically increasing sweep generation ID'''
+    return str(int(time()))
+
+
+def stamp_entity(entity: Entity, sweep_id: Optional[str]) -> Entity:
+    '''Stamp the sweep generation into an entity's annotations'''
+    if sweep_id:
+        entity['metadata']['annotations'][SWEEP_ANNOTATION] = sweep_id
+    return entity
+
+
+def get_entity_generation(entity: Entity) -> Optional[int]:
+    '''Return the sweep generation stamped on an entity'''
+    sweep_id = entity.get('metadata', {}).get('annotations', {}).get(SWEEP_ANNOTATION)
+    if sweep_id is None or not sweep_id.isdigit():
+        return None
+    return int(sweep_id)
+
+
+def start_sweep(
+    table_name: str,
+    sweep_id: str,
+    account_ids: List[str],
+    collectors: List[str],
+    org_account_ids: Optional[List[str]] = None
+) -> None:
+    '''
+    Record a new sweep and the number of account completions it is waiting on.
+
+    When only some accounts are scanned, org_account_ids lists every account in the organization
+    so entities of accounts skipped this sweep are not mistaken for stale ones.
+    '''
+    now = int(time())
+    item: Dict[str, 'AttributeValueTypeDef'] = {
+        'pk': {'S': _sweep_key(sweep_id)},
+        'Generation': {'N': sweep_id},
+        'Expected': {'N': str(len(account_ids) * len(collectors))},
+        'StartedAt': {'N': str(now)},
+        'expiration': {'N': str(now + SWEEP_TTL_SECONDS)},
+    }
+    # String sets cannot be empty.
+    if org_account_ids is not None and account_ids:
+        item['Accounts'] = {'SS': account_ids}
+    if org_account_ids:
+        item['OrgAccounts'] = {'SS': org_account_ids}
+
+    aws.get_client('dynamodb').put_item(TableName=table_name, Item=item)
+    LOGGER.info(
+        'Sweep started',
+        extra={'sweep_id': sweep_id, 'accounts': len(account_ids), 'collectors': collectors}
+    )
+
+
+def get_org_accounts(table_name: str, sweep_id: str) -> Optional[Set[str]]:
+    '''Return every account in the organization when a sweep started, if the sweep recorded them'''
+    item = aws.get_client('dynamodb').get_item(
+        TableName=table_name,
+        Key={'pk': {'S': _sweep_key(sweep_id)}},
+        ProjectionExpression='OrgAccounts'
+    ).get('Item')
+
+    if item is None or 'OrgAccounts' not in item:
+        return None
+
+    return set(item['OrgAccounts']['SS'])
+
+
+def complete_account(table_name: str, sweep_id: str, collector: str, account_id: str) -> bool:
+    '''
+    Mark an account complete for a collector.
+
+    Each completion is its own item, written in the same transaction that counts it on the sweep,
+    so redelivered messages are counted once and the sweep item stays the same size however many
+    accounts there are. Returns True when this completion finished the sweep.
+    '''
+    dynamodb = aws.get_client('dynamodb')
+    try:
+        dynamodb.transact_write_items(
+            TransactItems=[
+                {
+                    'Put': {
+                        'TableName': table_name,
+                        'Item': {
+                            'pk': {'S': _completion_key(sweep_id, collector, account_id)},
+                            'expiration': {'N': str(int(time()) + SWEEP_TTL_SECONDS)},
+                        },
+                        'ConditionExpression': 'attribute_not_exists(pk)',
+                    }
+                },
+                {
+                    'Update': {
+                        'TableName': table_name,
+                        'Key': {'pk': {'S': _sweep_key(sweep_id)}},
+                        'UpdateExpression': 'ADD Completed :one',
+                        'ConditionExpression': 'attribute_exists(pk)',
+                        'ExpressionAttributeValues': {':one': {'N': '1'}},
+                    }
+                },
+            ]
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            raise e
+        reason_codes: List[Optional[str]] = [
+            reason.get('Code') for reason in e.response.get('CancellationReasons', [{}, {}])
+        ]
+        completion, sweep_update = reason_codes
+        if sweep_update == 'ConditionalCheckFailed':
+            LOGGER.warning('Sweep not found; completion not recorded', extra={'sweep_id': sweep_id})
+        elif completion == 'ConditionalCheckFailed':
+            LOGGER.info(
+                'Completion already recorded',
+                extra={'sweep_id': sweep_id, 'collector': collector, 'account_id': account_id}
+            )
+        else:
+            raise e
+        return False
+
+    item = dynamodb.get_item(
+        TableName=table_name,
+        Key={'pk': {'S': _sweep_key(sweep_id)}},
+        ConsistentRead=True
+    )['Item']
+    completed = int(item['Completed']['N'])
+    expected = int(item['Expected']['N'])
+    if completed < expected:
+        return False
+
+    _set_last_completed(table_name, sweep_id, item)
+    return True
+
+
+def _set_last_completed(
+    table_name: str,
+    sweep_id: str,
+    sweep_item: Dict[str, 'AttributeValueTypeDef']
+) -> None:
+    '''Record a sweep as the last completed sweep unless a newer sweep already is'''
+    item: Dict[str, 'AttributeValueTypeDef'] = {
+        'pk': {'S': LAST_COMPLETED_KEY},
+        'Generation': {'N': sweep_id},
+        'CompletedAt': {'N': str(int(time()))},
+    }
+    for attribute in ['Accounts', 'OrgAccounts']:
+        if attribute in sweep_item:
+            item[attribute] = sweep_item[attribute]
+
+    try:
+        aws.get_client('dynamodb').put_item(
+            TableName=table_name,
+            Item=item,
+            ConditionExpression='attribute_not_exists(Generation) OR Generation < :generation',
+            ExpressionAttributeValues={':generation': {'N': sweep_id}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+        LOGGER.info('Newer sweep already completed', extra={'sweep_id': sweep_id})
+        return
+
+    LOGGER.info('Sweep completed', extra={'sweep_id': sweep_id})
+
+
+def mark_seen(table_name: str, entity_ref: str, sweep_id: str) -> None:
+    '''Record that a sweep saw an entity whose catalog copy carries an older generation'''
+    try:
+        aws.get_client('dynamodb').update_item(
+            TableName=table_name,
+            Key={'pk': {'S': _seen_key(entity_ref)}},
+            UpdateExpression='SET Generation = :generation, expiration = :expiration',
+            ConditionExpression='attribute_not_exists(Generation) OR Generation < :generation',
+            ExpressionAttributeValues={
+                ':generation': {'N': sweep_id},
+                ':expiration': {'N': str(int(time()) + SWEEP_TTL_SECONDS)},
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise e
+
+
+def get_seen_generations(table_name: str, entity_refs: List[str]) -> Dict[str, int]:
+    '''Return the latest sweep recorded as seeing each entity, for the entities that have one'''
+    dynamodb = aws.get_client('dynamodb')
+    generations: Dict[str, int] = {}
+    unique_refs = list(dict.fromkeys(entity_refs))
+    for i in range(0, len(unique_refs), BATCH_GET_MAX_KEYS):
+        request_items: Dict[str, Any] = {
+            table_name: {
+                'Keys': [
+                    {'pk': {'S': _seen_key(entity_ref)}}
+                    for entity_ref in unique_refs[i:i + BATCH_GET_MAX_KEYS]
+                ],
+                'ConsistentRead': True
+            }
+        }
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(table_name, []):
+                generations[item['pk']['S'].split('#', 1)[1]] = int(item['Generation']['N'])
+            request_items = response.get('UnprocessedKeys', {})
+
+    return generations
+
+
+def add_participant(
+    table_name: str,
+    sweep_id: str,
+    resource_type: str,
+    owner_account_id: str,
+    resource_ids: List[str],
+    account_id: str
+) -> None:
+    '''Record an account as a participant in resources shared by another account'''
+    if not resource_ids:
+        return
+
+    # One attribute per resource holds its participants, so a single update covers them all.
+    names = {'#r{}'.format(i): resource_id for i, resource_id in enumerate(resource_ids)}
+    aws.get_client('dynamodb').update_item(
+        TableName=table_name,
+        Key={'pk': {'S': _shared_key(sweep_id, resource_type, owner_account_id)}},
+        UpdateExpression='SET expiration = :expiration ADD {}'.format(
+            ', '.join('{} :account'.format(name) for name in names)
+        ),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues={
+            ':account': {'SS': [account_id]},
+            ':expiration': {'N': str(int(time()) + SWEEP_TTL_SECONDS)},
+        }
+    )
+
+
+def get_participants(
+    table_name: str,
+    sweep_ids: List[str],
+    resource_type: str,
+    owner_account_id: str
+) -> Dict[str, Set[str]]:
+    '''
+    Return the participant accounts of an owner account's shared resources, by resource ID.
+
+    Participants are merged across the given sweeps. Accounts are collected concurrently, so the
+    owner may read the current sweep's index before every participant has recorded itself; also
+    reading the last completed sweep fills in the participants that have not yet.
+    '''
+    keys = [
+        {'pk': {'S': _shared_key(sweep_id, resource_type, owner_account_id)}}
+        for sweep_id in dict.fromkeys(sweep_ids)
+    ]
+    response = aws.get_client('dynamodb').batch_get_item(
+        RequestItems={table_name: {'Keys': keys, 'ConsistentRead': True}}
+    )
+
+    participants: Dict[str, Set[str]] = {}
+    for item in response['Responses'].get(table_name, []):
+        for name, value in item.items():
+            if 'SS' in value:
+                participants.setdefault(name, set()).update(value['SS'])
+
+    return participants
+
+
+def get_last_completed(table_name: str) -> Optional[CompletedSweep]:
+    '''Return the last completed sweep'''
+    item = aws.get_client('dynamodb').get_item(
+        TableName=table_name,
+        Key={'pk': {'S': LAST_COMPLETED_KEY}},
+        ConsistentRead=True
+    ).get('Item')
+
+    if item is None:
+        return None
+
+    last_sweep = CompletedSweep({
+        'Generation': int(item['Generation']['N']),
+        'CompletedAt': int(item['CompletedAt']['N']),
+    })
+    if 'OrgAccounts' in item:
+        last_sweep['Accounts'] = item.get('Accounts', {}).get('SS', [])
+        last_sweep['OrgAccounts'] = item['OrgAccounts']['SS']
+
+    return last_sweep
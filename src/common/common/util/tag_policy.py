@@ -0,0 +1,131 @@
+'''
+Tag policy
+
+Entity system, owner and lifecycle are resolved from tags by a policy of rules, one per field. A
+rule reads the first of its tag keys that is present, applies its regex rewrites to the value, and
+otherwise falls back to the value the entity builder supplies and then to the rule's default. A
+resource's own tags take precedence, and builders pass what they know about the resource, such as
+its account's system or its state, as the fallback.
+
+The policy is configured by TAG_POLICY and compiled once at cold start. Resources in an account
+share a small number of tag combinations, so resolutions are memoized on the values of the tags
+the policy reads and the builder's fallbacks.
+'''
+import json
+import os
+import re
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Mapping, NamedTuple, Optional, Pattern, Tuple
+
+# Field to its rule. Rules take keys, rewrites of {'pattern', 'replacement'} and a default.
+# An owner only comes from tags when the rule is given keys, otherwise it is looked up by system.
+TAG_POLICY = json.loads(os.environ.get('TAG_POLICY', '{}'))
+DEFAULT_TAG_POLICY: Dict[str, Dict[str, Any]] = {
+    'system': {'keys': ['org:system'], 'default': 'UNKNOWN'},
+    'owner': {'keys': []},
+    'lifecycle': {'keys': []},
+}
+# Distinct tag combinations kept per container.
+TAG_POLICY_CACHE_SIZE = int(os.environ.get('TAG_POLICY_CACHE_SIZE', '4096'))
+
+
+class Resolution(NamedTuple):
+    '''Entity fields resolved from tags'''
+    system: str
+    owner: Optional[str]
+    lifecycle: Optional[str]
+
+
+def get_tag_values(tags: Iterable[Mapping[str, Any]]) -> Dict[str, str]:
+    '''Return a list of AWS tags as a dict
+
+    Most services return Key/Value but some, like ECS, return key/value.
+    '''
+    values = {}
+    for tag in tags:
+        key = tag.get('Key', tag.get('key'))
+        if key is not None:
+            values[key] = tag.get('Value', tag.get('value', ''))
+    return values
+
+
+def get_account_tag_values(account_info: Mapping[str, Any]) -> Dict[str, str]:
+    '''Return an account's tags over those it inherits from its organizational units'''
+    return {
+        **get_tag_values(account_info.get('InheritedTags', [])),
+        **get_tag_values(account_info.get('Tags', []))
+    }
+
+
+class FieldRule:
+    '''How one entity field is read from tags'''
+    def __init__(
+        self,
+        keys: List[str],
+        rewrites: Optional[List[Dict[str, str]]] = None,
+        default: Optional[str] = None
+    ):
+        self.keys = tuple(keys)
+        self.rewrites: Tuple[Tuple[Pattern[str], str], ...] = tuple(
+            (re.compile(rewrite['pattern']), rewrite['replacement']) for rewrite in rewrites or []
+        )
+        self.default = default
+
+    def resolve(self, values: Mapping[str, Optional[str]], fallback: Optional[str]) -> Optional[str]:
+        '''Return the field's value from tag values, the fallback or the default'''
+        for key in self.keys:
+            value = values.get(key)
+            if value:
+                for pattern, replacement in self.rewrites:
+                    value = pattern.sub(replacement, value)
+                return value
+        return fallback if fallback is not None else self.default
+
+
+def _make_memo_key(tag_keys: Tuple[str, ...]) -> Callable[[Mapping[str, str]], Hashable]:
+    '''Return a function returning the values of tag keys, as a memo key'''
+    # Building the key is most of the cost of a memo hit, so the usual single key is special cased.
+    if len(tag_keys) == 1:
+        (key,) = tag_keys
+        return lambda tags: tags.get(key)
+    return lambda tags: tuple([tags.get(key) for key in tag_keys])
+
+
+class TagPolicy:
+    '''Resolve entity fields from tags'''
+    def __init__(self, policy: Mapping[str, Mapping[str, Any]]):
+        self.rules = {field: FieldRule(**policy[field]) for field in Resolution._fields}
+        # Only the tags some rule reads matter, which keeps memo keys short and shared.
+        self.tag_keys = tuple(dict.fromkeys(key for rule in self.rules.values() for key in rule.keys))
+        self._memo_key = _make_memo_key(self.tag_keys)
+        self._resolutions: Dict[Tuple[Hashable, Optional[str], Optional[str]], Resolution] = {}
+
+    def _resolve_values(
+        self,
+        tags: Mapping[str, str],
+        system: Optional[str],
+        lifecycle: Optional[str]
+    ) -> Resolution:
+        '''Return entity fields for tags without memoizing'''
+        return Resolution(
+            self.rules['system'].resolve(tags, system),    # type: ignore[arg-type]
+            self.rules['owner'].resolve(tags, None),
+            self.rules['lifecycle'].resolve(tags, lifecycle)
+        )
+
+    def resolve(
+        self,
+        tags: Mapping[str, str],
+        system: Optional[str] = None,
+        lifecycle: Optional[str] = None
+    ) -> Resolution:
+        '''Return entity fields for tags, falling back to the given system and lifecycle'''
+        key = (self._memo_key(tags), system, lifecycle)
+        resolution = self._resolutions.get(key)
+        if resolution is None:
+            if len(self._resolutions) >= TAG_POLICY_CACHE_SIZE:
+                self._resolutions.clear()
+            resolution = self._resolutions[key] = self._resolve_values(tags, system, lifecycle)
+        return resolution
+
+
+POLICY = TagPolicy({**DEFAULT_TAG_POLICY, **TAG_POLICY})
@@ -0,0 +1,43 @@
+'''
+Bulk tag lookups
+
+Reading tags one resource at a time costs a call per resource. The Resource Groups Tagging API
+returns the tags of every tagged resource in an account and region, a hundred to a page, so a
+collector can build an index once and look resources up by ARN. Resources that have never been
+tagged are not returned, so a missing ARN means the resource has no tags.
+'''
+from typing import TYPE_CHECKING, Dict, List
+
+from common.util import aws
+
+if TYPE_CHECKING:
+    from mypy_boto3_resourcegroupstaggingapi import ResourceGroupsTaggingAPIClient
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+
+# The most resources GetResources returns in a page.
+TAG_INDEX_PAGE_SIZE = 100
+
+
+def get_tagging_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'ResourceGroupsTaggingAPIClient':
+    '''Return a Resource Groups Tagging API client with cross-account access'''
+    return aws.get_cross_account_client('resourcegroupstaggingapi', credentials, region_name)
+
+
+def get_tag_index(
+    client: 'ResourceGroupsTaggingAPIClient',
+    resource_types: List[str]
+) -> Dict[str, Dict[str, str]]:
+    '''Return the tags of the tagged resources of the given types, by ARN'''
+    index: Dict[str, Dict[str, str]] = {}
+    paginator = client.get_paginator('get_resources')
+    for page in paginator.paginate(
+        ResourceTypeFilters=resource_types,
+        PaginationConfig={'PageSize': TAG_INDEX_PAGE_SIZE}
+    ):
+        for mapping in page.get('ResourceTagMappingList', []):
+            index[mapping['ResourceARN']] = {tag['Key']: tag['Value'] for tag in mapping.get('Tags', [])}
+
+    return index
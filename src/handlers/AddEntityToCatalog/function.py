@@ -3,18 +3,34 @@
 import os
 import json
 import requests
+from functools import partial
+from hashlib import sha256
+from typing import Any, Dict, List, Optional
 
 from aws_lambda_powertools.logging import Logger
-from aws_lambda_powertools.utilities.typing import LambdaContext
-from aws_lambda_powertools.utilities.data_classes import (
-    event_source,
-    SQSEvent
+from aws_lambda_powertools.utilities.batch import (
+    BatchProcessor,
+    EventType,
+    process_partial_response
+)
+from aws_lambda_powertools.utilities.batch.types import PartialItemFailureResponse
+from aws_lambda_powertools.utilities.idempotency import (
+    DynamoDBPersistenceLayer,
+    IdempotencyConfig,
+    idempotent_function
 )
+from aws_lambda_powertools.utilities.idempotency.exceptions import IdempotencyAlreadyInProgressError
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 
 from common.model.entity import Entity
+from common.util import aws, catalog, claim_check, instrumentation, profiling, sweep
+from common.util.continuation import Deadline
+from common.util.envelope import unpack_entities
 from common.util.jwt import JwtAuth
 
 LOGGER = Logger(utc=True)
+PROCESSOR = BatchProcessor(event_type=EventType.SQS)
 
 CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
 
@@ -22,21 +38,58 @@ CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
 JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
 
+# Stop starting new entities when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+
+# Idempotency
+# Records share the collector state table and its TTL attribute.
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+IDEMPOTENCY_WINDOW_SECONDS = int(os.environ.get('IDEMPOTENCY_WINDOW_SECONDS', '900'))
+IDEMPOTENCY_KEY_PREFIX = 'idempotency#entity'
+# NOTE: The persistence layer takes its client when it is created so this one is not lazy.
+PERSISTENCE_STORE = DynamoDBPersistenceLayer(
+    table_name=STATE_TABLE_NAME,
+    key_attr='pk',
+    boto3_client=aws.get_client('dynamodb')
+)
+IDEMPOTENCY_CONFIG = IdempotencyConfig(
+    expires_after_seconds=IDEMPOTENCY_WINDOW_SECONDS,
+    use_local_cache=True
+)
+
 class AddEntityToCatalogError(Exception):
     '''Add Account to Catalog Error'''
     def __init__(self, account_id) -> None:
         super().__init__('Failed to add account to catalog: {}'.format(account_id))
 
 
+class AddEntitiesToCatalogError(Exception):
+    '''Add Entities to Catalog Error'''
+    def __init__(self, entity_refs: List[str]) -> None:
+        super().__init__('Failed to add entities to catalog: {}'.format(', '.join(entity_refs)))
+
+
+def _get_entity_ref(entity: Entity) -> str:
+    '''Return the catalog reference for an entity'''
+    return '{}:{}/{}'.format(
+        entity['kind'].lower(),
+        entity['metadata']['namespace'],
+        entity['metadata']['name']
+    )
+
+
 def _add_entity_to_catalog(entity: Entity, auth: JwtAuth) -> requests.Response:
     '''Add entity to catalog'''
-    r = requests.put(
+    r = catalog.request(
+        'PUT',
         '/'.join([
             CATALOG_ENDPOINT,
             entity['metadata']['namespace'],
             entity['kind'].lower(),
             entity['metadata']['name']
         ]),
+        catalog.ROUTE_PUT_ENTITY,
+        entity_ref=_get_entity_ref(entity),
         headers={
             'Content-Type': 'application/json'
         },
@@ -51,18 +104,84 @@ def _add_entity_to_catalog(entity: Entity, auth: JwtAuth) -> requests.Response:
     return r
 
 
+def _get_entity_version(entity: Entity) -> Dict[str, str]:
+    '''Return the entity reference and a hash of its content, less its sweep generation'''
+    annotations = {
+        key: value
+        for key, value in entity['metadata'].get('annotations', {}).items()
+        if key != sweep.SWEEP_ANNOTATION
+    }
+    content = {**entity, 'metadata': {**entity['metadata'], 'annotations': annotations}}
+    return {
+        'EntityRef': _get_entity_ref(entity),
+        'ContentHash': sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+    }
+
+
+@idempotent_function(
+    data_keyword_argument='entity_version',
+    config=IDEMPOTENCY_CONFIG,
+    persistence_store=PERSISTENCE_STORE,
+    key_prefix=IDEMPOTENCY_KEY_PREFIX
+)
+# entity_version is only read by the idempotency layer, as the key.
+def _put_entity(entity: Entity, entity_version: Dict[str, str]) -> Optional[str]:    # pylint: disable=unused-argument
+    '''Add an entity to the catalog once per version and idempotency window
+
+    Returns the sweep generation written, which duplicates get back from the idempotency record.
+    '''
+    _add_entity_to_catalog(entity, JWT)
+    return entity['metadata'].get('annotations', {}).get(sweep.SWEEP_ANNOTATION)
+
+
 def _main(entity: Entity) -> None:
     '''Publish account to catalog.'''
-    _add_entity_to_catalog(entity, JWT)
+    entity_version = _get_entity_version(entity)
+    written_sweep_id = _put_entity(entity, entity_version=entity_version)
+
+    # Overlapping sweeps share a version, so the catalog keeps the generation of whichever wrote it.
+    # Record that this sweep saw the entity too rather than write it again.
+    sweep_id = entity['metadata'].get('annotations', {}).get(sweep.SWEEP_ANNOTATION)
+    if sweep_id and sweep_id != written_sweep_id:
+        sweep.mark_seen(STATE_TABLE_NAME, entity_version['EntityRef'], sweep_id)
+
+
+def _process_record(record: SQSRecord, deadline: Deadline) -> None:
+    '''Add every entity in a record to the catalog, reporting failures per entity'''
+    entities = unpack_entities(claim_check.resolve(record.body))
+    failed_entity_refs = []
+    for i, entity in enumerate(entities):
+        # Leave the rest for the record's retry rather than run past the timeout and retry the batch.
+        if deadline.expired():
+            LOGGER.warning(
+                'Deadline reached; leaving entities for retry',
+                extra={'message_id': record.message_id, 'remaining': len(entities) - i}
+            )
+            failed_entity_refs += [_get_entity_ref(remaining) for remaining in entities[i:]]
+            break
+
+        try:
+            _main(entity)
+        except (AddEntityToCatalogError, IdempotencyAlreadyInProgressError) as e:
+            LOGGER.exception(e, extra={'entity_ref': _get_entity_ref(entity)})
+            failed_entity_refs.append(_get_entity_ref(entity))
+
+    # Fail the record so it is retried; entities that succeeded are skipped by the idempotency layer.
+    if failed_entity_refs:
+        raise AddEntitiesToCatalogError(failed_entity_refs)
 
 
 @LOGGER.inject_lambda_context
-@event_source(data_class=SQSEvent)
-def handler(event: SQSEvent, _: LambdaContext) -> None:
+@profiling.profile_handler
+@instrumentation.emit_metrics
+def handler(event: Dict[str, Any], context: LambdaContext) -> PartialItemFailureResponse:
     '''Event handler'''
-    LOGGER.debug('Event', extra={"message_object": event._data})
-    for record in event.records:
-        entity = Entity(**json.loads(record.body))
-        _main(entity)
-
-    return
+    LOGGER.debug('Event', extra={"message_object": event})
+    IDEMPOTENCY_CONFIG.register_lambda_context(context)
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
+    return process_partial_response(
+        event=event,
+        record_handler=partial(_process_record, deadline=deadline),
+        processor=PROCESSOR,
+        context=context
+    )
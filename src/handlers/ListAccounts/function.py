@@ -1,9 +1,10 @@
 
 '''List AWS accounts'''
 import os
-import boto3
 import json
-from typing import TYPE_CHECKING, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 from aws_lambda_powertools.logging import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
@@ -13,47 +14,129 @@ from aws_lambda_powertools.utilities.data_classes import (
 )
 
 if TYPE_CHECKING:
+    from mypy_boto3_organizations.type_defs import TagTypeDef
     from mypy_boto3_sns.type_defs import PublishResponseTypeDef
 
 from common.model.account import AccountType, AccountTypeWithTags
 from common.util import JSONDateTimeEncoder
+from common.util import aws, claim_check, instrumentation, profiling, schedule, sweep
 
 LOGGER = Logger(utc=True)
 
-ORG_CLIENT = boto3.client('organizations')
-SNS_CLIENT = boto3.client('sns')
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN', 'UNSET')
+# Concurrent tag lookups. Organizations throttles well below Lambda's concurrency.
+ORGANIZATIONS_CONCURRENCY = int(os.environ.get('ORGANIZATIONS_CONCURRENCY', '4'))
+# Tags accounts take from the nearest organizational unit, or root, that has them.
+INHERITED_TAG_KEYS = os.environ.get('INHERITED_TAG_KEYS', 'org:system,org:owner').split(',')
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTORS = os.environ.get(
+    'SWEEP_COLLECTORS',
+    'ProcessAccount,ProcessEcsClusters,ProcessEcsServices,ProcessVpcs,ProcessS3Buckets,ProcessLambdaFunctions,'
+    'ProcessEc2Instances'
+).split(',')
+
+# Scheduling
+SCHEDULE_MODE = os.environ.get('SCHEDULE_MODE', schedule.SCHEDULE_MODE_BURST)
+SCHEDULE_ACCOUNTS_PER_MINUTE = float(os.environ.get('SCHEDULE_ACCOUNTS_PER_MINUTE', '10'))
+SWEEP_INTERVAL_SECONDS = int(os.environ.get('SWEEP_INTERVAL_SECONDS', '7200'))
+
+# Scan tiers
+TIER_TAG_KEY = os.environ.get('TIER_TAG_KEY', 'org:scan-tier')
+DEFAULT_TIER = os.environ.get('DEFAULT_TIER', 'default')
+SUSPENDED_TIER = 'suspended'
+# Seconds between scans per tier. Tiers not listed are scanned every sweep.
+TIER_INTERVALS: Dict[str, int] = json.loads(
+    os.environ.get('TIER_INTERVALS', '{"suspended": 604800}')
+)
+SCAN_INDEX_KEY = 'scan-index'
+
+
+def _list_tags(resource_ids: List[str]) -> Dict[str, List['TagTypeDef']]:
+    '''Return the tags of Organizations resources, by ID'''
+    # Clients aren't created thread safely so take it before starting the threads.
+    paginator = aws.get_client('organizations').get_paginator('list_tags_for_resource')
+
+    def _get_tags(resource_id: str) -> List['TagTypeDef']:
+        return [tag for page in paginator.paginate(ResourceId=resource_id) for tag in page.get('Tags', [])]
+
+    with ThreadPoolExecutor(max_workers=ORGANIZATIONS_CONCURRENCY) as executor:
+        return dict(zip(resource_ids, executor.map(_get_tags, resource_ids)))
 
 
 def _get_account_tags(accounts: List[AccountType]) -> List[AccountTypeWithTags]:
     '''Get tags for accounts'''
-    accounts_with_tags = []
-    for account in accounts:
-        tags = ORG_CLIENT.list_tags_for_resource(
-            # Haven't seen a situation where Id is not present
-            ResourceId=account.get('Id', '')
-        ).get('Tags')
-        account_with_tags = {**account, 'Tags': tags}
-        accounts_with_tags.append(account_with_tags)
-    return accounts_with_tags
+    # Haven't seen a situation where Id is not present
+    tags = _list_tags([account.get('Id', '') for account in accounts])
+    return [
+        AccountTypeWithTags({**account, 'Tags': tags[account.get('Id', '')]})
+        for account in accounts
+    ]
 
 
-def _list_all_accounts(NextToken: Optional[str] = None) -> List[AccountType]:
+def _list_all_accounts() -> List[AccountType]:
     '''List AWS accounts'''
-    accounts = []
-    while True:
-        response = ORG_CLIENT.list_accounts(
-            **{ 'NextToken': NextToken } if NextToken else {}
-        )
-        if 'Accounts' in response:
-            accounts += response['Accounts']
+    paginator = aws.get_client('organizations').get_paginator('list_accounts')
+    return [account for page in paginator.paginate() for account in page.get('Accounts', [])]
 
-        if 'NextToken' in response:
-            next_page = _list_all_accounts(NextToken=response['NextToken'])
-            response['Accounts'] += next_page
-        else:
-            break
-    return accounts
+
+def _list_children(parent_id: str, child_type: str) -> List[str]:
+    '''Return the IDs of a root or organizational unit's children of a type'''
+    paginator = aws.get_client('organizations').get_paginator('list_children')
+    return [
+        child['Id']
+        for page in paginator.paginate(ParentId=parent_id, ChildType=child_type)
+        for child in page.get('Children', [])
+    ]
+
+
+def _get_org_tree() -> Tuple[Dict[str, str], List[str]]:
+    '''Return the parent of every organizational unit and account, and the roots and OUs'''
+    parents: Dict[str, str] = {}
+    containers = [root['Id'] for root in aws.get_client('organizations').list_roots().get('Roots', [])]
+    # The tree is walked once per run, costing a couple of calls per OU rather than per account.
+    pending = list(containers)
+    while pending:
+        parent_id = pending.pop()
+        for ou_id in _list_children(parent_id, 'ORGANIZATIONAL_UNIT'):
+            parents[ou_id] = parent_id
+            containers.append(ou_id)
+            pending.append(ou_id)
+        for account_id in _list_children(parent_id, 'ACCOUNT'):
+            parents[account_id] = parent_id
+
+    return parents, containers
+
+
+def _get_inherited_tags(
+    account_id: str,
+    parents: Dict[str, str],
+    container_tags: Dict[str, List['TagTypeDef']]
+) -> List[Dict[str, str]]:
+    '''Return the tags an account inherits, each from the nearest OU or root that has it'''
+    inherited: Dict[str, str] = {}
+    parent_id = parents.get(account_id)
+    while parent_id is not None:
+        for tag in container_tags.get(parent_id, []):
+            if tag['Key'] in INHERITED_TAG_KEYS:
+                inherited.setdefault(tag['Key'], tag['Value'])
+        parent_id = parents.get(parent_id)
+
+    return [{'Key': key, 'Value': value} for key, value in inherited.items()]
+
+
+def _add_inherited_tags(accounts: List[AccountTypeWithTags]) -> List[AccountTypeWithTags]:
+    '''Attach the tags each account inherits from its organizational units'''
+    parents, containers = _get_org_tree()
+    container_tags = _list_tags(containers)
+    return [
+        AccountTypeWithTags({
+            **account,
+            'InheritedTags': _get_inherited_tags(account.get('Id', ''), parents, container_tags)
+        })
+        for account in accounts
+    ]
 
 
 def _publish_accounts(accounts: List[AccountTypeWithTags]) -> List['PublishResponseTypeDef']:
@@ -61,24 +144,134 @@ def _publish_accounts(accounts: List[AccountTypeWithTags]) -> List['PublishRespo
     responses = []
     for account in accounts:
         LOGGER.debug('Publishing {}'.format(account.get('Id')), extra={"message_object": account})
-        response = SNS_CLIENT.publish(
+        response = aws.get_client('sns').publish(
             TopicArn = SNS_TOPIC_ARN,
             Subject = 'AWS Account',
-            Message = json.dumps(account, cls=JSONDateTimeEncoder)
+            Message = claim_check.offload(json.dumps(account, cls=JSONDateTimeEncoder))
         )
         LOGGER.debug('SNS Response for {}'.format(account.get('Id')), extra={"message_object": response})
         responses.append(response)
     return responses
 
 
+def _get_account_tier(account: AccountTypeWithTags) -> str:
+    '''Return the scan tier of an account'''
+    if account.get('Status') == 'SUSPENDED':
+        return SUSPENDED_TIER
+
+    for tag in account.get('Tags', []):
+        if tag['Key'] == TIER_TAG_KEY:
+            return tag['Value']
+
+    return DEFAULT_TIER
+
+
+def _get_scan_index() -> Dict[str, int]:
+    '''Return when each account was last scanned'''
+    item = aws.get_client('dynamodb').get_item(
+        TableName=STATE_TABLE_NAME,
+        Key={'pk': {'S': SCAN_INDEX_KEY}}
+    ).get('Item', {})
+
+    return {
+        account_id: int(value['N'])
+        for account_id, value in item.get('LastScanned', {}).get('M', {}).items()
+    }
+
+
+def _put_scan_index(scan_index: Dict[str, int]) -> None:
+    '''Store when each account was last scanned'''
+    aws.get_client('dynamodb').put_item(
+        TableName=STATE_TABLE_NAME,
+        Item={
+            'pk': {'S': SCAN_INDEX_KEY},
+            'LastScanned': {
+                'M': {account_id: {'N': str(scanned)} for account_id, scanned in scan_index.items()}
+            }
+        }
+    )
+
+
+def _get_due_accounts(
+    accounts: List[AccountTypeWithTags],
+    scan_index: Dict[str, int]
+) -> List[AccountTypeWithTags]:
+    '''Return accounts whose tier interval has elapsed since their last scan'''
+    now = int(time())
+    due_accounts = []
+    for account in accounts:
+        tier = _get_account_tier(account)
+        interval = TIER_INTERVALS.get(tier, 0)
+        last_scanned = scan_index.get(account.get('Id', ''), 0)
+        # Runs only happen once per sweep interval so allow for a run landing just short of due.
+        if now - last_scanned + SWEEP_INTERVAL_SECONDS // 2 >= interval:
+            due_accounts.append(account)
+        else:
+            LOGGER.debug('Account not due for scan', extra={'account_id': account.get('Id'), 'tier': tier})
+
+    return due_accounts
+
+
+def _start_sweep(
+    accounts: List[AccountTypeWithTags],
+    org_accounts: List[AccountTypeWithTags]
+) -> List[AccountTypeWithTags]:
+    '''Start a new sweep and stamp its generation onto the accounts'''
+    sweep_id = sweep.new_sweep_id()
+    sweep.start_sweep(
+        STATE_TABLE_NAME,
+        sweep_id,
+        [account.get('Id', '') for account in accounts],
+        SWEEP_COLLECTORS,
+        [account.get('Id', '') for account in org_accounts]
+    )
+    return [AccountTypeWithTags({**account, 'SweepId': sweep_id}) for account in accounts]
+
+
+def _schedule_accounts(accounts: List[AccountTypeWithTags]) -> List[AccountTypeWithTags]:
+    '''Spread account processing across the sweep interval'''
+    if SCHEDULE_MODE != schedule.SCHEDULE_MODE_JITTERED:
+        return accounts
+
+    offsets = schedule.get_schedule_offsets(
+        [account.get('Id', '') for account in accounts],
+        SCHEDULE_ACCOUNTS_PER_MINUTE,
+        SWEEP_INTERVAL_SECONDS
+    )
+    now = int(time())
+    return [
+        AccountTypeWithTags({**account, 'NotBefore': now + offsets[account.get('Id', '')]})
+        for account in accounts
+    ]
+
+
 def _main() -> None:
     '''List AWS accounts and publish to SNS'''
     accounts = _list_all_accounts()
-    accounts_with_tags = _get_account_tags(accounts)
-    _publish_accounts(accounts_with_tags)
+    accounts_with_tags = _add_inherited_tags(_get_account_tags(accounts))
+
+    scan_index = _get_scan_index()
+    due_accounts = _get_due_accounts(accounts_with_tags, scan_index)
+    LOGGER.info('Accounts due for scan', extra={'due': len(due_accounts), 'total': len(accounts_with_tags)})
+    if not due_accounts:
+        return
+
+    accounts_in_sweep = _start_sweep(due_accounts, accounts_with_tags)
+    _publish_accounts(_schedule_accounts(accounts_in_sweep))
+
+    now = int(time())
+    org_account_ids = {account.get('Id', '') for account in accounts_with_tags}
+    # Drop accounts that have left the organization so the index stays small.
+    scan_index = {
+        account_id: scanned for account_id, scanned in scan_index.items() if account_id in org_account_ids
+    }
+    scan_index.update({account.get('Id', ''): now for account in due_accounts})
+    _put_scan_index(scan_index)
 
 
 @LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
 @event_source(data_class=EventBridgeEvent)
 def handler(event: EventBridgeEvent, context: LambdaContext) -> None:
     '''Event handler'''
@@ -1,10 +1,8 @@
 '''process account entity'''
 import os
 import json
-import requests
 from typing import TYPE_CHECKING
 
-import boto3
 from aws_lambda_powertools.logging import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools.utilities.data_classes import (
@@ -15,19 +13,28 @@ from aws_lambda_powertools.utilities.data_classes import (
 if TYPE_CHECKING:
     from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
 
-from common.model.account import AccountTypeWithTags
+from common.model.account import AccountTypeWithTags, Continuation
 from common.model.entity import Entity, EntityMeta, EntityMetaLinks, EntitySpec
+from common.util import catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy
+from common.util.continuation import send_continuation
 from common.util.jwt import JwtAuth
 
 LOGGER = Logger(utc=True)
-SQS_CLIENT = boto3.client('sqs')
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+# Defer accounts while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
 
 CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
 CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
 JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
 
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessAccount'
+
 
 class GetSystemOwnerError(Exception):
     '''Get System Owner Error'''
@@ -37,27 +44,25 @@ class GetSystemOwnerError(Exception):
 
 def _send_queue_message(entity: Entity) -> 'SendMessageResultTypeDef':
     '''Send message to SQS'''
-    sqs = boto3.client('sqs')
-    r = sqs.send_message(
-        QueueUrl=SQS_QUEUE_URL,
-        MessageBody=json.dumps(entity)
-    )
-    return r
+    return sqs.send_message(SQS_QUEUE_URL, json.dumps(entity))
 
 
 def _get_entity_data(account_info: AccountTypeWithTags, auth: JwtAuth) -> Entity:
     '''Return entity data'''
     account_id = account_info.get('Id', '')
 
-    account_tags = {tag['Key']: tag['Value'] for tag in account_info.get('Tags', [])}
-    system = account_tags.get('org:system', 'UNKNOWN')
-    owner = _get_system_owner(system, auth)
+    resolution = tag_policy.POLICY.resolve(
+        tag_policy.get_account_tag_values(account_info),
+        lifecycle=account_info.get('Status', '')
+    )
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
 
     entity_spec = EntitySpec({
         'owner': owner,
         'type': 'cloud-account',
         'system': system,
-        'lifecycle': account_info.get('Status', '')
+        'lifecycle': resolution.lifecycle
     })
 
     entity_links = EntityMetaLinks([
@@ -93,15 +98,19 @@ def _get_entity_data(account_info: AccountTypeWithTags, auth: JwtAuth) -> Entity
     return entity
 
 
+@catalog.cache_system_owner
 def _get_system_owner(system: str, auth: JwtAuth) -> str:
     '''Return system owner'''
-    r = requests.get(
+    r = catalog.request(
+        'GET',
         '/'.join([
             CATALOG_ENDPOINT,
             'default',
             'system',
             system
         ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
         auth=auth
     )
 
@@ -114,17 +123,29 @@ def _get_system_owner(system: str, auth: JwtAuth) -> str:
 
 def _main(account_info: AccountTypeWithTags) -> None:
     '''Publish account to catalog.'''
-    entity = _get_entity_data(account_info, JWT)
+    sweep_id = account_info.get('SweepId')
+    entity = sweep.stamp_entity(_get_entity_data(account_info, JWT), sweep_id)
     _send_queue_message(entity)
 
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_info.get('Id', ''))
+
 
 @LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
 @event_source(data_class=SQSEvent)
 def handler(event: SQSEvent, _: LambdaContext) -> None:
     '''Event handler'''
     LOGGER.debug('Event', extra={"message_object": event._data})
     for record in event.records:
-        account_info = AccountTypeWithTags(**json.loads(record.body))
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+            # Counted like the collectors' deferrals, so the account is dropped at MAX_DEFERRALS.
+            send_continuation(account_info, Continuation(), SOURCE_QUEUE_URL, BACKPRESSURE_DELAY_SECONDS)
+            continue
         _main(account_info)
 
     return
@@ -0,0 +1,268 @@
+'''Process EC2 Instances'''
+import os
+import json
+from typing import TYPE_CHECKING, Dict, List
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    SQSEvent
+)
+
+from common.model.account import AccountTypeWithTags
+from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy
+from common.util.continuation import Deadline, get_remaining_regions, make_continuation, send_continuation
+from common.util.envelope import pack_entities
+from common.util.jwt import JwtAuth
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_ec2.type_defs import FilterTypeDef, InstanceTypeDef
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+    from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
+
+LOGGER = Logger(utc=True)
+
+# AWS
+CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
+SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+COLLECTOR_REGIONS = os.environ.get('COLLECTOR_REGIONS', 'us-east-1').split(',')
+# DescribeInstances returns at most 1000 instances a page.
+INSTANCE_PAGE_SIZE = int(os.environ.get('INSTANCE_PAGE_SIZE', '1000'))
+# Only instances in these states are collected. Terminated instances linger for about an hour.
+INSTANCE_STATES = os.environ.get('INSTANCE_STATES', 'pending,running,stopping,stopped').split(',')
+# Tag key to the values an instance must have one of to be collected. No values means any value.
+INSTANCE_TAG_FILTERS: Dict[str, List[str]] = json.loads(os.environ.get('INSTANCE_TAG_FILTERS', '{}'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new pages when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
+
+# Catalog
+CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
+CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
+JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessEc2Instances'
+
+
+class GetSystemOwnerError(Exception):
+    '''Get System Owner Error'''
+    def __init__(self, system) -> None:
+        super().__init__('Failed to get owner for system: {}'.format(system))
+
+
+def _get_cross_account_credentials(
+    account_id: str,
+    role_name: str
+) -> 'CredentialsTypeDef':
+    '''Return the IAM role for cross-account access'''
+    role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
+    try:
+        response = aws.get_client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='ProcessEc2InstancesResourcecollector'
+        )
+    except Exception as e:
+        LOGGER.exception(e)
+        raise e
+
+    return response['Credentials']
+
+
+def _get_cross_account_ec2_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'EC2Client':
+    '''Return an EC2 client with cross-account access'''
+    return aws.get_cross_account_client('ec2', credentials, region_name)
+
+
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
+
+
+def _get_instance_filters() -> 'List[FilterTypeDef]':
+    '''Return the DescribeInstances filters for the instances to collect
+
+    Filtering server side keeps uncollected instances out of the pages altogether.
+    '''
+    filters: 'List[FilterTypeDef]' = [{'Name': 'instance-state-name', 'Values': INSTANCE_STATES}]
+    for key, values in INSTANCE_TAG_FILTERS.items():
+        if values:
+            filters.append({'Name': 'tag:{}'.format(key), 'Values': values})
+        else:
+            filters.append({'Name': 'tag-key', 'Values': [key]})
+
+    return filters
+
+
+def _create_ec2_instance_entity(
+    instance: 'InstanceTypeDef',
+    account_id: str,
+    region: str,
+    account_system: str,
+    auth: JwtAuth
+) -> Entity:
+    '''Create an entity for an EC2 instance'''
+    entity_type = 'ec2-instance'
+    instance_tags = tag_policy.get_tag_values(instance.get('Tags', []))
+    # Untagged instances belong to their account's system.
+    resolution = tag_policy.POLICY.resolve(
+        instance_tags,
+        system=account_system,
+        lifecycle=instance.get('State', {}).get('Name', 'UNKNOWN')
+    )
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
+
+    instance_id = instance.get('InstanceId', '')
+
+    entity_spec = EntitySpec({
+        'system': system,
+        'owner': owner,
+        'type': entity_type,
+        'lifecycle': resolution.lifecycle
+    })
+    if instance.get('VpcId'):
+        entity_spec['dependsOn'] = ['resource:default/ec2-vpc-{}'.format(instance['VpcId'])]
+
+    # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
+    # the default namespace. eventually we should figure out how to handle this.
+    entity_meta = EntityMeta({
+        'namespace': 'default',
+        'name': '{}-{}'.format(entity_type, instance_id),
+        'title': instance_tags.get('Name') or instance_id,
+        'description': 'EC2 instance {} in account {}'.format(instance_id, account_id),
+        'annotations': {
+            "io.serverlessops/cloud-provider": "aws",
+            'aws.amazon.com/arn': 'arn:aws:ec2:{}:{}:instance/{}'.format(region, account_id, instance_id),
+            'aws.amazon.com/account-id': account_id,
+            'aws.amazon.com/region': region,
+            'aws.amazon.com/instance-id': instance_id,
+            'aws.amazon.com/instance-type': instance.get('InstanceType', 'UNKNOWN'),
+            'aws.amazon.com/image-id': instance.get('ImageId', 'UNKNOWN'),
+            'aws.amazon.com/availability-zone': instance.get('Placement', {}).get('AvailabilityZone', 'UNKNOWN'),
+            'aws.amazon.com/vpc-id': instance.get('VpcId', 'UNKNOWN'),
+        }
+    })
+
+    entity = Entity({
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': entity_meta,
+        'spec': entity_spec
+    })
+    return entity
+
+
+@catalog.cache_system_owner
+def _get_system_owner(system: str, auth: JwtAuth) -> str:
+    '''Return system owner'''
+    r = catalog.request(
+        'GET',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            'default',
+            'system',
+            system
+        ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to get system owner', extra={'response': r.text})
+        raise GetSystemOwnerError(system)
+
+    return r.json().get('spec', {}).get('owner', 'UNKNOWN')
+
+
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
+    '''Publish EC2 instances to catalog.
+
+    Instances are sent a page at a time so only one page is held in memory however many an account
+    has, and the page cursor is saved in a continuation at the deadline.
+    '''
+    system = tag_policy.POLICY.resolve(tag_policy.get_account_tag_values(account_info)).system
+    account_id = account_info.get('Id', '')
+    sweep_id = account_info.get('SweepId')
+    credentials = _get_cross_account_credentials(
+        account_id,
+        CROSS_ACCOUNT_IAM_ROLE_NAME
+    )
+    filters = _get_instance_filters()
+
+    # Resume where a previous invocation stopped, if anywhere.
+    regions, next_token = get_remaining_regions(COLLECTOR_REGIONS, account_info.get('Continuation'))
+    pages = 0
+    for region in regions:
+        ec2_client = _get_cross_account_ec2_client(credentials, region)
+        while True:
+            # Always make progress on at least one page per invocation.
+            if pages > 0 and deadline.expired():
+                send_continuation(account_info, make_continuation(region, next_token), SOURCE_QUEUE_URL)
+                return
+
+            if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+                send_continuation(
+                    account_info,
+                    make_continuation(region, next_token),
+                    SOURCE_QUEUE_URL,
+                    BACKPRESSURE_DELAY_SECONDS
+                )
+                return
+
+            instances = ec2_client.describe_instances(
+                Filters=filters,
+                MaxResults=INSTANCE_PAGE_SIZE,
+                **{'NextToken': next_token} if next_token else {}
+            )
+            entities = [
+                sweep.stamp_entity(
+                    _create_ec2_instance_entity(instance, account_id, region, system, JWT),
+                    sweep_id
+                )
+                for reservation in instances['Reservations']
+                for instance in reservation.get('Instances', [])
+            ]
+            if entities:
+                _send_queue_messages(entities)
+
+            pages += 1
+            next_token = instances.get('NextToken')
+            if not next_token:
+                break
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
+
+
+@LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
+@event_source(data_class=SQSEvent)
+def handler(event: SQSEvent, context: LambdaContext) -> None:
+    '''Event handler'''
+    LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
+    for record in event.records:
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
+
+    return
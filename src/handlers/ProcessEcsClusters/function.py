@@ -2,7 +2,6 @@
 '''Process ECS Clusters'''
 import os
 import json
-import requests
 from typing import TYPE_CHECKING, List
 
 from aws_lambda_powertools.logging import Logger
@@ -11,10 +10,12 @@ from aws_lambda_powertools.utilities.data_classes import (
     event_source,
     SQSEvent
 )
-import boto3
 
 from common.model.account import AccountTypeWithTags
 from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy
+from common.util.continuation import Deadline, get_remaining_regions, make_continuation, send_continuation
+from common.util.envelope import pack_entities
 from common.util.jwt import JwtAuth
 
 if TYPE_CHECKING:
@@ -26,9 +27,17 @@ if TYPE_CHECKING:
 LOGGER = Logger(utc=True)
 
 # AWS
-STS_CLIENT = boto3.client('sts')
 CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+COLLECTOR_REGIONS = os.environ.get('COLLECTOR_REGIONS', 'us-east-1').split(',')
+CLUSTER_PAGE_SIZE = int(os.environ.get('CLUSTER_PAGE_SIZE', '100'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new pages when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
 
 # Catalog
 CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
@@ -36,6 +45,10 @@ CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
 JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
 
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessEcsClusters'
+
 
 class GetSystemOwnerError(Exception):
     '''Get System Owner Error'''
@@ -50,7 +63,7 @@ def _get_cross_account_credentials(
     '''Return the IAM role for cross-account access'''
     role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
     try:
-        response = STS_CLIENT.assume_role(
+        response = aws.get_client('sts').assume_role(
             RoleArn=role_arn,
             RoleSessionName='ListEcsClustersResourcecollector'
         )
@@ -62,32 +75,19 @@ def _get_cross_account_credentials(
 
 
 def _get_cross_account_ecs_client(
-    account_id: str,
-    role_name: str
+    credentials: 'CredentialsTypeDef',
+    region_name: str
 ) -> 'ECSClient':
     '''Return an ECS client with cross-account access'''
-    credentials = _get_cross_account_credentials(
-        account_id,
-        role_name
-    )
-    client = boto3.client(
-        'ecs',
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken']
-    )
+    return aws.get_cross_account_client('ecs', credentials, region_name)
 
-    return client
 
-
-def _send_queue_message(entity: Entity) -> 'SendMessageResultTypeDef':
-    '''Send message to SQS'''
-    sqs = boto3.client('sqs')
-    r = sqs.send_message(
-        QueueUrl=SQS_QUEUE_URL,
-        MessageBody=json.dumps(entity)
-    )
-    return r
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
 
 
 def _create_ecs_cluster_entity(
@@ -96,11 +96,12 @@ def _create_ecs_cluster_entity(
     auth: JwtAuth
 ) -> Entity:
     '''Create an entity for an ECS cluster'''
-    # Type says key and value are not required which is interesting. Jumping through hoops to
-    # make mypy happy
-    tags = {tag.get('key'): tag.get('value', 'NO_VALUE') for tag in cluster_tags }
-    system = tags.get('org:system', 'UNKNOWN')
-    owner = _get_system_owner(system, auth)
+    resolution = tag_policy.POLICY.resolve(
+        tag_policy.get_tag_values(cluster_tags),
+        lifecycle=cluster.get('status', 'UNKNOWN')
+    )
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
 
     region, account_id = cluster.get('clusterArn', '').split(':')[3:5]
     entity_type = 'ecs-cluster'
@@ -109,7 +110,7 @@ def _create_ecs_cluster_entity(
         'system': system,
         'owner': owner,
         'type': entity_type,
-        'lifecycle': cluster.get('status', 'UNKNOWN')
+        'lifecycle': resolution.lifecycle
     })
 
     # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
@@ -137,15 +138,19 @@ def _create_ecs_cluster_entity(
     return entity
 
 
+@catalog.cache_system_owner
 def _get_system_owner(system: str, auth: JwtAuth) -> str:
     '''Return system owner'''
-    r = requests.get(
+    r = catalog.request(
+        'GET',
         '/'.join([
             CATALOG_ENDPOINT,
             'default',
             'system',
             system
         ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
         auth=auth
     )
 
@@ -156,36 +161,80 @@ def _get_system_owner(system: str, auth: JwtAuth) -> str:
     return r.json().get('spec', {}).get('owner', 'UNKNOWN')
 
 
-def _main(account_info: AccountTypeWithTags) -> None:
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
     '''Publish account to catalog.'''
-    ecs_client = _get_cross_account_ecs_client(
-        account_info.get('Id', ''),
+    account_id = account_info.get('Id', '')
+    sweep_id = account_info.get('SweepId')
+    credentials = _get_cross_account_credentials(
+        account_id,
         CROSS_ACCOUNT_IAM_ROLE_NAME
     )
 
-    clusters_list = ecs_client.list_clusters()
-    clusters = ecs_client.describe_clusters(
-        clusters=clusters_list['clusterArns']
-    )
-
-    for cluster in clusters['clusters']:
-        # Type says ARN not requited. Guess there is some corner case where it may not exist.
-        if cluster.get('clusterArn'):
-            cluster_tags = ecs_client.list_tags_for_resource(
-                #
-                resourceArn=cluster.get('clusterArn', '')
-            ).get('tags', [])
-            entity = _create_ecs_cluster_entity(cluster, cluster_tags, JWT)
-            _send_queue_message(entity)
+    # Resume where a previous invocation stopped, if anywhere.
+    regions, next_token = get_remaining_regions(COLLECTOR_REGIONS, account_info.get('Continuation'))
+    pages = 0
+    for region in regions:
+        ecs_client = _get_cross_account_ecs_client(credentials, region)
+        while True:
+            # Always make progress on at least one page per invocation.
+            if pages > 0 and deadline.expired():
+                send_continuation(account_info, make_continuation(region, next_token), SOURCE_QUEUE_URL)
+                return
+
+            if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+                send_continuation(
+                    account_info,
+                    make_continuation(region, next_token),
+                    SOURCE_QUEUE_URL,
+                    BACKPRESSURE_DELAY_SECONDS
+                )
+                return
+
+            clusters_list = ecs_client.list_clusters(
+                maxResults=CLUSTER_PAGE_SIZE,
+                **{'nextToken': next_token} if next_token else {}
+            )
+            # An empty list would describe the default cluster.
+            if clusters_list['clusterArns']:
+                # Tags come back with the clusters rather than one call per cluster.
+                clusters = ecs_client.describe_clusters(
+                    clusters=clusters_list['clusterArns'],
+                    include=['TAGS']
+                )
+
+                entities = []
+                for cluster in clusters['clusters']:
+                    # Type says ARN not requited. Guess there is some corner case where it may not exist.
+                    if cluster.get('clusterArn'):
+                        entities.append(
+                            sweep.stamp_entity(
+                                _create_ecs_cluster_entity(cluster, cluster.get('tags', []), JWT),
+                                sweep_id
+                            )
+                        )
+                _send_queue_messages(entities)
+
+            pages += 1
+            next_token = clusters_list.get('nextToken')
+            if not next_token:
+                break
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
 
 
 @LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
 @event_source(data_class=SQSEvent)
-def handler(event: SQSEvent, _: LambdaContext) -> None:
+def handler(event: SQSEvent, context: LambdaContext) -> None:
     '''Event handler'''
     LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
     for record in event.records:
-        account_info = AccountTypeWithTags(**json.loads(record.body))
-        _main(account_info)
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
 
     return
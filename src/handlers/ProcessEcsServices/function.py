@@ -0,0 +1,518 @@
+'''Process ECS Services'''
+import os
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, TypedDict
+
+from botocore.config import Config
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    SQSEvent
+)
+
+from common.model.account import AccountTypeWithTags, Continuation
+from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy
+from common.util.continuation import Deadline, get_remaining_regions, make_continuation, send_continuation
+from common.util.envelope import pack_entities
+from common.util.jwt import JwtAuth
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_ecs import ECSClient
+    from mypy_boto3_ecs.type_defs import ListServicesRequestTypeDef, ServiceTypeDef
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+    from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
+
+LOGGER = Logger(utc=True)
+
+# AWS
+CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
+SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+COLLECTOR_REGIONS = os.environ.get('COLLECTOR_REGIONS', 'us-east-1').split(',')
+SERVICE_PAGE_SIZE = int(os.environ.get('SERVICE_PAGE_SIZE', '100'))
+# Threads describing a page of services and their task definitions.
+ECS_SERVICES_CONCURRENCY = int(os.environ.get('ECS_SERVICES_CONCURRENCY', '8'))
+# Clusters of a region collected at once.
+ECS_CLUSTER_CONCURRENCY = int(os.environ.get('ECS_CLUSTER_CONCURRENCY', '4'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new pages when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
+
+# Task definitions whose images are kept across invocations.
+TASK_DEFINITION_CACHE_SIZE = int(os.environ.get('TASK_DEFINITION_CACHE_SIZE', '1000'))
+
+# DescribeServices takes at most this many services.
+DESCRIBE_SERVICES_BATCH_SIZE = 10
+# A DescribeSubnets filter takes at most this many values.
+DESCRIBE_SUBNETS_BATCH_SIZE = 200
+
+# Catalog
+CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
+CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
+JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessEcsServices'
+
+# Task definition ARN to its container images. A revision never changes so these are kept across
+# invocations, up to TASK_DEFINITION_CACHE_SIZE.
+_TASK_DEFINITION_IMAGES: Dict[str, List[str]] = {}
+# Held while describing task definitions so clusters collected at once don't describe the same one.
+_TASK_DEFINITION_LOCK = Lock()
+
+
+class ClusterProgress(TypedDict):
+    '''Where a cluster's collection stopped, if it did not finish, and how long to wait to resume it'''
+    Continuation: Optional[Continuation]
+    DelaySeconds: int
+
+
+class GetSystemOwnerError(Exception):
+    '''Get System Owner Error'''
+    def __init__(self, system) -> None:
+        super().__init__('Failed to get owner for system: {}'.format(system))
+
+
+def _get_cross_account_credentials(
+    account_id: str,
+    role_name: str
+) -> 'CredentialsTypeDef':
+    '''Return the IAM role for cross-account access'''
+    role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
+    try:
+        response = aws.get_client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='ProcessEcsServicesResourcecollector'
+        )
+    except Exception as e:
+        LOGGER.exception(e)
+        raise e
+
+    return response['Credentials']
+
+
+def _get_cross_account_ecs_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'ECSClient':
+    '''Return an ECS client with cross-account access'''
+    # Size the connection pool so concurrent clusters and describes don't wait on each other for a
+    # connection.
+    return aws.get_cross_account_client(
+        'ecs',
+        credentials,
+        region_name,
+        Config(max_pool_connections=ECS_SERVICES_CONCURRENCY + ECS_CLUSTER_CONCURRENCY)
+    )
+
+
+def _get_cross_account_ec2_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'EC2Client':
+    '''Return an EC2 client with cross-account access'''
+    return aws.get_cross_account_client('ec2', credentials, region_name)
+
+
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
+
+
+def _describe_services_page(
+    ecs_client: 'ECSClient',
+    cluster_arn: str,
+    next_token: Optional[str],
+    executor: ThreadPoolExecutor
+) -> 'Tuple[List[ServiceTypeDef], Optional[str]]':
+    '''Return a page of a cluster's services with their tags, and the token for the next page'''
+    request: 'ListServicesRequestTypeDef' = {'cluster': cluster_arn, 'maxResults': SERVICE_PAGE_SIZE}
+    if next_token:
+        request['nextToken'] = next_token
+    page = ecs_client.list_services(**request)
+    service_arns = page['serviceArns']
+
+    # Tags come back with the services rather than one call per service.
+    batches = executor.map(
+        lambda i: ecs_client.describe_services(
+            cluster=cluster_arn,
+            services=service_arns[i:i + DESCRIBE_SERVICES_BATCH_SIZE],
+            include=['TAGS']
+        )['services'],
+        range(0, len(service_arns), DESCRIBE_SERVICES_BATCH_SIZE)
+    )
+    services = [
+        service
+        for batch in batches
+        for service in batch
+        # Type says ARN not required. Guess there is some corner case where it may not exist.
+        if service.get('serviceArn')
+    ]
+
+    return services, page.get('nextToken')
+
+
+def _get_service_subnets(service: 'ServiceTypeDef') -> List[str]:
+    '''Return the subnets an awsvpc service's tasks run in'''
+    return service.get('networkConfiguration', {}).get('awsvpcConfiguration', {}).get('subnets', [])
+
+
+def _get_subnet_vpcs(ec2_client: 'EC2Client', subnet_ids: List[str]) -> Dict[str, str]:
+    '''Return the VPC of each subnet, by subnet ID'''
+    subnet_ids = sorted(set(subnet_ids))
+    subnet_vpcs: Dict[str, str] = {}
+    for i in range(0, len(subnet_ids), DESCRIBE_SUBNETS_BATCH_SIZE):
+        for page in ec2_client.get_paginator('describe_subnets').paginate(
+            Filters=[{'Name': 'subnet-id', 'Values': subnet_ids[i:i + DESCRIBE_SUBNETS_BATCH_SIZE]}]
+        ):
+            subnet_vpcs.update((subnet['SubnetId'], subnet['VpcId']) for subnet in page['Subnets'])
+
+    return subnet_vpcs
+
+
+def _get_task_definition_images(
+    ecs_client: 'ECSClient',
+    task_definition_arns: List[str],
+    executor: ThreadPoolExecutor
+) -> Dict[str, List[str]]:
+    '''Return the container images of task definitions, describing those not already known once each'''
+    task_definition_arns = sorted(set(task_definition_arns))
+    with _TASK_DEFINITION_LOCK:
+        new_arns = [arn for arn in task_definition_arns if arn not in _TASK_DEFINITION_IMAGES]
+        if len(_TASK_DEFINITION_IMAGES) + len(new_arns) > TASK_DEFINITION_CACHE_SIZE:
+            _TASK_DEFINITION_IMAGES.clear()
+            new_arns = task_definition_arns
+
+        task_definitions = executor.map(
+            lambda arn: ecs_client.describe_task_definition(taskDefinition=arn)['taskDefinition'],
+            new_arns
+        )
+        # Only the images are kept; the rest of a task definition, environment included, is dropped.
+        _TASK_DEFINITION_IMAGES.update(
+            (arn, [container.get('image', '') for container in task_definition.get('containerDefinitions', [])])
+            for arn, task_definition in zip(new_arns, task_definitions)
+        )
+
+        return {arn: _TASK_DEFINITION_IMAGES[arn] for arn in task_definition_arns}
+
+
+def _create_ecs_service_entity(
+    service: 'ServiceTypeDef',
+    images: List[str],
+    account_system: str,
+    auth: JwtAuth,
+    subnet_vpcs: Optional[Dict[str, str]] = None
+) -> Entity:
+    '''Create an entity for an ECS service'''
+    # Untagged services belong to their account's system.
+    resolution = tag_policy.POLICY.resolve(
+        tag_policy.get_tag_values(service.get('tags', [])),
+        system=account_system,
+        lifecycle=service.get('status', 'UNKNOWN')
+    )
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
+
+    region, account_id = service.get('serviceArn', '').split(':')[3:5]
+    cluster_name = service.get('clusterArn', '').split('/')[-1]
+    service_name = service.get('serviceName', '')
+    entity_type = 'ecs-service'
+    subnet_ids = _get_service_subnets(service)
+    subnet_vpcs = subnet_vpcs or {}
+    vpc_ids = sorted({subnet_vpcs[subnet_id] for subnet_id in subnet_ids if subnet_id in subnet_vpcs})
+
+    entity_spec = EntitySpec({
+        'system': system,
+        'owner': owner,
+        'type': entity_type,
+        'lifecycle': resolution.lifecycle,
+        # VPCs have no view of the services in them, so the service relates itself to its VPCs.
+        'dependsOn': ['resource:default/ecs-cluster-{}'.format(cluster_name)] + [
+            'resource:default/ec2-vpc-{}'.format(vpc_id) for vpc_id in vpc_ids
+        ]
+    })
+
+    # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
+    # the default namespace. eventually we should figure out how to handle this.
+    entity_meta = EntityMeta({
+        'namespace': 'default',
+        # Service names are only unique within their cluster, and clusters within their account and region.
+        'name': catalog.get_entity_name(
+            entity_type,
+            '{}-{}'.format(cluster_name, service_name),
+            service.get('serviceArn', '')
+        ),
+        'title': service_name,
+        'description': 'ECS Service {} in cluster {} in account {}'.format(service_name, cluster_name, account_id),
+        'annotations': {
+            "io.serverlessops/cloud-provider": "aws",
+            'aws.amazon.com/arn': service.get('serviceArn', ''),
+            'aws.amazon.com/account-id': account_id,
+            'aws.amazon.com/region': region,
+            'aws.amazon.com/cluster-name': cluster_name,
+            'aws.amazon.com/service-name': service_name,
+            'aws.amazon.com/launch-type': service.get('launchType', 'UNKNOWN'),
+            'aws.amazon.com/task-definition': service.get('taskDefinition', 'UNKNOWN'),
+            'aws.amazon.com/container-images': ','.join(images),
+        }
+    })
+    if subnet_ids:
+        entity_meta['annotations'].update({
+            'aws.amazon.com/subnet-ids': ','.join(sorted(subnet_ids)),
+            'aws.amazon.com/vpc-ids': ','.join(vpc_ids),
+        })
+
+    entity = Entity({
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': entity_meta,
+        'spec': entity_spec
+    })
+    return entity
+
+
+@catalog.cache_system_owner
+def _get_system_owner(system: str, auth: JwtAuth) -> str:
+    '''Return system owner'''
+    r = catalog.request(
+        'GET',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            'default',
+            'system',
+            system
+        ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to get system owner', extra={'response': r.text})
+        raise GetSystemOwnerError(system)
+
+    return r.json().get('spec', {}).get('owner', 'UNKNOWN')
+
+
+def _collect_page(
+    ecs_client: 'ECSClient',
+    ec2_client: 'EC2Client',
+    cluster_arn: str,
+    next_token: Optional[str],
+    account_system: str,
+    sweep_id: Optional[str],
+    subnet_vpcs: Dict[str, str],
+    subnet_lock: Lock,
+    executor: ThreadPoolExecutor
+) -> Tuple[List[Entity], Optional[str]]:
+    '''Return entities for a page of a cluster's services, and the token for the next page'''
+    services, next_token = _describe_services_page(ecs_client, cluster_arn, next_token, executor)
+
+    # Services commonly share task definitions, within and across pages.
+    images = _get_task_definition_images(
+        ecs_client,
+        [service['taskDefinition'] for service in services if service.get('taskDefinition')],
+        executor
+    )
+    # Subnets resolved for earlier pages of the region, in any cluster, are not described again.
+    with subnet_lock:
+        new_subnet_ids = [
+            subnet_id
+            for service in services
+            for subnet_id in _get_service_subnets(service)
+            if subnet_id not in subnet_vpcs
+        ]
+        if new_subnet_ids:
+            subnet_vpcs.update(_get_subnet_vpcs(ec2_client, new_subnet_ids))
+
+    entities = [
+        sweep.stamp_entity(
+            _create_ecs_service_entity(
+                service,
+                images.get(service.get('taskDefinition', ''), []),
+                account_system,
+                JWT,
+                subnet_vpcs
+            ),
+            sweep_id
+        )
+        for service in services
+    ]
+
+    return entities, next_token
+
+
+def _collect_cluster(
+    ecs_client: 'ECSClient',
+    ec2_client: 'EC2Client',
+    region: str,
+    cluster_arn: str,
+    next_token: Optional[str],
+    account_system: str,
+    sweep_id: Optional[str],
+    subnet_vpcs: Dict[str, str],
+    subnet_lock: Lock,
+    executor: ThreadPoolExecutor,
+    should_stop: Callable[[], bool],
+    first_page_due: bool = False
+) -> ClusterProgress:
+    '''Collect a cluster's services a page at a time, until done or told to stop'''
+    while True:
+        # The first page of an invocation is always collected so every invocation makes progress.
+        if not first_page_due and should_stop():
+            return ClusterProgress(Continuation=make_continuation(region, next_token, cluster_arn), DelaySeconds=0)
+
+        if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+            return ClusterProgress(
+                Continuation=make_continuation(region, next_token, cluster_arn),
+                DelaySeconds=BACKPRESSURE_DELAY_SECONDS
+            )
+
+        entities, next_token = _collect_page(
+            ecs_client,
+            ec2_client,
+            cluster_arn,
+            next_token,
+            account_system,
+            sweep_id,
+            subnet_vpcs,
+            subnet_lock,
+            executor
+        )
+        if entities:
+            _send_queue_messages(entities)
+
+        first_page_due = False
+        if not next_token:
+            return ClusterProgress(Continuation=None, DelaySeconds=0)
+
+
+def _get_remaining_clusters(
+    cluster_arns: List[str],
+    cluster_arn: Optional[str],
+    next_token: Optional[str]
+) -> Tuple[List[str], Optional[str]]:
+    '''Return the clusters left to collect in a region and the page token to resume the first of them at'''
+    if cluster_arn is None:
+        return cluster_arns, None
+
+    if cluster_arn not in cluster_arns:
+        LOGGER.warning(
+            'Continuation cluster no longer exists; starting region over',
+            extra={'cluster_arn': cluster_arn}
+        )
+        return cluster_arns, None
+
+    return cluster_arns[cluster_arns.index(cluster_arn):], next_token
+
+
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
+    '''Publish ECS services to catalog.'''
+    system = tag_policy.POLICY.resolve(tag_policy.get_account_tag_values(account_info)).system
+    account_id = account_info.get('Id', '')
+    sweep_id = account_info.get('SweepId')
+    credentials = _get_cross_account_credentials(
+        account_id,
+        CROSS_ACCOUNT_IAM_ROLE_NAME
+    )
+
+    # Resume at the region, cluster and page a previous invocation stopped before, if any.
+    continuation = account_info.get('Continuation')
+    regions, next_token = get_remaining_regions(COLLECTOR_REGIONS, continuation)
+    resume_cluster_arn = continuation.get('Cluster') if continuation else None
+    # Clusters check the deadline before each page, and stop early once the account is put back.
+    stopped = Event()
+
+    def _should_stop() -> bool:
+        return stopped.is_set() or deadline.expired()
+
+    first_page_due = True
+    with ThreadPoolExecutor(max_workers=ECS_SERVICES_CONCURRENCY) as executor, \
+            ThreadPoolExecutor(max_workers=ECS_CLUSTER_CONCURRENCY) as cluster_executor:
+        for region in regions:
+            ecs_client = _get_cross_account_ecs_client(credentials, region)
+            ec2_client = _get_cross_account_ec2_client(credentials, region)
+            cluster_arns = [
+                cluster_arn
+                for page in ecs_client.get_paginator('list_clusters').paginate()
+                for cluster_arn in page['clusterArns']
+            ]
+            remaining_cluster_arns, next_token = _get_remaining_clusters(
+                cluster_arns,
+                resume_cluster_arn,
+                next_token
+            )
+            resume_cluster_arn = None
+
+            subnet_vpcs: Dict[str, str] = {}
+            subnet_lock = Lock()
+            progress: 'List[Future[ClusterProgress]]' = [
+                cluster_executor.submit(
+                    _collect_cluster,
+                    ecs_client,
+                    ec2_client,
+                    region,
+                    cluster_arn,
+                    next_token if i == 0 else None,
+                    system,
+                    sweep_id,
+                    subnet_vpcs,
+                    subnet_lock,
+                    executor,
+                    _should_stop,
+                    first_page_due and i == 0
+                )
+                for i, cluster_arn in enumerate(remaining_cluster_arns)
+            ]
+            if progress:
+                first_page_due = False
+
+            # The continuation resumes at the first cluster that did not finish. Clusters after it
+            # are redone by the continuation, so stop collecting them.
+            for i, pending_cluster in enumerate(progress):
+                cluster_progress = pending_cluster.result()
+                if cluster_progress['Continuation'] is not None:
+                    stopped.set()
+                    for pending in progress[i + 1:]:
+                        pending.cancel()
+                    send_continuation(
+                        account_info,
+                        cluster_progress['Continuation'],
+                        SOURCE_QUEUE_URL,
+                        cluster_progress['DelaySeconds']
+                    )
+                    return
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
+
+
+@LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
+@event_source(data_class=SQSEvent)
+def handler(event: SQSEvent, context: LambdaContext) -> None:
+    '''Event handler'''
+    LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
+    for record in event.records:
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
+
+    return
@@ -0,0 +1,325 @@
+'''Process Lambda Functions'''
+import os
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event
+from typing import TYPE_CHECKING, Callable, Dict, List, Mapping, Optional, TypedDict
+
+from botocore.exceptions import ClientError
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    SQSEvent
+)
+
+from common.model.account import AccountTypeWithTags, Continuation
+from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy, tags
+from common.util.continuation import Deadline, get_remaining_regions, make_continuation, send_continuation
+from common.util.envelope import pack_entities
+from common.util.jwt import JwtAuth
+
+if TYPE_CHECKING:
+    from mypy_boto3_lambda import LambdaClient
+    from mypy_boto3_lambda.type_defs import FunctionConfigurationTypeDef, ListFunctionsRequestTypeDef
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+    from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
+
+LOGGER = Logger(utc=True)
+
+# AWS
+CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
+SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+COLLECTOR_REGIONS = os.environ.get('COLLECTOR_REGIONS', 'us-east-1').split(',')
+# ListFunctions returns at most 50 functions a page.
+FUNCTION_PAGE_SIZE = int(os.environ.get('FUNCTION_PAGE_SIZE', '50'))
+# Regions scanned at once.
+LAMBDA_REGION_CONCURRENCY = int(os.environ.get('LAMBDA_REGION_CONCURRENCY', '4'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new pages when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
+
+# Tagging API resource type for functions.
+FUNCTION_RESOURCE_TYPE = 'lambda:function'
+
+# Catalog
+CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
+CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
+JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessLambdaFunctions'
+
+
+class RegionListing(TypedDict):
+    '''A region's functions and their tags, by ARN, and where listing stopped if it did not finish'''
+    Functions: List['FunctionConfigurationTypeDef']
+    Tags: Dict[str, Dict[str, str]]
+    Continuation: Optional[Continuation]
+
+
+class GetSystemOwnerError(Exception):
+    '''Get System Owner Error'''
+    def __init__(self, system) -> None:
+        super().__init__('Failed to get owner for system: {}'.format(system))
+
+
+def _get_cross_account_credentials(
+    account_id: str,
+    role_name: str
+) -> 'CredentialsTypeDef':
+    '''Return the IAM role for cross-account access'''
+    role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
+    try:
+        response = aws.get_client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='ProcessLambdaFunctionsResourcecollector'
+        )
+    except Exception as e:
+        LOGGER.exception(e)
+        raise e
+
+    return response['Credentials']
+
+
+def _get_cross_account_lambda_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'LambdaClient':
+    '''Return a Lambda client with cross-account access'''
+    return aws.get_cross_account_client('lambda', credentials, region_name)
+
+
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
+
+
+def _list_region_functions(
+    credentials: 'CredentialsTypeDef',
+    region: str,
+    next_token: Optional[str],
+    should_stop: Callable[[], bool],
+    first_page_due: bool = False
+) -> RegionListing:
+    '''List a region's functions a page at a time, until done or told to stop
+
+    The listing carries everything an entity needs but tags. Those come from the tagging API's
+    index, which costs a call per page rather than per function. Tags are only listed per function
+    when the index can't be read.
+    '''
+    lambda_client = _get_cross_account_lambda_client(credentials, region)
+    functions: 'List[FunctionConfigurationTypeDef]' = []
+    continuation: Optional[Continuation] = None
+    while True:
+        # The first page of an invocation is always listed so every invocation makes progress.
+        if not first_page_due and should_stop():
+            continuation = make_continuation(region, next_token)
+            break
+
+        request: 'ListFunctionsRequestTypeDef' = {'MaxItems': FUNCTION_PAGE_SIZE}
+        if next_token:
+            request['Marker'] = next_token
+        page = lambda_client.list_functions(**request)
+        functions.extend(page['Functions'])
+        first_page_due = False
+        next_token = page.get('NextMarker')
+        if not next_token:
+            break
+
+    function_tags: Dict[str, Dict[str, str]] = {}
+    if not functions:
+        return RegionListing(Functions=functions, Tags=function_tags, Continuation=continuation)
+
+    try:
+        function_tags = tags.get_tag_index(tags.get_tagging_client(credentials, region), [FUNCTION_RESOURCE_TYPE])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'AccessDeniedException':
+            raise e
+        LOGGER.warning('Tag index unavailable; listing tags per function', extra={'region': region})
+        function_tags = {
+            function['FunctionArn']: lambda_client.list_tags(Resource=function['FunctionArn']).get('Tags', {})
+            for function in functions
+        }
+
+    return RegionListing(Functions=functions, Tags=function_tags, Continuation=continuation)
+
+
+def _create_lambda_function_entity(
+    function: 'FunctionConfigurationTypeDef',
+    function_tags: Mapping[str, str],
+    account_system: str,
+    auth: JwtAuth
+) -> Entity:
+    '''Create an entity for a Lambda function'''
+    # Untagged functions belong to their account's system.
+    resolution = tag_policy.POLICY.resolve(function_tags, system=account_system, lifecycle='available')
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
+
+    region, account_id = function.get('FunctionArn', '').split(':')[3:5]
+    function_name = function.get('FunctionName', '')
+    entity_type = 'lambda-function'
+
+    entity_spec = EntitySpec({
+        'system': system,
+        'owner': owner,
+        'type': entity_type,
+        'lifecycle': resolution.lifecycle
+    })
+
+    # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
+    # the default namespace. eventually we should figure out how to handle this.
+    entity_meta = EntityMeta({
+        'namespace': 'default',
+        # Function names are only unique within their account and region.
+        'name': catalog.get_entity_name(entity_type, function_name, function.get('FunctionArn', '')),
+        'title': function_name,
+        'description': 'Lambda function {} in account {}'.format(function_name, account_id),
+        'annotations': {
+            "io.serverlessops/cloud-provider": "aws",
+            'aws.amazon.com/arn': function.get('FunctionArn', ''),
+            'aws.amazon.com/account-id': account_id,
+            'aws.amazon.com/region': region,
+            'aws.amazon.com/function-name': function_name,
+            # Container image functions have no runtime.
+            'aws.amazon.com/runtime': function.get('Runtime', 'UNKNOWN'),
+            'aws.amazon.com/package-type': function.get('PackageType', 'UNKNOWN'),
+            'aws.amazon.com/memory-size': str(function.get('MemorySize', 'UNKNOWN')),
+            'aws.amazon.com/last-modified': function.get('LastModified', 'UNKNOWN'),
+        }
+    })
+
+    entity = Entity({
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': entity_meta,
+        'spec': entity_spec
+    })
+    return entity
+
+
+@catalog.cache_system_owner
+def _get_system_owner(system: str, auth: JwtAuth) -> str:
+    '''Return system owner'''
+    r = catalog.request(
+        'GET',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            'default',
+            'system',
+            system
+        ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to get system owner', extra={'response': r.text})
+        raise GetSystemOwnerError(system)
+
+    return r.json().get('spec', {}).get('owner', 'UNKNOWN')
+
+
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
+    '''Publish Lambda functions to catalog.'''
+    system = tag_policy.POLICY.resolve(tag_policy.get_account_tag_values(account_info)).system
+    account_id = account_info.get('Id', '')
+    sweep_id = account_info.get('SweepId')
+    credentials = _get_cross_account_credentials(
+        account_id,
+        CROSS_ACCOUNT_IAM_ROLE_NAME
+    )
+
+    # Resume at the region and page a previous invocation stopped before, if any.
+    regions, next_token = get_remaining_regions(COLLECTOR_REGIONS, account_info.get('Continuation'))
+    # Listings check the deadline before each page, and stop early once the account is put back.
+    stopped = Event()
+
+    def _should_stop() -> bool:
+        return stopped.is_set() or deadline.expired()
+
+    with ThreadPoolExecutor(max_workers=LAMBDA_REGION_CONCURRENCY) as executor:
+        # Regions are listed at most LAMBDA_REGION_CONCURRENCY ahead of the one being sent, and sent
+        # in order, so a continuation resumes at the first region that was not sent.
+        listings: 'List[Future[RegionListing]]' = []
+        for i, region in enumerate(regions):
+            if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+                stopped.set()
+                for pending in listings[i:]:
+                    pending.cancel()
+                send_continuation(
+                    account_info,
+                    make_continuation(region, next_token if i == 0 else None),
+                    SOURCE_QUEUE_URL,
+                    BACKPRESSURE_DELAY_SECONDS
+                )
+                return
+
+            listings.extend(
+                executor.submit(
+                    _list_region_functions,
+                    credentials,
+                    regions[j],
+                    next_token if j == 0 else None,
+                    _should_stop,
+                    j == 0
+                )
+                for j in range(len(listings), min(i + LAMBDA_REGION_CONCURRENCY, len(regions)))
+            )
+            listing = listings[i].result()
+            entities = [
+                sweep.stamp_entity(
+                    _create_lambda_function_entity(
+                        function,
+                        listing['Tags'].get(function['FunctionArn'], {}),
+                        system,
+                        JWT
+                    ),
+                    sweep_id
+                )
+                for function in listing['Functions']
+            ]
+            if entities:
+                _send_queue_messages(entities)
+
+            continuation = listing['Continuation']
+            if continuation is not None:
+                # Later regions are redone by the continuation, so stop listing them.
+                stopped.set()
+                for pending in listings[i + 1:]:
+                    pending.cancel()
+                send_continuation(account_info, continuation, SOURCE_QUEUE_URL)
+                return
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
+
+
+@LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
+@event_source(data_class=SQSEvent)
+def handler(event: SQSEvent, context: LambdaContext) -> None:
+    '''Event handler'''
+    LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
+    for record in event.records:
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
+
+    return
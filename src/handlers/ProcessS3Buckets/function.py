@@ -0,0 +1,308 @@
+'''Process S3 Buckets'''
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from botocore.config import Config
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    SQSEvent
+)
+
+from common.model.account import AccountTypeWithTags
+from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy, tags
+from common.util.continuation import Deadline, make_continuation, send_continuation
+from common.util.envelope import pack_entities
+from common.util.jwt import JwtAuth
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+    from mypy_boto3_s3.type_defs import BucketTypeDef
+    from mypy_boto3_sts.type_defs import CredentialsTypeDef
+    from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
+
+LOGGER = Logger(utc=True)
+
+# AWS
+CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
+SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+# Buckets are enriched and sent in batches of this size.
+BUCKET_BATCH_SIZE = int(os.environ.get('BUCKET_BATCH_SIZE', '100'))
+# Threads fetching bucket locations.
+S3_ENRICHMENT_CONCURRENCY = int(os.environ.get('S3_ENRICHMENT_CONCURRENCY', '16'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new batches when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
+
+# Bucket listing is global and served from us-east-1.
+LIST_BUCKETS_REGION = 'us-east-1'
+# Tagging API resource type for buckets.
+BUCKET_RESOURCE_TYPE = 's3'
+# GetBucketLocation returns these for buckets created before regional constraints were required.
+LEGACY_LOCATION_CONSTRAINTS = {
+    '': 'us-east-1',
+    'EU': 'eu-west-1',
+}
+
+# Catalog
+CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
+CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
+JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessS3Buckets'
+
+# Bucket name to its region. A bucket's region is fixed so these are kept across invocations.
+_BUCKET_REGIONS: Dict[str, str] = {}
+
+
+class GetSystemOwnerError(Exception):
+    '''Get System Owner Error'''
+    def __init__(self, system) -> None:
+        super().__init__('Failed to get owner for system: {}'.format(system))
+
+
+def _get_cross_account_credentials(
+    account_id: str,
+    role_name: str
+) -> 'CredentialsTypeDef':
+    '''Return the IAM role for cross-account access'''
+    role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
+    try:
+        response = aws.get_client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='ProcessS3BucketsResourcecollector'
+        )
+    except Exception as e:
+        LOGGER.exception(e)
+        raise e
+
+    return response['Credentials']
+
+
+def _get_cross_account_s3_client(
+    credentials: 'CredentialsTypeDef',
+    region_name: str
+) -> 'S3Client':
+    '''Return an S3 client with cross-account access'''
+    # Size the connection pool so location lookups don't wait on each other for a connection.
+    return aws.get_cross_account_client(
+        's3',
+        credentials,
+        region_name,
+        Config(max_pool_connections=S3_ENRICHMENT_CONCURRENCY)
+    )
+
+
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
+
+
+def _get_bucket_region(bucket: 'BucketTypeDef', s3_client: 'S3Client') -> str:
+    '''Return a bucket's region'''
+    bucket_name = bucket.get('Name', '')
+    if bucket_name not in _BUCKET_REGIONS:
+        # ListBuckets includes the region in newer responses, which saves a call per bucket.
+        region = bucket.get('BucketRegion')
+        if not region:
+            constraint = s3_client.get_bucket_location(Bucket=bucket_name).get('LocationConstraint') or ''
+            region = LEGACY_LOCATION_CONSTRAINTS.get(constraint, constraint)
+        _BUCKET_REGIONS[bucket_name] = region
+
+    return _BUCKET_REGIONS[bucket_name]
+
+
+def _create_s3_bucket_entity(
+    bucket: 'BucketTypeDef',
+    bucket_tags: Dict[str, str],
+    account_id: str,
+    region: str,
+    account_system: str,
+    auth: JwtAuth
+) -> Entity:
+    '''Create an entity for an S3 bucket'''
+    entity_type = 's3-bucket'
+    # Untagged buckets belong to their account's system.
+    resolution = tag_policy.POLICY.resolve(bucket_tags, system=account_system, lifecycle='available')
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
+
+    bucket_name = bucket.get('Name', '')
+    bucket_arn = 'arn:aws:s3:::{}'.format(bucket_name)
+
+    entity_spec = EntitySpec({
+        'system': system,
+        'owner': owner,
+        'type': entity_type,
+        'lifecycle': resolution.lifecycle
+    })
+
+    # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
+    # the default namespace. eventually we should figure out how to handle this.
+    entity_meta = EntityMeta({
+        'namespace': 'default',
+        # Bucket names run to 63 characters, too long for the name with its type prefix.
+        'name': catalog.get_entity_name(entity_type, bucket_name, bucket_arn),
+        'title': bucket_name,
+        'description': 'S3 bucket {} in account {}'.format(bucket_name, account_id),
+        'annotations': {
+            "io.serverlessops/cloud-provider": "aws",
+            'aws.amazon.com/arn': bucket_arn,
+            'aws.amazon.com/account-id': account_id,
+            'aws.amazon.com/region': region,
+            'aws.amazon.com/bucket-name': bucket_name
+        }
+    })
+    entity = Entity({
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': entity_meta,
+        'spec': entity_spec
+    })
+    return entity
+
+
+@catalog.cache_system_owner
+def _get_system_owner(system: str, auth: JwtAuth) -> str:
+    '''Return system owner'''
+    r = catalog.request(
+        'GET',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            'default',
+            'system',
+            system
+        ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to get system owner', extra={'response': r.text})
+        raise GetSystemOwnerError(system)
+
+    return r.json().get('spec', {}).get('owner', 'UNKNOWN')
+
+
+def _enrich_buckets(
+    buckets: 'List[BucketTypeDef]',
+    credentials: 'CredentialsTypeDef',
+    s3_client: 'S3Client',
+    tag_indexes: Dict[str, Dict[str, Dict[str, str]]],
+    executor: ThreadPoolExecutor
+) -> 'List[Tuple[BucketTypeDef, str, Dict[str, str]]]':
+    '''Return (bucket, region, tags) for a batch of buckets
+
+    Locations are fetched concurrently. The tagging API only returns buckets in the region it is
+    called in, so each region's tag index is built the first time one of its buckets is seen.
+    '''
+    regions = list(executor.map(lambda bucket: _get_bucket_region(bucket, s3_client), buckets))
+
+    for region in sorted(set(regions) - set(tag_indexes)):
+        tag_indexes[region] = tags.get_tag_index(
+            tags.get_tagging_client(credentials, region),
+            [BUCKET_RESOURCE_TYPE]
+        )
+
+    return [
+        (bucket, region, tag_indexes[region].get('arn:aws:s3:::{}'.format(bucket['Name']), {}))
+        for bucket, region in zip(buckets, regions)
+    ]
+
+
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
+    '''Publish S3 buckets to catalog.'''
+    system = tag_policy.POLICY.resolve(tag_policy.get_account_tag_values(account_info)).system
+    account_id = account_info.get('Id', '')
+    credentials = _get_cross_account_credentials(
+        account_id,
+        CROSS_ACCOUNT_IAM_ROLE_NAME
+    )
+
+    sweep_id = account_info.get('SweepId')
+
+    s3_client = _get_cross_account_s3_client(credentials, LIST_BUCKETS_REGION)
+    buckets = sorted(s3_client.list_buckets().get('Buckets', []), key=lambda b: b['Name'])
+    # Region to the tags of its buckets, by ARN
+    tag_indexes: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+    # Resume after the last bucket a previous invocation sent, if any.
+    last_bucket_name = account_info.get('Continuation', {}).get('NextToken')
+    if last_bucket_name:
+        buckets = [bucket for bucket in buckets if bucket['Name'] > last_bucket_name]
+
+    batches = 0
+    with ThreadPoolExecutor(max_workers=S3_ENRICHMENT_CONCURRENCY) as executor:
+        for i in range(0, len(buckets), BUCKET_BATCH_SIZE):
+            # Always make progress on at least one batch per invocation.
+            if batches > 0 and deadline.expired():
+                send_continuation(
+                    account_info,
+                    make_continuation(LIST_BUCKETS_REGION, last_bucket_name),
+                    SOURCE_QUEUE_URL
+                )
+                return
+
+            if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+                send_continuation(
+                    account_info,
+                    make_continuation(LIST_BUCKETS_REGION, last_bucket_name),
+                    SOURCE_QUEUE_URL,
+                    BACKPRESSURE_DELAY_SECONDS
+                )
+                return
+
+            batch = buckets[i:i + BUCKET_BATCH_SIZE]
+            entities = [
+                sweep.stamp_entity(
+                    _create_s3_bucket_entity(bucket, bucket_tags, account_id, region, system, JWT),
+                    sweep_id
+                )
+                for bucket, region, bucket_tags in _enrich_buckets(
+                    batch,
+                    credentials,
+                    s3_client,
+                    tag_indexes,
+                    executor
+                )
+            ]
+            _send_queue_messages(entities)
+
+            batches += 1
+            last_bucket_name = batch[-1]['Name']
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
+
+
+@LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
+@event_source(data_class=SQSEvent)
+def handler(event: SQSEvent, context: LambdaContext) -> None:
+    '''Event handler'''
+    LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
+    for record in event.records:
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
+
+    return
@@ -2,8 +2,7 @@
 '''Process VPCs'''
 import os
 import json
-import requests
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, TypedDict
 
 from aws_lambda_powertools.logging import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
@@ -11,24 +10,34 @@ from aws_lambda_powertools.utilities.data_classes import (
     event_source,
     SQSEvent
 )
-import boto3
 
 from common.model.account import AccountTypeWithTags
 from common.model.entity import Entity, EntityMeta, EntitySpec
+from common.util import aws, catalog, claim_check, instrumentation, profiling, schedule, sqs, sweep, tag_policy
+from common.util.continuation import Deadline, get_remaining_regions, make_continuation, send_continuation
+from common.util.envelope import pack_entities
 from common.util.jwt import JwtAuth
 
 if TYPE_CHECKING:
     from mypy_boto3_ec2 import EC2Client
-    from mypy_boto3_ec2.type_defs import VpcTypeDef
+    from mypy_boto3_ec2.type_defs import FilterTypeDef, VpcTypeDef
     from mypy_boto3_sts.type_defs import CredentialsTypeDef
     from mypy_boto3_sqs.type_defs import SendMessageResultTypeDef
 
 LOGGER = Logger(utc=True)
 
 # AWS
-STS_CLIENT = boto3.client('sts')
 CROSS_ACCOUNT_IAM_ROLE_NAME = os.environ.get('CROSS_ACCOUNT_IAM_ROLE_NAME', '')
 SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL', 'MUST_SET_SQS_QUEUE_URL')
+SOURCE_QUEUE_URL = os.environ.get('SOURCE_QUEUE_URL', 'MUST_SET_SOURCE_QUEUE_URL')
+COLLECTOR_REGIONS = os.environ.get('COLLECTOR_REGIONS', 'us-east-1').split(',')
+VPC_PAGE_SIZE = int(os.environ.get('VPC_PAGE_SIZE', '100'))
+ENVELOPE_COMPRESSION = os.environ.get('ENVELOPE_COMPRESSION', 'false').lower() == 'true'
+# Stop starting new pages when less than this much time remains.
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '1500'))
+# Defer work while the catalog queue holds more than this many messages.
+BACKPRESSURE_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_QUEUE_DEPTH', '500'))
+BACKPRESSURE_DELAY_SECONDS = int(os.environ.get('BACKPRESSURE_DELAY_SECONDS', '300'))
 
 # Catalog
 CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
@@ -36,6 +45,19 @@ CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
 JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
 
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+SWEEP_COLLECTOR = 'ProcessVpcs'
+# Shared resource index type for VPCs
+SHARED_RESOURCE_TYPE = 'vpc'
+
+
+class VpcTopology(TypedDict):
+    '''What a VPC contains'''
+    Subnets: Set[str]
+    AvailabilityZones: Set[str]
+    RouteTables: Set[str]
+
 
 class GetSystemOwnerError(Exception):
     '''Get System Owner Error'''
@@ -50,7 +72,7 @@ def _get_cross_account_credentials(
     '''Return the IAM role for cross-account access'''
     role_arn = 'arn:aws:iam::{}:role/{}'.format(account_id, role_name)
     try:
-        response = STS_CLIENT.assume_role(
+        response = aws.get_client('sts').assume_role(
             RoleArn=role_arn,
             RoleSessionName='ProcessVpcsResourcecollector'
         )
@@ -62,45 +84,68 @@ def _get_cross_account_credentials(
 
 
 def _get_cross_account_ec2_client(
-    account_id: str,
-    role_name: str
+    credentials: 'CredentialsTypeDef',
+    region_name: str
 ) -> 'EC2Client':
     '''Return an EC2 client with cross-account access'''
-    credentials = _get_cross_account_credentials(
-        account_id,
-        role_name
-    )
-    client = boto3.client(
-        'ec2',
-        aws_access_key_id=credentials['AccessKeyId'],
-        aws_secret_access_key=credentials['SecretAccessKey'],
-        aws_session_token=credentials['SessionToken']
-    )
+    return aws.get_cross_account_client('ec2', credentials, region_name)
 
-    return client
 
+def _send_queue_messages(entities: List[Entity]) -> List['SendMessageResultTypeDef']:
+    '''Send entities to SQS packed into envelopes'''
+    return [
+        sqs.send_message(SQS_QUEUE_URL, envelope)
+        for envelope in pack_entities(entities, ENVELOPE_COMPRESSION)
+    ]
 
-def _send_queue_message(entity: Entity) -> 'SendMessageResultTypeDef':
-    '''Send message to SQS'''
-    sqs = boto3.client('sqs')
-    r = sqs.send_message(
-        QueueUrl=SQS_QUEUE_URL,
-        MessageBody=json.dumps(entity)
-    )
-    return r
+
+def _get_vpc_topology(ec2_client: 'EC2Client', vpc_ids: List[str]) -> Dict[str, VpcTopology]:
+    '''Return the topology of a page of VPCs, by VPC ID
+
+    Subnets and route tables are listed for the page's VPCs together and grouped by VPC in memory,
+    so the cost is a call per page rather than one set of calls per VPC, and the work is bounded by
+    the same deadline check as the page itself.
+    '''
+    topology: Dict[str, VpcTopology] = {
+        vpc_id: VpcTopology(Subnets=set(), AvailabilityZones=set(), RouteTables=set())
+        for vpc_id in vpc_ids
+    }
+    if not vpc_ids:
+        return topology
+
+    filters: 'List[FilterTypeDef]' = [{'Name': 'vpc-id', 'Values': vpc_ids}]
+    for subnet_page in ec2_client.get_paginator('describe_subnets').paginate(Filters=filters):
+        for subnet in subnet_page['Subnets']:
+            vpc_topology = topology[subnet['VpcId']]
+            vpc_topology['Subnets'].add(subnet['SubnetId'])
+            vpc_topology['AvailabilityZones'].add(subnet['AvailabilityZone'])
+
+    for route_table_page in ec2_client.get_paginator('describe_route_tables').paginate(Filters=filters):
+        for route_table in route_table_page['RouteTables']:
+            topology[route_table['VpcId']]['RouteTables'].add(route_table['RouteTableId'])
+
+    return topology
 
 
 def _create_vpc_entity(
     vpc: 'VpcTypeDef',
     account_id: str,
     region: str,
-    system: str,
-    auth: JwtAuth
+    account_system: str,
+    auth: JwtAuth,
+    topology: Optional[VpcTopology] = None,
+    participants: Optional[Set[str]] = None
 ) -> Entity:
     '''Create an entity for a VPC'''
     entity_type = 'ec2-vpc'
-    tags = { tag.get('key'): tag.get('value', 'NO_VALUE') for tag in vpc.get('Tags', []) }
-    owner = _get_system_owner(system, auth)
+    # Untagged VPCs belong to their account's system.
+    resolution = tag_policy.POLICY.resolve(
+        tag_policy.get_tag_values(vpc.get('Tags', [])),
+        system=account_system,
+        lifecycle=vpc.get('State', 'UNKNOWN')
+    )
+    system = resolution.system
+    owner = resolution.owner or _get_system_owner(system, auth)
 
     vpc_id = vpc.get('VpcId', '')
 
@@ -108,7 +153,7 @@ def _create_vpc_entity(
         'system': system,
         'owner': owner,
         'type': entity_type,
-        'lifecycle': vpc.get('State', 'UNKNOWN')
+        'lifecycle': resolution.lifecycle
     })
 
     # FIXME: The odds of a resource collision are low enough at our scale that we'll just use
@@ -127,6 +172,14 @@ def _create_vpc_entity(
             'aws.amazon.com/cidr-block': vpc.get('CidrBlock', 'UNKNOWN')
         }
     })
+    if topology is not None:
+        entity_meta['annotations'].update({
+            'aws.amazon.com/subnet-count': str(len(topology['Subnets'])),
+            'aws.amazon.com/availability-zones': ','.join(sorted(topology['AvailabilityZones'])),
+            'aws.amazon.com/route-tables': ','.join(sorted(topology['RouteTables'])),
+        })
+    if participants:
+        entity_meta['annotations']['aws.amazon.com/participant-account-ids'] = ','.join(sorted(participants))
     entity = Entity({
         'apiVersion': 'backstage.io/v1alpha1',
         'kind': 'Resource',
@@ -136,15 +189,19 @@ def _create_vpc_entity(
     return entity
 
 
+@catalog.cache_system_owner
 def _get_system_owner(system: str, auth: JwtAuth) -> str:
     '''Return system owner'''
-    r = requests.get(
+    r = catalog.request(
+        'GET',
         '/'.join([
             CATALOG_ENDPOINT,
             'default',
             'system',
             system
         ]),
+        catalog.ROUTE_GET_SYSTEM,
+        entity_ref='system:default/{}'.format(system),
         auth=auth
     )
 
@@ -155,33 +212,130 @@ def _get_system_owner(system: str, auth: JwtAuth) -> str:
     return r.json().get('spec', {}).get('owner', 'UNKNOWN')
 
 
-def _main(account_info: AccountTypeWithTags) -> None:
+def _get_vpc_participants(account_id: str, sweep_id: Optional[str]) -> Dict[str, Set[str]]:
+    '''Return the accounts an account's VPCs are shared with, by VPC ID'''
+    if not sweep_id:
+        return {}
+
+    sweep_ids = [sweep_id]
+    last_sweep = sweep.get_last_completed(STATE_TABLE_NAME)
+    if last_sweep is not None:
+        sweep_ids.append(str(last_sweep['Generation']))
+
+    return sweep.get_participants(STATE_TABLE_NAME, sweep_ids, SHARED_RESOURCE_TYPE, account_id)
+
+
+def _record_shared_vpcs(vpcs: 'List[VpcTypeDef]', account_id: str, sweep_id: Optional[str]) -> None:
+    '''Record an account as a participant in VPCs shared with it by other accounts'''
+    if not sweep_id:
+        return
+
+    shared_vpc_ids: Dict[str, List[str]] = {}
+    for vpc in vpcs:
+        shared_vpc_ids.setdefault(vpc['OwnerId'], []).append(vpc['VpcId'])
+
+    for owner_account_id, vpc_ids in shared_vpc_ids.items():
+        sweep.add_participant(STATE_TABLE_NAME, sweep_id, SHARED_RESOURCE_TYPE, owner_account_id, vpc_ids, account_id)
+
+
+def _main(account_info: AccountTypeWithTags, deadline: Deadline) -> None:
     '''Publish VPC to catalog.'''
-    # NOTE: VPCs arem't tagged so we just use the account's system tag.
-    account_tags = {tag['Key']: tag['Value'] for tag in account_info.get('Tags', [])}
-    system = account_tags.get('org:system', 'UNKNOWN')
+    system = tag_policy.POLICY.resolve(tag_policy.get_account_tag_values(account_info)).system
     account_id = account_info.get('Id', '')
-    ec2_client = _get_cross_account_ec2_client(
+    credentials = _get_cross_account_credentials(
         account_id,
         CROSS_ACCOUNT_IAM_ROLE_NAME
     )
 
-    region = ec2_client.meta.region_name
-
-    vpcs = ec2_client.describe_vpcs()
-    for vpc in vpcs['Vpcs']:
-        entity = _create_vpc_entity(vpc, account_id, region, system, JWT)
-        _send_queue_message(entity)
-
+    sweep_id = account_info.get('SweepId')
+    participants = _get_vpc_participants(account_id, sweep_id)
+    org_account_ids = sweep.get_org_accounts(STATE_TABLE_NAME, sweep_id) if sweep_id else None
+
+    # Resume where a previous invocation stopped, if anywhere.
+    regions, next_token = get_remaining_regions(COLLECTOR_REGIONS, account_info.get('Continuation'))
+    pages = 0
+    for region in regions:
+        ec2_client = _get_cross_account_ec2_client(credentials, region)
+        while True:
+            # Always make progress on at least one page per invocation.
+            if pages > 0 and deadline.expired():
+                send_continuation(account_info, make_continuation(region, next_token), SOURCE_QUEUE_URL)
+                return
+
+            if sqs.is_backed_up(SQS_QUEUE_URL, BACKPRESSURE_QUEUE_DEPTH):
+                send_continuation(
+                    account_info,
+                    make_continuation(region, next_token),
+                    SOURCE_QUEUE_URL,
+                    BACKPRESSURE_DELAY_SECONDS
+                )
+                return
+
+            vpcs = ec2_client.describe_vpcs(
+                MaxResults=VPC_PAGE_SIZE,
+                **{'NextToken': next_token} if next_token else {}
+            )
+            # VPCs shared with this account are emitted by their owner, unless the owner is outside the
+            # organization and so never collected.
+            owned_vpcs = [vpc for vpc in vpcs['Vpcs'] if vpc.get('OwnerId', account_id) == account_id]
+            shared_vpcs = [vpc for vpc in vpcs['Vpcs'] if vpc.get('OwnerId', account_id) != account_id]
+            external_vpcs = [
+                vpc for vpc in shared_vpcs
+                if org_account_ids is not None and vpc['OwnerId'] not in org_account_ids
+            ]
+            _record_shared_vpcs(
+                [vpc for vpc in shared_vpcs if vpc not in external_vpcs],
+                account_id,
+                sweep_id
+            )
+            topology = _get_vpc_topology(ec2_client, [vpc['VpcId'] for vpc in owned_vpcs])
+            entities = [
+                sweep.stamp_entity(
+                    _create_vpc_entity(
+                        vpc,
+                        account_id,
+                        region,
+                        system,
+                        JWT,
+                        topology.get(vpc['VpcId']),
+                        participants.get(vpc['VpcId'])
+                    ),
+                    sweep_id
+                )
+                for vpc in owned_vpcs
+            ] + [
+                # Participants only see the subnets shared with them, so these carry no topology and
+                # are described under their owner account whichever participant emits them.
+                sweep.stamp_entity(
+                    _create_vpc_entity(vpc, vpc['OwnerId'], region, system, JWT),
+                    sweep_id
+                )
+                for vpc in external_vpcs
+            ]
+            if entities:
+                _send_queue_messages(entities)
+
+            pages += 1
+            next_token = vpcs.get('NextToken')
+            if not next_token:
+                break
+
+    if sweep_id:
+        sweep.complete_account(STATE_TABLE_NAME, sweep_id, SWEEP_COLLECTOR, account_id)
 
 
 @LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
 @event_source(data_class=SQSEvent)
-def handler(event: SQSEvent, _: LambdaContext) -> None:
+def handler(event: SQSEvent, context: LambdaContext) -> None:
     '''Event handler'''
     LOGGER.debug('Event', extra={"message_object": event._data})
+    deadline = Deadline(context, DEADLINE_MARGIN_MS)
     for record in event.records:
-        account_info = AccountTypeWithTags(**json.loads(record.body))
-        _main(account_info)
+        account_info = AccountTypeWithTags(**json.loads(claim_check.resolve(record.body)))
+        if schedule.defer_until_due(account_info, SOURCE_QUEUE_URL):
+            continue
+        _main(account_info, deadline)
 
     return
@@ -0,0 +1,209 @@
+
+'''Remove stale entities from the catalog'''
+import os
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import List
+
+from aws_lambda_powertools.logging import Logger
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import (
+    event_source,
+    EventBridgeEvent
+)
+
+from common.model.entity import Entity
+from common.model.sweep import CompletedSweep
+from common.util import catalog, instrumentation, profiling, sweep
+from common.util.jwt import JwtAuth
+
+LOGGER = Logger(utc=True)
+
+# Catalog
+CATALOG_ENDPOINT = os.environ.get('CATALOG_ENDPOINT', 'MUST_SET_CATALOG_ENDPOINT')
+CLIENT_ID = os.environ.get('CLIENT_ID', 'MUST_SET_CLIENT_ID')
+CLIENT_SECRET = os.environ.get('CLIENT_SECRET', 'MUST_SET_CLIENT_SECRET')
+JWT = JwtAuth(CLIENT_ID, CLIENT_SECRET)
+
+# Sweep tracking
+STATE_TABLE_NAME = os.environ.get('STATE_TABLE_NAME', 'MUST_SET_STATE_TABLE_NAME')
+
+# Reconciliation
+# Give AddEntityToCatalog time to drain writes from the completed sweep before judging staleness.
+RECONCILE_GRACE_SECONDS = int(os.environ.get('RECONCILE_GRACE_SECONDS', '600'))
+RECONCILE_MAX_DELETES = int(os.environ.get('RECONCILE_MAX_DELETES', '100'))
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', '4'))
+RECONCILE_BATCH_SIZE = int(os.environ.get('RECONCILE_BATCH_SIZE', '20'))
+# Stop starting new batches when less than this much time remains.
+RECONCILE_DEADLINE_MARGIN_MS = int(os.environ.get('RECONCILE_DEADLINE_MARGIN_MS', '5000'))
+
+CATALOG_NAMESPACE = 'default'
+CATALOG_KIND = 'resource'
+
+
+class ListEntitiesError(Exception):
+    '''List Entities Error'''
+    def __init__(self, kind) -> None:
+        super().__init__('Failed to list catalog entities of kind: {}'.format(kind))
+
+
+class DeleteEntityError(Exception):
+    '''Delete Entity Error'''
+    def __init__(self, name) -> None:
+        super().__init__('Failed to delete entity from catalog: {}'.format(name))
+
+
+def _list_entities(auth: JwtAuth) -> List[Entity]:
+    '''Return catalog entities'''
+    r = catalog.request(
+        'GET',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            CATALOG_NAMESPACE,
+            CATALOG_KIND
+        ]),
+        catalog.ROUTE_LIST_ENTITIES,
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to list entities', extra={'response': r.text})
+        raise ListEntitiesError(CATALOG_KIND)
+
+    return r.json()
+
+
+def _get_entity_ref(entity: Entity) -> str:
+    '''Return the catalog reference for an entity'''
+    return '{}:{}/{}'.format(
+        entity['kind'].lower(),
+        entity['metadata']['namespace'],
+        entity['metadata']['name']
+    )
+
+
+def _delete_entity(entity: Entity, auth: JwtAuth) -> requests.Response:
+    '''Delete entity from catalog'''
+    r = catalog.request(
+        'DELETE',
+        '/'.join([
+            CATALOG_ENDPOINT,
+            entity['metadata']['namespace'],
+            entity['kind'].lower(),
+            entity['metadata']['name']
+        ]),
+        catalog.ROUTE_DELETE_ENTITY,
+        entity_ref=_get_entity_ref(entity),
+        auth=auth
+    )
+
+    if not r.ok:
+        LOGGER.error('Failed to delete entity', extra={'response': r.text})
+        raise DeleteEntityError(entity['metadata']['name'])
+
+    return r
+
+
+def _is_stale(entity: Entity, last_sweep: CompletedSweep) -> bool:
+    '''Return whether an entity was not seen by the last completed sweep'''
+    # Entities without a generation were not written by a sweep and are left alone.
+    generation = sweep.get_entity_generation(entity)
+    if generation is None or generation >= last_sweep['Generation']:
+        return False
+
+    if 'OrgAccounts' not in last_sweep:
+        return True
+
+    # Accounts not due for a scan keep their entities; accounts gone from the organization do not.
+    account_id = entity['metadata']['annotations'].get('aws.amazon.com/account-id')
+    if account_id not in last_sweep['OrgAccounts']:
+        return True
+    return account_id in last_sweep.get('Accounts', [])
+
+
+def _get_stale_entities(entities: List[Entity], last_sweep: CompletedSweep) -> List[Entity]:
+    '''Return entities older than the last completed sweep'''
+    stale_entities = [entity for entity in entities if _is_stale(entity, last_sweep)]
+    if not stale_entities:
+        return stale_entities
+
+    # Unchanged entities are not written again by overlapping sweeps, which record seeing them instead.
+    seen_generations = sweep.get_seen_generations(
+        STATE_TABLE_NAME,
+        [_get_entity_ref(entity) for entity in stale_entities]
+    )
+    return [
+        entity for entity in stale_entities
+        if seen_generations.get(_get_entity_ref(entity), 0) < last_sweep['Generation']
+    ]
+
+
+def _delete_entities(entities: List[Entity], auth: JwtAuth, context: LambdaContext) -> int:
+    '''Delete entities in bounded-concurrency batches and return the number deleted'''
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=RECONCILE_CONCURRENCY) as executor:
+        for i in range(0, len(entities), RECONCILE_BATCH_SIZE):
+            if i > 0 and context.get_remaining_time_in_millis() < RECONCILE_DEADLINE_MARGIN_MS:
+                LOGGER.warning('Deadline approaching; stopping reconciliation', extra={'deleted': deleted})
+                break
+
+            batch = entities[i:i + RECONCILE_BATCH_SIZE]
+            results = executor.map(lambda entity: _try_delete_entity(entity, auth), batch)
+            deleted += sum(results)
+
+    return deleted
+
+
+def _try_delete_entity(entity: Entity, auth: JwtAuth) -> bool:
+    '''Delete an entity, logging rather than raising on failure'''
+    try:
+        _delete_entity(entity, auth)
+    except DeleteEntityError as e:
+        LOGGER.exception(e)
+        return False
+    return True
+
+
+def _main(context: LambdaContext) -> None:
+    '''Delete entities not seen by the last completed sweep.'''
+    last_sweep = sweep.get_last_completed(STATE_TABLE_NAME)
+    if last_sweep is None:
+        LOGGER.info('No completed sweep; nothing to reconcile')
+        return
+
+    if int(time()) - last_sweep['CompletedAt'] < RECONCILE_GRACE_SECONDS:
+        LOGGER.info('Last sweep completed too recently; skipping', extra={'generation': last_sweep['Generation']})
+        return
+
+    entities = _list_entities(JWT)
+    stale_entities = _get_stale_entities(entities, last_sweep)
+    if len(stale_entities) > RECONCILE_MAX_DELETES:
+        LOGGER.warning(
+            'Stale entities exceed deletion cap',
+            extra={'stale': len(stale_entities), 'cap': RECONCILE_MAX_DELETES}
+        )
+
+    deleted = _delete_entities(stale_entities[:RECONCILE_MAX_DELETES], JWT, context)
+    LOGGER.info(
+        'Reconciliation complete',
+        extra={
+            'generation': last_sweep['Generation'],
+            'entities': len(entities),
+            'stale': len(stale_entities),
+            'deleted': deleted
+        }
+    )
+
+
+@LOGGER.inject_lambda_context
+@profiling.profile_handler
+@instrumentation.emit_metrics
+@event_source(data_class=EventBridgeEvent)
+def handler(event: EventBridgeEvent, context: LambdaContext) -> None:
+    '''Event handler'''
+    LOGGER.debug('Event', extra={"message_object": event})
+
+    _main(context)
+
+    return
@@ -0,0 +1,457 @@
+'''Pipeline benchmark fixtures'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import io
+import json
+import os
+import tracemalloc
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from types import ModuleType
+from typing import Any, Callable, Dict, Generator, Iterator, List, Tuple, TypedDict
+from uuid import uuid4
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Set to rewrite the baseline from the current run instead of comparing against it.
+UPDATE_BASELINE = os.environ.get('BENCHMARK_UPDATE_BASELINE', '') == '1'
+# How much each measurement may grow over the baseline. Timings vary between machines and runs;
+# call counts do not.
+PIPELINE_TOLERANCES = {
+    'wall_time_s': 1.5,
+    'peak_memory_mb': 1.5,
+    'aws_calls': 1.0,
+    'catalog_calls': 1.0,
+}
+
+# Calls whose number depends on timing, such as queue depth samples reused for a few seconds. They
+# are reported but not gated.
+TIMING_DEPENDENT_OPERATIONS = {'sqs.GetQueueAttributes'}
+
+AWS_LATENCY_MS = int(os.environ.get('BENCHMARK_AWS_LATENCY_MS', '2'))
+CATALOG_LATENCY_MS = int(os.environ.get('BENCHMARK_CATALOG_LATENCY_MS', '10'))
+# Plenty of time so collectors only split work when a benchmark asks them to.
+REMAINING_TIME_MS = 900000
+
+MOCK_CATALOG_ENDPOINT = 'https://api.example.com/catalog'
+CROSS_ACCOUNT_ROLE_NAME = 'mock-cross-account-role'
+REGION = 'us-east-1'
+# An image moto provides in every account.
+INSTANCE_IMAGE_ID = 'ami-12c6146b'
+
+# Queue name, handler module, batch size
+COLLECTORS: List[Tuple[str, str, int]] = [
+    ('ProcessAccount', 'src.handlers.ProcessAccount.function', 1),
+    ('ProcessEcsClusters', 'src.handlers.ProcessEcsClusters.function', 1),
+    ('ProcessEcsServices', 'src.handlers.ProcessEcsServices.function', 1),
+    ('ProcessVpcs', 'src.handlers.ProcessVpcs.function', 1),
+    ('ProcessS3Buckets', 'src.handlers.ProcessS3Buckets.function', 1),
+    ('ProcessLambdaFunctions', 'src.handlers.ProcessLambdaFunctions.function', 1),
+    ('ProcessEc2Instances', 'src.handlers.ProcessEc2Instances.function', 1),
+]
+CATALOG_WRITER = ('AddEntityToCatalog', 'src.handlers.AddEntityToCatalog.function', 10)
+
+# Scenario and its measurements, for the summary
+_RESULTS: List[Tuple[str, Dict[str, float]]] = []
+
+
+class SyntheticOrg(TypedDict):
+    '''Accounts and resources created for a benchmark'''
+    accounts: List[str]
+    vpcs: int
+    clusters: int
+    services: int
+    buckets: int
+    functions: int
+    instances: int
+
+
+class BenchmarkResult(TypedDict):
+    '''Measurements from one pipeline run'''
+    wall_time_s: float
+    peak_memory_mb: float
+    aws_calls: int
+    catalog_calls: int
+    aws_calls_by_operation: Dict[str, int]
+    catalog_calls_by_route: Dict[str, int]
+    entities: int
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config) -> None:
+    '''Report benchmark results'''
+    if not _RESULTS:
+        return
+
+    terminalreporter.section('benchmarks')
+    for scenario, measurements in _RESULTS:
+        terminalreporter.write_line('{:<40} {}'.format(
+            scenario,
+            '  '.join('{}={:.3f}'.format(key, value) for key, value in measurements.items())
+        ))
+
+
+# AWS
+class AwsCalls(Counter):
+    '''AWS API calls made by handler code, by operation'''
+    counting = False
+
+    @contextmanager
+    def in_handler(self) -> Iterator[None]:
+        '''Count calls made inside the block'''
+        self.counting = True
+        try:
+            yield
+        finally:
+            self.counting = False
+
+    def gated(self) -> int:
+        '''Return the number of calls that do not depend on timing'''
+        return sum(count for operation, count in self.items() if operation not in TIMING_DEPENDENT_OPERATIONS)
+
+
+@pytest.fixture()
+def aws_calls(mocked_aws, mocker: MockerFixture) -> Generator[AwsCalls, None, None]:
+    '''Count AWS API calls made through moto by handler code, adding latency to each'''
+    from moto.core.botocore_stubber import BotocoreStubber
+
+    calls = AwsCalls()
+    stubber_call = BotocoreStubber.__call__
+
+    def _call(self, event_name: str, request: Any, **kwargs: Any) -> Any:
+        # Calls made by the benchmark itself, to set up and drain queues, are not measured.
+        if calls.counting:
+            # event_name is before-send.<service>.<operation>
+            calls[event_name.split('.', 1)[1]] += 1
+            sleep(AWS_LATENCY_MS / 1000)
+        return stubber_call(self, event_name, request, **kwargs)
+
+    mocker.patch.object(BotocoreStubber, '__call__', _call)
+    yield calls
+
+
+@pytest.fixture()
+def make_synthetic_org(
+    aws_calls: AwsCalls,
+    make_mocked_client: Callable,
+) -> Callable[[int, int, int, int, int], SyntheticOrg]:
+    '''Return a function that creates an organization of accounts with VPCs, EC2 instances, ECS clusters and
+    services, S3 buckets and Lambda functions'''
+    import boto3
+
+    function_code = io.BytesIO()
+    with zipfile.ZipFile(function_code, 'w') as function_zip:
+        function_zip.writestr('function.py', 'def handler(event, context):\n    return\n')
+
+    def _make_synthetic_org(accounts: int, vpcs: int, clusters: int, buckets: int, functions: int) -> SyntheticOrg:
+        org_client = make_mocked_client('organizations')
+        sts_client = make_mocked_client('sts')
+        org_client.create_organization(FeatureSet='ALL')
+
+        account_ids = []
+        vpc_count = 0
+        for i in range(accounts):
+            account_id = org_client.create_account(
+                AccountName='account-{}'.format(i),
+                Email='account-{}@example.com'.format(i)
+            )['CreateAccountStatus']['AccountId']
+            org_client.tag_resource(
+                ResourceId=account_id,
+                Tags=[{'Key': 'org:system', 'Value': 'system-{}'.format(i % 3)}]
+            )
+            account_ids.append(account_id)
+
+            credentials = sts_client.assume_role(
+                RoleArn='arn:aws:iam::{}:role/{}'.format(account_id, CROSS_ACCOUNT_ROLE_NAME),
+                RoleSessionName='benchmark'
+            )['Credentials']
+            session = boto3.session.Session(
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                region_name=REGION
+            )
+            ec2_client = session.client('ec2')
+            ecs_client = session.client('ecs')
+            s3_client = session.client('s3')
+            for j in range(vpcs):
+                ec2_client.create_vpc(CidrBlock='10.{}.0.0/16'.format(j))
+            # An instance for every VPC, all in the default VPC.
+            if vpcs:
+                ec2_client.run_instances(ImageId=INSTANCE_IMAGE_ID, MinCount=vpcs, MaxCount=vpcs)
+            # Every cluster runs a service and the services share a task definition.
+            task_definition_arn = ecs_client.register_task_definition(
+                family='task',
+                containerDefinitions=[{'name': 'app', 'image': 'app:latest', 'memory': 128}]
+            )['taskDefinition']['taskDefinitionArn']
+            for j in range(clusters):
+                ecs_client.create_cluster(clusterName='cluster-{}'.format(j))
+                ecs_client.create_service(
+                    cluster='cluster-{}'.format(j),
+                    serviceName='service',
+                    taskDefinition=task_definition_arn,
+                    desiredCount=1
+                )
+            for j in range(buckets):
+                bucket_name = 'bucket-{}-{}'.format(account_id, j)
+                s3_client.create_bucket(Bucket=bucket_name)
+                # Half the buckets belong to a system other than their account's.
+                if j % 2:
+                    s3_client.put_bucket_tagging(
+                        Bucket=bucket_name,
+                        Tagging={'TagSet': [{'Key': 'org:system', 'Value': 'system-{}'.format(j % 3)}]}
+                    )
+            if functions:
+                role_arn = session.client('iam').create_role(
+                    RoleName='function-role',
+                    AssumeRolePolicyDocument=json.dumps({'Version': '2012-10-17', 'Statement': []})
+                )['Role']['Arn']
+            lambda_client = session.client('lambda')
+            for j in range(functions):
+                lambda_client.create_function(
+                    FunctionName='function-{}'.format(j),
+                    Runtime='python3.12',
+                    Role=role_arn,
+                    Handler='function.handler',
+                    Code={'ZipFile': function_code.getvalue()},
+                    # Half the functions belong to a system other than their account's.
+                    Tags={'org:system': 'system-{}'.format(j % 3)} if j % 2 else {}
+                )
+            # Accounts come with a default VPC.
+            vpc_count += len(ec2_client.describe_vpcs()['Vpcs'])
+
+        # The management account is collected too.
+        vpc_count += len(make_mocked_client('ec2').describe_vpcs()['Vpcs'])
+        account_ids.insert(0, org_client.describe_organization()['Organization']['MasterAccountId'])
+
+        return SyntheticOrg({
+            'accounts': account_ids,
+            'vpcs': vpc_count,
+            'clusters': accounts * clusters,
+            'services': accounts * clusters,
+            'buckets': accounts * buckets,
+            'functions': accounts * functions,
+            'instances': accounts * vpcs
+        })
+
+    return _make_synthetic_org
+
+
+# Catalog
+@pytest.fixture()
+def catalog_calls() -> Generator[requests_mock.Mocker, None, None]:
+    '''Mock the catalog and token endpoints, adding latency to each call'''
+    from common.util.jwt import AUTH_ENDPOINT
+
+    def _respond(body: Any) -> Callable:
+        def _callback(request, context) -> Any:
+            sleep(CATALOG_LATENCY_MS / 1000)
+            return body
+        return _callback
+
+    with requests_mock.Mocker() as m:
+        m.post(AUTH_ENDPOINT, json=_respond({'access_token': 'token', 'expires_in': 3600}))
+        m.get(requests_mock.ANY, json=_respond({'spec': {'owner': 'owner'}}))
+        m.put(requests_mock.ANY, json=_respond({}))
+        yield m
+
+
+# Pipeline
+def _make_sqs_event(queue_arn: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Return an SQS event for received messages'''
+    return {
+        'Records': [
+            {
+                'messageId': message['MessageId'],
+                'receiptHandle': message['ReceiptHandle'],
+                'body': message['Body'],
+                'attributes': {
+                    'ApproximateReceiveCount': '1',
+                    'SentTimestamp': '0',
+                    'SenderId': 'benchmark',
+                    'ApproximateFirstReceiveTimestamp': '0',
+                },
+                'messageAttributes': {},
+                'md5OfBody': message['MD5OfBody'],
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': queue_arn,
+                'awsRegion': REGION,
+            }
+            for message in messages
+        ]
+    }
+
+
+@pytest.fixture()
+def run_pipeline(
+    aws_calls: AwsCalls,
+    catalog_calls: requests_mock.Mocker,
+    make_mocked_client: Callable,
+    mock_state_table_name: str,
+    mock_context: Callable[..., LambdaContext],
+    mocker: MockerFixture,
+) -> Callable[[], BenchmarkResult]:
+    '''Return a function that drives every handler until the pipeline is drained'''
+    import importlib
+    from common.util.jwt import JwtAuth
+
+    sqs_client = make_mocked_client('sqs')
+    sns_client = make_mocked_client('sns')
+    topic_arn = sns_client.create_topic(Name='ListAccounts')['TopicArn']
+
+    queues: Dict[str, Tuple[str, str]] = {}
+    for name, _, _ in COLLECTORS + [CATALOG_WRITER]:
+        queue_url = sqs_client.create_queue(QueueName=name)['QueueUrl']
+        queue_arn = sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=['QueueArn']
+        )['Attributes']['QueueArn']
+        queues[name] = (queue_url, queue_arn)
+
+    for name, _, _ in COLLECTORS:
+        sns_client.subscribe(
+            TopicArn=topic_arn,
+            Protocol='sqs',
+            Endpoint=queues[name][1],
+            Attributes={'RawMessageDelivery': 'true'}
+        )
+
+    list_accounts = importlib.import_module('src.handlers.ListAccounts.function')
+    mocker.patch.object(list_accounts, 'SNS_TOPIC_ARN', topic_arn)
+    mocker.patch.object(list_accounts, 'STATE_TABLE_NAME', mock_state_table_name)
+
+    handlers: List[Tuple[str, ModuleType, int]] = []
+    for name, module_name, batch_size in COLLECTORS + [CATALOG_WRITER]:
+        fn = importlib.import_module(module_name)
+        mocker.patch.object(fn, 'JWT', JwtAuth('clientId', 'clientSecret'))
+        mocker.patch.object(fn, 'CATALOG_ENDPOINT', MOCK_CATALOG_ENDPOINT)
+        mocker.patch.object(fn, 'STATE_TABLE_NAME', mock_state_table_name)
+        if name != CATALOG_WRITER[0]:
+            mocker.patch.object(fn, 'SQS_QUEUE_URL', queues[CATALOG_WRITER[0]][0])
+            mocker.patch.object(fn, 'SOURCE_QUEUE_URL', queues[name][0])
+            # The benchmark drains queues in turn so the catalog queue backs up by design.
+            mocker.patch.object(fn, 'BACKPRESSURE_QUEUE_DEPTH', 1000000)
+        if hasattr(fn, 'CROSS_ACCOUNT_IAM_ROLE_NAME'):
+            mocker.patch.object(fn, 'CROSS_ACCOUNT_IAM_ROLE_NAME', CROSS_ACCOUNT_ROLE_NAME)
+        if hasattr(fn, 'PERSISTENCE_STORE'):
+            mocker.patch.object(fn.PERSISTENCE_STORE, 'table_name', mock_state_table_name)
+            mocker.patch.object(fn.PERSISTENCE_STORE, 'configured', False)
+        handlers.append((name, fn, batch_size))
+
+    def _drain() -> None:
+        '''Invoke handlers on their queues until every queue is empty'''
+        while True:
+            received = 0
+            for name, fn, batch_size in handlers:
+                queue_url, queue_arn = queues[name]
+                messages = sqs_client.receive_message(
+                    QueueUrl=queue_url,
+                    MaxNumberOfMessages=batch_size
+                ).get('Messages', [])
+                if not messages:
+                    continue
+
+                received += len(messages)
+                with aws_calls.in_handler():
+                    response = fn.handler(
+                        _make_sqs_event(queue_arn, messages),
+                        mock_context(name, REMAINING_TIME_MS)
+                    )
+                assert not (response or {}).get('batchItemFailures'), response
+                for message in messages:
+                    sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+            if received == 0:
+                break
+
+        for name, (queue_url, _) in queues.items():
+            delayed = sqs_client.get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=['ApproximateNumberOfMessagesDelayed']
+            )['Attributes']['ApproximateNumberOfMessagesDelayed']
+            assert delayed == '0', '{} has delayed messages'.format(name)
+
+    def _run_pipeline() -> BenchmarkResult:
+        aws_calls.clear()
+        catalog_calls.reset_mock()
+
+        tracemalloc.start()
+        start = perf_counter()
+        with aws_calls.in_handler():
+            list_accounts.handler(
+                {
+                    'version': '0',
+                    'id': str(uuid4()),
+                    'detail-type': 'Scheduled Event',
+                    'source': 'aws.scheduler',
+                    'account': '123456789012',
+                    'time': '2024-12-13T22:46:36Z',
+                    'region': REGION,
+                    'resources': [],
+                    'detail': {}
+                },
+                mock_context('ListAccounts', REMAINING_TIME_MS)
+            )
+        _drain()
+        wall_time_s = perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        catalog_calls_by_route: Counter = Counter(
+            '{} {}'.format(r.method, r.path.split('/')[-2] if r.method != 'POST' else 'token')
+            for r in catalog_calls.request_history
+        )
+        return BenchmarkResult({
+            'wall_time_s': wall_time_s,
+            'peak_memory_mb': peak_memory / 1024 / 1024,
+            'aws_calls': aws_calls.gated(),
+            'catalog_calls': catalog_calls.call_count,
+            'aws_calls_by_operation': dict(sorted(aws_calls.items())),
+            'catalog_calls_by_route': dict(sorted(catalog_calls_by_route.items())),
+            'entities': sum(count for route, count in catalog_calls_by_route.items() if route.startswith('PUT'))
+        })
+
+    return _run_pipeline
+
+
+@pytest.fixture()
+def compare_to_baseline() -> Callable[[str, Dict[str, float], Dict[str, float]], None]:
+    '''Return a function that fails when measurements regress from the stored baseline'''
+    def _compare_to_baseline(
+        scenario: str,
+        measurements: Dict[str, float],
+        tolerances: Dict[str, float]
+    ) -> None:
+        '''Compare measurements to the baseline, each allowed to grow by its tolerance'''
+        _RESULTS.append((scenario, measurements))
+
+        baselines: Dict[str, Any] = {}
+        if os.path.exists(BASELINE_FILE):
+            with open(BASELINE_FILE) as f:
+                baselines = json.load(f)
+
+        if UPDATE_BASELINE:
+            baselines[scenario] = {key: round(value, 3) for key, value in measurements.items()}
+            with open(BASELINE_FILE, 'w') as f:
+                json.dump(baselines, f, indent=4, sort_keys=True)
+                f.write('\n')
+            return
+
+        if scenario not in baselines:
+            pytest.fail('No baseline for benchmark {}; record one with BENCHMARK_UPDATE_BASELINE=1'.format(scenario))
+
+        baseline = baselines[scenario]
+        regressions = [
+            '{}: {:.3f} > baseline {:.3f} x {}'.format(key, measurements[key], baseline[key], tolerance)
+            for key, tolerance in tolerances.items()
+            if measurements[key] > baseline[key] * tolerance
+        ]
+        assert not regressions, 'Benchmark {} regressed:\n{}'.format(scenario, '\n'.join(regressions))
+
+    return _compare_to_baseline
@@ -0,0 +1,200 @@
+'''Microbenchmark per-entity construction, tag resolution, serialization and parsing'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import datetime
+import gc
+import json
+import tracemalloc
+from time import perf_counter
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Tuple
+
+import pytest
+from pytest_mock import MockerFixture
+
+pytestmark = pytest.mark.benchmark
+
+ENTITY_COUNTS = [10000, 100000]
+# Timings are the best of several runs to keep noise out of the comparison.
+TIMING_REPEATS = 3
+MICROBENCHMARK_TOLERANCES = {
+    'us_per_entity': 2.0,
+    'bytes_per_entity': 1.2,
+}
+
+MOCK_ACCOUNT_ID = '123456789012'
+MOCK_REGION = 'us-east-1'
+
+
+def _measure(run: Callable[[List[Any]], Any], inputs: List[Any], entities: int) -> Dict[str, float]:
+    '''Return the time and peak allocations per entity of running over inputs'''
+    # As timeit does, keep garbage collection pauses out of the timed runs.
+    elapsed = float('inf')
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(TIMING_REPEATS):
+            start = perf_counter()
+            run(inputs)
+            elapsed = min(elapsed, perf_counter() - start)
+    finally:
+        gc.enable()
+
+    # Allocations are traced in a separate pass so tracing does not skew the timing.
+    tracemalloc.start()
+    outputs = run(inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del outputs
+
+    return {
+        'us_per_entity': elapsed / entities * 1000000,
+        'bytes_per_entity': peak / entities,
+    }
+
+
+def _make_account(i: int) -> Dict[str, Any]:
+    '''Return account info as ListAccounts publishes it'''
+    return {
+        'Id': '{:012d}'.format(i),
+        'Arn': 'arn:aws:organizations::{}:account/o-q4ulo3gwzx/{:012d}'.format(MOCK_ACCOUNT_ID, i),
+        'Email': 'account-{}@example.com'.format(i),
+        'Name': 'account-{}'.format(i),
+        'Status': 'ACTIVE',
+        'JoinedMethod': 'CREATED',
+        'JoinedTimestamp': datetime.datetime(2025, 1, 3, 15, 21, 4, tzinfo=datetime.timezone.utc),
+        'SweepId': '1735935664',
+        'Tags': [
+            {'Key': 'org:system', 'Value': 'mock_system'},
+            {'Key': 'org:domain', 'Value': 'mock_domain'},
+            {'Key': 'org:owner', 'Value': 'group:mock_group'},
+        ],
+    }
+
+
+def _make_vpc(i: int) -> Dict[str, Any]:
+    '''Return a VPC as DescribeVpcs returns it'''
+    return {
+        'VpcId': 'vpc-{:017x}'.format(i),
+        'CidrBlock': '10.{}.{}.0/24'.format(i // 256 % 256, i % 256),
+        'OwnerId': MOCK_ACCOUNT_ID,
+        'State': 'available',
+        'IsDefault': False,
+        'Tags': [{'Key': 'Name', 'Value': 'vpc-{}'.format(i)}],
+    }
+
+
+def _make_resource_tags(i: int) -> List[Dict[str, str]]:
+    '''Return a resource's tags, a third of them naming a system'''
+    tags = [{'Key': 'Name', 'Value': 'resource-{}'.format(i)}]
+    if i % 3 == 0:
+        tags.append({'Key': 'org:system', 'Value': 'system-{}'.format(i % 100)})
+    return tags
+
+
+def _make_cluster(i: int) -> Tuple[Dict[str, Any], List[Dict[str, str]]]:
+    '''Return an ECS cluster and its tags as the ECS API returns them'''
+    return (
+        {
+            'clusterArn': 'arn:aws:ecs:{}:{}:cluster/cluster-{}'.format(MOCK_REGION, MOCK_ACCOUNT_ID, i),
+            'clusterName': 'cluster-{}'.format(i),
+            'status': 'ACTIVE',
+        },
+        [{'key': 'org:system', 'value': 'mock_system'}],
+    )
+
+
+@pytest.fixture()
+def handlers(mocked_aws, mocker: MockerFixture) -> Dict[str, ModuleType]:
+    '''Return handler modules with catalog lookups stubbed out'''
+    import importlib
+
+    modules = {}
+    for name in ['ProcessAccount', 'ProcessVpcs', 'ProcessEcsClusters']:
+        fn = importlib.import_module('src.handlers.{}.function'.format(name))
+        # Construction is measured here, not the owner lookup.
+        mocker.patch.object(fn, '_get_system_owner', lambda system, auth: 'owner')
+        modules[name] = fn
+    return modules
+
+
+def _get_cases(handlers: Dict[str, ModuleType], count: int) -> Dict[str, Tuple[Callable, List[Any]]]:
+    '''Return each benchmark's batch function and inputs'''
+    from common.model.account import AccountTypeWithTags
+    from common.model.entity import Entity
+    from common.util import JSONDateTimeEncoder, tag_policy
+    from common.util.envelope import pack_entities, unpack_entities
+
+    vpcs = handlers['ProcessVpcs']
+    clusters = handlers['ProcessEcsClusters']
+    accounts = handlers['ProcessAccount']
+
+    vpc_inputs = [_make_vpc(i) for i in range(count)]
+    entities = [
+        vpcs._create_vpc_entity(vpc, MOCK_ACCOUNT_ID, MOCK_REGION, 'mock_system', None)
+        for vpc in vpc_inputs
+    ]
+    account_inputs = [_make_account(i) for i in range(count)]
+    account_bodies = [json.dumps(account, cls=JSONDateTimeEncoder) for account in account_inputs]
+    entity_bodies = [json.dumps(entity) for entity in entities]
+
+    return {
+        'build/vpc': (
+            lambda inputs: [
+                vpcs._create_vpc_entity(vpc, MOCK_ACCOUNT_ID, MOCK_REGION, 'mock_system', None)
+                for vpc in inputs
+            ],
+            vpc_inputs
+        ),
+        'build/ecs-cluster': (
+            lambda inputs: [clusters._create_ecs_cluster_entity(c, tags, None) for c, tags in inputs],
+            [_make_cluster(i) for i in range(count)]
+        ),
+        'build/account': (
+            lambda inputs: [accounts._get_entity_data(account, None) for account in inputs],
+            account_inputs
+        ),
+        'resolve/system': (
+            lambda inputs: [
+                tag_policy.POLICY.resolve(tag_policy.get_tag_values(tags), system='mock_system').system
+                for tags in inputs
+            ],
+            [_make_resource_tags(i) for i in range(count)]
+        ),
+        'serialize/account': (
+            lambda inputs: [json.dumps(account, cls=JSONDateTimeEncoder) for account in inputs],
+            account_inputs
+        ),
+        'serialize/entity': (
+            lambda inputs: [json.dumps(entity) for entity in inputs],
+            entities
+        ),
+        'serialize/envelope': (pack_entities, entities),
+        'parse/account': (
+            lambda inputs: [AccountTypeWithTags(**json.loads(body)) for body in inputs],
+            account_bodies
+        ),
+        'parse/entity': (
+            lambda inputs: [Entity(**json.loads(body)) for body in inputs],
+            entity_bodies
+        ),
+        'parse/envelope': (
+            lambda inputs: [entity for body in inputs for entity in unpack_entities(body)],
+            pack_entities(entities)
+        ),
+    }
+
+
+@pytest.mark.parametrize('count', ENTITY_COUNTS)
+def test_entities(
+    count: int,
+    handlers: Dict[str, ModuleType],
+    compare_to_baseline: Callable[[str, Dict[str, float], Dict[str, float]], None],
+):
+    '''Measure per-entity cost of building, resolving tags for, serializing and parsing entities'''
+    for name, (run, inputs) in _get_cases(handlers, count).items():
+        compare_to_baseline(
+            'entities/{}/{}'.format(name, count),
+            _measure(run, inputs, count),
+            MICROBENCHMARK_TOLERANCES
+        )
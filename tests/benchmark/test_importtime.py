@@ -0,0 +1,95 @@
+'''Benchmark handler cold-start import cost'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+import os
+import subprocess
+import sys
+from typing import Callable, Dict, List, Tuple
+
+import pytest
+
+pytestmark = pytest.mark.benchmark
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+HANDLERS = sorted(
+    name for name in os.listdir(os.path.join(ROOT_DIR, 'src', 'handlers'))
+    if os.path.exists(os.path.join(ROOT_DIR, 'src', 'handlers', name, 'function.py'))
+)
+IMPORTTIME_TOLERANCES = {
+    'import_ms': 1.5,
+}
+# Clients a handler may create at import. Everything else is created on first use.
+CLIENTS_AT_IMPORT = {
+    # The idempotency persistence layer takes its client when it is created.
+    'AddEntityToCatalog': 1,
+}
+# Modules to report when a handler's import cost regresses.
+REPORT_MODULES = 10
+
+# Import a handler in a fresh interpreter and count the AWS clients it left behind.
+# NOTE: -X importtime does not see importlib.import_module() so use an import statement.
+IMPORT_SCRIPT = '''
+import src.handlers.{}.function
+import gc, json
+from botocore.client import BaseClient
+print(json.dumps({{'clients': sum(isinstance(o, BaseClient) for o in gc.get_objects())}}))
+'''
+
+
+def _import_handler(name: str) -> Tuple[Dict[str, int], str]:
+    '''Import a handler in a new interpreter and return its output and import profile'''
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([os.path.join(ROOT_DIR, 'src', 'common'), ROOT_DIR]),
+        AWS_DEFAULT_REGION='us-east-1',
+    )
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT.format(name)],
+        cwd=ROOT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr
+
+
+def _parse_importtime(profile: str) -> List[Tuple[str, int, int]]:
+    '''Return (module, self us, cumulative us) for each line of an -X importtime profile'''
+    modules = []
+    for line in profile.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented under the module that imported them.
+        modules.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+@pytest.mark.parametrize('name', HANDLERS)
+def test_importtime(
+    name: str,
+    compare_to_baseline: Callable[[str, Dict[str, float], Dict[str, float]], None],
+):
+    '''Measure the cost of importing a handler in a cold interpreter'''
+    # The first import compiles bytecode, which Lambda deployments ship with.
+    _import_handler(name)
+    output, profile = _import_handler(name)
+
+    modules = _parse_importtime(profile)
+    # Top-level lines cover everything the handler import pulled in.
+    import_us = sum(
+        cumulative_us for module, _, cumulative_us in modules
+        if not module.startswith(' ') and module.split('.')[0] == 'src'
+    )
+    slowest = sorted(modules, key=lambda module: module[1], reverse=True)[:REPORT_MODULES]
+    print('\n'.join('{:>8} us  {}'.format(self_us, module.strip()) for module, self_us, _ in slowest))
+
+    assert output['clients'] <= CLIENTS_AT_IMPORT.get(name, 0), \
+        '{} created {} AWS clients at import'.format(name, output['clients'])
+    compare_to_baseline(
+        'importtime/{}'.format(name),
+        {'import_ms': import_us / 1000},
+        IMPORTTIME_TOLERANCES
+    )
@@ -0,0 +1,50 @@
+'''Benchmark the collection pipeline end to end'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from typing import Callable, Dict
+
+import pytest
+
+from tests.benchmark.conftest import PIPELINE_TOLERANCES, BenchmarkResult, SyntheticOrg
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.mark.parametrize(
+    'scenario, accounts, vpcs, clusters, buckets, functions',
+    [
+        ('small', 5, 3, 2, 4, 4),
+        ('medium', 20, 5, 3, 10, 10),
+    ]
+)
+def test_pipeline(
+    scenario: str,
+    accounts: int,
+    vpcs: int,
+    clusters: int,
+    buckets: int,
+    functions: int,
+    make_synthetic_org: Callable[[int, int, int, int, int], SyntheticOrg],
+    run_pipeline: Callable[[], BenchmarkResult],
+    compare_to_baseline: Callable[[str, Dict[str, float], Dict[str, float]], None],
+    mock_state_table_name: str,
+):
+    '''Drive ListAccounts through AddEntityToCatalog for a synthetic organization'''
+    from common.util import sweep
+
+    org = make_synthetic_org(accounts, vpcs, clusters, buckets, functions)
+    result = run_pipeline()
+
+    # Every account, VPC, instance, cluster, service, bucket and function reached the catalog and the
+    # sweep completed.
+    assert result['entities'] == (
+        len(org['accounts']) + org['vpcs'] + org['instances'] + org['clusters'] + org['services']
+        + org['buckets'] + org['functions']
+    )
+    assert sweep.get_last_completed(mock_state_table_name) is not None
+
+    compare_to_baseline(
+        'pipeline/{}'.format(scenario),
+        {key: result[key] for key in PIPELINE_TOLERANCES},  # type: ignore[literal-required]
+        PIPELINE_TOLERANCES
+    )
@@ -4,10 +4,15 @@
 import os
 import sys
 import json
-from collections import namedtuple
-from typing import TYPE_CHECKING, cast, Any, Callable
+from collections import Counter, namedtuple
+from typing import TYPE_CHECKING, cast, Any, Callable, Dict, Generator
+
+from boto3 import Session
+from botocore.client import BaseClient
 
 import pytest
+from pytest_mock import MockerFixture
+from moto import mock_aws
 
 if TYPE_CHECKING:
     from aws_lambda_powertools.utilities.typing import LambdaContext
@@ -30,6 +35,105 @@ RESPONSE_DATA_SCHEMA_FILE_NAME = 'response-data.schema.json'
 # ref: https://github.com/pytest-dev/pytest/issues/2421#issuecomment-403724503
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# AWS mocks
+@pytest.fixture()
+def mock_aws_credentials() -> None:
+    '''Mocked AWS Credentials for moto.'''
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+
+@pytest.fixture()
+def mocked_aws(mock_aws_credentials):
+    '''Mock all AWS interactions'''
+    with mock_aws():
+        yield
+
+@pytest.fixture()
+def mocked_aws_session(mocked_aws) -> Generator[Session, None, None]:
+    '''Mock all AWS interactions'''
+    yield Session()
+
+@pytest.fixture()
+def make_mocked_client(
+    mocked_aws_session: Session,
+) -> Generator[Callable[[str], BaseClient], None, None]:
+    '''Mock an AWS service client'''
+    def _make_client(service_name: str) -> BaseClient:
+        return mocked_aws_session.client(service_name)    # type: ignore
+    yield _make_client
+
+@pytest.fixture()
+def mock_state_table_name(make_mocked_client: Callable) -> str:
+    '''Create a mock collector state table'''
+    table_name = 'mock-state-table'
+    ddb_client = make_mocked_client('dynamodb')
+    ddb_client.create_table(
+        TableName=table_name,
+        AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return table_name
+
+
+# Call budgets
+class CallCounts:
+    '''AWS and catalog calls made during a test
+
+    Calls are keyed <service>.<operation>, such as ecs.ListClusters, and catalog calls
+    catalog.<route>, such as catalog.GetSystem.
+    '''
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+
+    def count(self, key: str) -> int:
+        '''Return the calls to a service, such as ecs, or an operation, such as ecs.ListClusters'''
+        return sum(n for call, n in self.calls.items() if call == key or call.startswith(key + '.'))
+
+    def clear(self) -> None:
+        '''Forget calls made so far'''
+        self.calls.clear()
+
+    def assert_within(self, budget: Dict[str, int]) -> None:
+        '''Fail when calls to any service or operation exceed their budget'''
+        exceeded = [
+            '{}: {} calls > budget {}'.format(key, self.count(key), limit)
+            for key, limit in budget.items()
+            if self.count(key) > limit
+        ]
+        assert not exceeded, 'Call budget exceeded:\n{}\nCalls: {}'.format(
+            '\n'.join(exceeded),
+            dict(sorted(self.calls.items()))
+        )
+
+@pytest.fixture()
+def call_counts(mocked_aws, mocker: MockerFixture) -> Generator[CallCounts, None, None]:
+    '''Count AWS calls made through moto and catalog calls made through the catalog session'''
+    from moto.core.botocore_stubber import BotocoreStubber
+    from common.util import catalog
+
+    counts = CallCounts()
+    stubber_call = BotocoreStubber.__call__
+    catalog_record = catalog._record
+
+    def _stubber_call(self, event_name: str, request: Any, **kwargs: Any) -> Any:
+        # event_name is before-send.<service>.<operation>
+        counts.calls[event_name.split('.', 1)[1]] += 1
+        return stubber_call(self, event_name, request, **kwargs)
+
+    def _record(route: str, *args: Any, **kwargs: Any) -> None:
+        counts.calls['catalog.{}'.format(route)] += 1
+        catalog_record(route, *args, **kwargs)
+
+    # Patching the stubber catches clients handlers create themselves, such as cross-account ones.
+    mocker.patch.object(BotocoreStubber, '__call__', _stubber_call)
+    mocker.patch.object(catalog, '_record', _record)
+    yield counts
+
+
 @pytest.fixture()
 def lambda_function_name(request: pytest.FixtureRequest) -> str:
     '''Return the name of the Lambda function being tested'''
@@ -37,9 +141,9 @@ def lambda_function_name(request: pytest.FixtureRequest) -> str:
 
 
 @pytest.fixture()
-def mock_context() -> Callable[[str], 'LambdaContext']:
+def mock_context() -> Callable[..., 'LambdaContext']:
     '''context object'''
-    def _make_context(function_name: str) -> 'LambdaContext':
+    def _make_context(function_name: str, remaining_time_in_millis: int = 0) -> 'LambdaContext':
         context_info = {
             'aws_request_id': '00000000-0000-0000-0000-000000000000',
             'function_name': function_name,
@@ -51,7 +155,7 @@ def mock_context() -> Callable[[str], 'LambdaContext']:
             'identity': None,
             'tenant_id': None,
             'client_context': None,
-            'get_remaining_time_in_millis': lambda: 0
+            'get_remaining_time_in_millis': lambda: remaining_time_in_millis
         }
 
         Context = namedtuple('LambdaContext', context_info.keys())
@@ -0,0 +1,53 @@
+'''Test the AWS client registry'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from types import ModuleType
+from typing import Callable, Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def aws(mocked_aws, mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the aws module'''
+    from common.util import aws
+    mocker.patch.dict(aws._CLIENTS, clear=True)
+    mocker.patch.object(aws, '_SESSION', None)
+    yield aws
+
+
+class TestCode:
+    '''Code tests'''
+    def test_get_client(self, aws: ModuleType):
+        '''Test clients are created once per service and region from the shared session'''
+        assert not aws._CLIENTS
+
+        client = aws.get_client('sqs')
+        assert aws.get_client('sqs') is client
+        assert aws.get_client('sqs', 'us-west-2') is not client
+        assert aws.get_client('sqs', 'us-west-2').meta.region_name == 'us-west-2'
+        assert aws.get_session() is aws.get_session()
+
+    def test_get_client_instrumented(self, aws: ModuleType, make_mocked_client: Callable):
+        '''Test calls through registry clients are recorded'''
+        from common.util import instrumentation
+
+        make_mocked_client('sqs').create_queue(QueueName='mock-queue')
+        instrumentation._OPERATION_STATS.clear()
+        aws.get_client('sqs').list_queues()
+        assert len(instrumentation._OPERATION_STATS[('SQS', 'ListQueues')].latencies) == 1
+        instrumentation._OPERATION_STATS.clear()
+
+    def test_get_cross_account_client(self, aws: ModuleType, make_mocked_client: Callable):
+        '''Test cross-account clients use the assumed role credentials'''
+        credentials = make_mocked_client('sts').assume_role(
+            RoleArn='arn:aws:iam::123456789012:role/mock-role',
+            RoleSessionName='test'
+        )['Credentials']
+
+        client = aws.get_cross_account_client('ec2', credentials, 'us-west-2')
+        assert client.meta.region_name == 'us-west-2'
+        assert client._request_signer._credentials.access_key == credentials['AccessKeyId']
+        assert aws.get_cross_account_client('ec2', credentials, 'us-west-2') is not client
+        assert not aws._CLIENTS
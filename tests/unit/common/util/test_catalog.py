@@ -0,0 +1,147 @@
+'''Test catalog requests'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from types import ModuleType
+from typing import Generator
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from common.util import catalog as catalog_module
+
+
+class MockCatalogHandler(BaseHTTPRequestHandler):
+    '''Answer every GET with a small JSON body over a kept-alive connection'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"spec": {"owner": "owner"}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def catalog(mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the catalog module'''
+    mocker.patch.dict(catalog_module._ROUTE_STATS, clear=True)
+    mocker.patch.dict(catalog_module._SYSTEM_OWNERS, clear=True)
+    yield catalog_module
+
+
+@pytest.fixture()
+def mock_endpoint() -> Generator[str, None, None]:
+    '''Serve a mock catalog on localhost'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockCatalogHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def _get_emf_documents(output: str) -> list[dict]:
+    '''Return the EMF documents written to stdout'''
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+class TestCode:
+    '''Code tests'''
+    def test_request(self, catalog: ModuleType, mock_endpoint: str):
+        '''Test requests are recorded by route and reuse connections'''
+        for _ in range(3):
+            r = catalog.request('GET', mock_endpoint + '/default/system/mock', catalog.ROUTE_GET_SYSTEM)
+            assert r.ok
+
+        stats = catalog._ROUTE_STATS[catalog.ROUTE_GET_SYSTEM]
+        assert len(stats.latencies) == 3
+        assert stats.response_bytes == 3 * len(r.content)
+        assert stats.status_classes == {'2xx': 3}
+        assert stats.connections_new == 1
+        assert stats.connections_reused == 2
+
+    def test_request_status_classes(self, catalog: ModuleType):
+        '''Test responses are counted by status class'''
+        with requests_mock.Mocker() as m:
+            m.put('https://api.example.com/catalog/default/resource/a', status_code=200)
+            m.put('https://api.example.com/catalog/default/resource/b', status_code=503)
+            catalog.request('PUT', 'https://api.example.com/catalog/default/resource/a', catalog.ROUTE_PUT_ENTITY)
+            catalog.request('PUT', 'https://api.example.com/catalog/default/resource/b', catalog.ROUTE_PUT_ENTITY)
+
+        stats = catalog._ROUTE_STATS[catalog.ROUTE_PUT_ENTITY]
+        assert stats.status_classes == {'2xx': 1, '5xx': 1}
+        # requests-mock responses have no connection pool to inspect.
+        assert stats.connections_new == stats.connections_reused == 0
+
+    def test_request_slow_call(self, catalog: ModuleType, mocker: MockerFixture):
+        '''Test slow calls are logged with their entity'''
+        mocker.patch.object(catalog, 'CATALOG_SLOW_CALL_MS', 0)
+        warning = mocker.spy(catalog.LOGGER, 'warning')
+        with requests_mock.Mocker() as m:
+            m.put(requests_mock.ANY, status_code=200)
+            catalog.request(
+                'PUT',
+                'https://api.example.com/catalog/default/resource/a',
+                catalog.ROUTE_PUT_ENTITY,
+                entity_ref='resource:default/a'
+            )
+
+        warning.assert_called_once()
+        assert warning.call_args.kwargs['extra']['entity_ref'] == 'resource:default/a'
+        assert warning.call_args.kwargs['extra']['route'] == catalog.ROUTE_PUT_ENTITY
+
+    def test_get_entity_name(self, catalog: ModuleType):
+        '''Test entity names are unique by resource ID and fit the catalog's limit'''
+        arn = 'arn:aws:lambda:us-east-1:123456789012:function:{}'
+        name = catalog.get_entity_name('lambda-function', 'mock-function', arn.format('mock-function'))
+        other_region_name = catalog.get_entity_name(
+            'lambda-function', 'mock-function', arn.format('mock-function').replace('us-east-1', 'us-west-2')
+        )
+        assert name != other_region_name
+        assert name.startswith('lambda-function-mock-function-')
+
+        long_function_name = 'a' * 37 + '-' + 'b' * 26
+        name = catalog.get_entity_name('lambda-function', long_function_name, arn.format(long_function_name))
+        assert len(name) <= catalog.ENTITY_NAME_MAX_LENGTH
+        # The shortened name does not end in a separator.
+        assert name.startswith('lambda-function-{}-'.format('a' * 37))
+        assert '--' not in name
+
+    def test_cache_system_owner(self, catalog: ModuleType, mocker: MockerFixture):
+        '''Test system owners are looked up once per system until the cache expires'''
+        lookup = mocker.Mock(side_effect=lambda system, auth: '{}-owner'.format(system))
+        get_system_owner = catalog.cache_system_owner(lookup)
+
+        assert get_system_owner('system-1', None) == 'system-1-owner'
+        assert get_system_owner('system-1', None) == 'system-1-owner'
+        assert get_system_owner('system-2', None) == 'system-2-owner'
+        assert lookup.call_count == 2
+
+        mocker.patch.object(catalog, 'SYSTEM_OWNER_CACHE_SECONDS', 0)
+        get_system_owner('system-1', None)
+        assert lookup.call_count == 3
+
+    def test_flush_metrics(self, catalog: ModuleType, mock_endpoint: str, capsys: pytest.CaptureFixture):
+        '''Test recorded requests are written as EMF and reset'''
+        for _ in range(2):
+            catalog.request('GET', mock_endpoint + '/default/system/mock', catalog.ROUTE_GET_SYSTEM)
+        capsys.readouterr()
+
+        catalog.flush_metrics()
+        documents = _get_emf_documents(capsys.readouterr().out)
+
+        assert len(documents) == 1
+        assert documents[0]['Route'] == catalog.ROUTE_GET_SYSTEM
+        assert documents[0]['CatalogCalls'] == [2.0]
+        assert documents[0]['CatalogResponses2xx'] == [2.0]
+        assert documents[0]['CatalogConnectionReuse'] == [50.0]
+        assert catalog._ROUTE_STATS == {}
@@ -0,0 +1,80 @@
+'''Test claim-check offload'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from types import ModuleType
+from typing import Callable, Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def mock_bucket_name(make_mocked_client: Callable) -> str:
+    '''Create a mock claim-check bucket'''
+    bucket_name = 'mock-claim-check-bucket'
+    make_mocked_client('s3').create_bucket(Bucket=bucket_name)
+    return bucket_name
+
+
+@pytest.fixture()
+def claim_check(mock_bucket_name: str, mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the claim_check module'''
+    from common.util import claim_check
+    mocker.patch.object(claim_check, 'CLAIM_CHECK_BUCKET_NAME', mock_bucket_name)
+    mocker.patch.object(claim_check, 'CLAIM_CHECK_THRESHOLD_BYTES', 64)
+    claim_check._get_object.cache_clear()
+    yield claim_check
+    claim_check._get_object.cache_clear()
+
+
+class TestCode:
+    '''Code tests'''
+    def test_offload_small_body(self, claim_check: ModuleType):
+        '''Test bodies under the threshold are returned unchanged'''
+        body = json.dumps({'Id': '123456789012'})
+        assert claim_check.offload(body) == body
+        assert claim_check.resolve(body) == body
+
+    def test_offload_large_body(
+        self,
+        claim_check: ModuleType,
+        mock_bucket_name: str,
+        make_mocked_client: Callable
+    ):
+        '''Test bodies over the threshold are stored in S3'''
+        body = json.dumps({'Id': '123456789012', 'Tags': ['tag'] * 100})
+        pointer = claim_check.offload(body)
+
+        assert claim_check.is_pointer(pointer)
+        assert json.loads(pointer)['ClaimCheck']['Bucket'] == mock_bucket_name
+        assert json.loads(pointer)['ClaimCheck']['Size'] == len(body)
+        assert len(make_mocked_client('s3').list_objects_v2(Bucket=mock_bucket_name)['Contents']) == 1
+        assert claim_check.resolve(pointer) == body
+
+    def test_offload_content_addressed(
+        self,
+        claim_check: ModuleType,
+        mock_bucket_name: str,
+        make_mocked_client: Callable
+    ):
+        '''Test identical bodies share an object'''
+        body = json.dumps({'Id': '123456789012', 'Tags': ['tag'] * 100})
+        assert claim_check.offload(body) == claim_check.offload(body)
+        assert len(make_mocked_client('s3').list_objects_v2(Bucket=mock_bucket_name)['Contents']) == 1
+
+    def test_offload_disabled(self, claim_check: ModuleType, mocker: MockerFixture):
+        '''Test bodies are not offloaded without a bucket'''
+        mocker.patch.object(claim_check, 'CLAIM_CHECK_BUCKET_NAME', '')
+        body = json.dumps({'Id': '123456789012', 'Tags': ['tag'] * 100})
+        assert claim_check.offload(body) == body
+
+    def test_resolve_cached(self, claim_check: ModuleType, mocker: MockerFixture):
+        '''Test pointers to the same object are downloaded once'''
+        body = json.dumps({'Id': '123456789012', 'Tags': ['tag'] * 100})
+        pointer = claim_check.offload(body)
+        get_object = mocker.spy(claim_check.aws.get_client('s3'), 'get_object')
+
+        assert claim_check.resolve(pointer) == body
+        assert claim_check.resolve(pointer) == body
+        assert get_object.call_count == 1
@@ -0,0 +1,103 @@
+'''Test deadline-aware work splitting'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from types import ModuleType
+from typing import Any
+from unittest.mock import MagicMock
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def continuation(mocked_aws) -> ModuleType:
+    '''Return the continuation module'''
+    from common.util import continuation
+    return continuation
+
+
+@pytest.fixture()
+def mock_account() -> dict[str, Any]:
+    '''Return a mock account'''
+    return {
+        'Id': '123456789012',
+        'Name': 'mock',
+        'Tags': [],
+    }
+
+
+class TestCode:
+    '''Code tests'''
+    def test_deadline_reserves_unit_cost(self, continuation: ModuleType):
+        '''Test the deadline leaves time for the longest unit of work seen'''
+        context = MagicMock()
+        context.get_remaining_time_in_millis.side_effect = [10000, 7000, 3500]
+        deadline = continuation.Deadline(context, 1000)
+
+        assert deadline.expired() is False
+        # 3000 ms of work between checks; 7000 ms left covers another unit and the margin.
+        assert deadline.expired() is False
+        assert deadline.unit_ms == 3000
+        # 3500 ms left does not.
+        assert deadline.expired() is True
+
+    def test_make_continuation(self, continuation: ModuleType):
+        '''Test cursors only carry the parts they are given'''
+        assert continuation.make_continuation('us-east-1') == {'Region': 'us-east-1'}
+        assert continuation.make_continuation('us-east-1', 'page-2', 'cluster-1') == {
+            'Region': 'us-east-1',
+            'Cluster': 'cluster-1',
+            'NextToken': 'page-2'
+        }
+
+    def test_get_remaining_regions(self, continuation: ModuleType):
+        '''Test regions resume at the continuation's region and page'''
+        regions = ['us-east-1', 'us-west-2', 'eu-west-1']
+
+        assert continuation.get_remaining_regions(regions, None) == (regions, None)
+        assert continuation.get_remaining_regions(
+            regions,
+            continuation.make_continuation('us-west-2', 'page-2')
+        ) == (['us-west-2', 'eu-west-1'], 'page-2')
+
+    def test_get_remaining_regions_unknown_region(self, continuation: ModuleType):
+        '''Test a continuation for a region no longer collected starts over'''
+        regions = ['us-east-1', 'us-west-2']
+
+        assert continuation.get_remaining_regions(
+            regions,
+            continuation.make_continuation('ap-south-1', 'page-2')
+        ) == (regions, None)
+
+
+    def test_send_continuation_counts_deferrals(
+        self,
+        continuation: ModuleType,
+        mock_account: dict[str, Any],
+        mocker: MockerFixture
+    ):
+        '''Test delayed continuations are counted and dropped past the limit'''
+        mocker.patch.object(continuation, 'MAX_DEFERRALS', 2)
+        send_message = mocker.patch.object(continuation.sqs, 'send_message')
+
+        def _send(account_info: dict[str, Any], delay_seconds: int) -> dict[str, Any]:
+            send_message.reset_mock()
+            continuation.send_continuation(
+                account_info,
+                continuation.make_continuation('us-east-1'),
+                'mock-queue-url',
+                delay_seconds
+            )
+            return json.loads(send_message.call_args.args[1]) if send_message.called else {}
+
+        account_info = _send(mock_account, 300)
+        assert account_info['Continuation']['Deferrals'] == 1
+        # Continuing at the deadline carries the count without adding to it.
+        account_info = _send(account_info, 0)
+        assert account_info['Continuation']['Deferrals'] == 1
+        account_info = _send(account_info, 300)
+        assert account_info['Continuation']['Deferrals'] == 2
+
+        assert _send(account_info, 300) == {}
+        send_message.assert_not_called()
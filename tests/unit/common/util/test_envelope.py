@@ -0,0 +1,89 @@
+'''Test entity envelopes'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from hashlib import sha256
+from typing import Any, List
+
+import pytest
+
+from common.util import envelope
+
+
+@pytest.fixture()
+def mock_entities() -> List[dict[str, Any]]:
+    '''Return mock entities'''
+    return [
+        {
+            'apiVersion': 'backstage.io/v1alpha1',
+            'kind': 'Resource',
+            'metadata': {
+                'namespace': 'default',
+                'name': 'resource-{}'.format(i),
+                'annotations': {},
+            },
+            'spec': {'type': 'aws-vpc', 'owner': 'owner'},
+        }
+        for i in range(50)
+    ]
+
+
+class TestCode:
+    '''Code tests'''
+    def test_pack_entities(self, mock_entities: List[dict[str, Any]]):
+        '''Test entities are packed into a single envelope'''
+        envelopes = envelope.pack_entities(mock_entities, max_entities=len(mock_entities))
+        assert len(envelopes) == 1
+        assert json.loads(envelopes[0])['Encoding'] == envelope.ENCODING_JSON
+        assert envelope.unpack_entities(envelopes[0]) == mock_entities
+
+    def test_pack_entities_compressed(self, mock_entities: List[dict[str, Any]]):
+        '''Test entities are packed into a compressed envelope'''
+        envelopes = envelope.pack_entities(mock_entities, use_compression=True, max_entities=len(mock_entities))
+        assert len(envelopes) == 1
+        assert json.loads(envelopes[0])['Encoding'] == envelope.ENCODING_ZLIB
+        assert len(envelopes[0]) < len(envelope.pack_entities(mock_entities, max_entities=len(mock_entities))[0])
+        assert envelope.unpack_entities(envelopes[0]) == mock_entities
+
+    @pytest.mark.parametrize('use_compression', [False, True])
+    def test_pack_entities_splits(self, mock_entities: List[dict[str, Any]], use_compression: bool):
+        '''Test envelopes are split to fit the size limit'''
+        max_bytes = 2048
+        envelopes = envelope.pack_entities(mock_entities, use_compression, max_bytes)
+        assert len(envelopes) > 1
+        assert all(len(e.encode()) <= max_bytes for e in envelopes)
+
+        unpacked = [entity for e in envelopes for entity in envelope.unpack_entities(e)]
+        assert unpacked == mock_entities
+
+    def test_pack_entities_max_entities(self, mock_entities: List[dict[str, Any]]):
+        '''Test envelopes hold at most the entity limit'''
+        envelopes = envelope.pack_entities(mock_entities, max_entities=20)
+        assert [len(envelope.unpack_entities(e)) for e in envelopes] == [20, 20, 10]
+
+    @pytest.mark.parametrize('use_compression', [False, True])
+    def test_pack_entities_not_claim_checked(self, mock_entities: List[dict[str, Any]], use_compression: bool):
+        '''Test full envelopes stay under the claim-check threshold'''
+        from common.util import claim_check
+        # Unique, incompressible descriptions so compressed envelopes fill too.
+        entities = [
+            {**entity, 'metadata': {**entity['metadata'], 'description': sha256(str(i).encode()).hexdigest() * 32}}
+            for i, entity in enumerate(mock_entities * 40)
+        ]
+        envelopes = envelope.pack_entities(entities, use_compression, max_entities=len(entities))
+        assert len(envelopes) > 1
+        for e in envelopes:
+            assert claim_check.offload(e, 'mock-bucket') == e
+
+    def test_pack_entities_oversized_entity(self, mock_entities: List[dict[str, Any]]):
+        '''Test an entity larger than the limit is sent alone'''
+        envelopes = envelope.pack_entities(mock_entities[:2], max_bytes=64)
+        assert len(envelopes) == 2
+
+    def test_pack_entities_empty(self):
+        '''Test no envelopes are returned for no entities'''
+        assert envelope.pack_entities([]) == []
+
+    def test_unpack_entities_bare_entity(self, mock_entities: List[dict[str, Any]]):
+        '''Test a message that is not an envelope is a single entity'''
+        assert envelope.unpack_entities(json.dumps(mock_entities[0])) == [mock_entities[0]]
@@ -0,0 +1,120 @@
+'''Test AWS API call instrumentation'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from types import ModuleType
+from typing import Callable, Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def instrumentation(mocked_aws, mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the instrumentation module'''
+    from common.util import instrumentation
+    mocker.patch.dict(instrumentation._OPERATION_STATS, clear=True)
+    yield instrumentation
+
+
+def _get_emf_documents(output: str) -> list[dict]:
+    '''Return the EMF documents written to stdout'''
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
+class TestCode:
+    '''Code tests'''
+    def test_instrument_client(self, instrumentation: ModuleType, make_mocked_client: Callable):
+        '''Test calls made by an instrumented client are recorded per operation'''
+        client = instrumentation.instrument_client(make_mocked_client('sqs'))
+        client.list_queues()
+        client.list_queues()
+        client.create_queue(QueueName='mock-queue')
+
+        stats = instrumentation._OPERATION_STATS
+        assert len(stats[('SQS', 'ListQueues')].latencies) == 2
+        assert len(stats[('SQS', 'CreateQueue')].latencies) == 1
+
+    def test_instrument_client_errors(self, instrumentation: ModuleType, make_mocked_client: Callable):
+        '''Test failed calls are recorded'''
+        from botocore.exceptions import ClientError
+
+        client = instrumentation.instrument_client(make_mocked_client('sqs'))
+        with pytest.raises(ClientError):
+            client.get_queue_url(QueueName='missing-queue')
+
+        stats = instrumentation._OPERATION_STATS[('SQS', 'GetQueueUrl')]
+        assert len(stats.latencies) == 1
+        assert stats.errors == 1
+
+    def test_instrument_client_once(self, instrumentation: ModuleType, make_mocked_client: Callable):
+        '''Test instrumenting a client twice records calls once'''
+        client = instrumentation.instrument_client(
+            instrumentation.instrument_client(make_mocked_client('sqs'))
+        )
+        client.list_queues()
+
+        assert len(instrumentation._OPERATION_STATS[('SQS', 'ListQueues')].latencies) == 1
+
+    def test__needs_retry(self, instrumentation: ModuleType, make_mocked_client: Callable):
+        '''Test throttled attempts are counted'''
+        model = make_mocked_client('sqs').meta.service_model.operation_model('ListQueues')
+        instrumentation._needs_retry(model, (None, {'Error': {'Code': 'ThrottlingException'}}))
+        instrumentation._needs_retry(model, (None, {'Error': {'Code': 'InternalError'}}))
+        instrumentation._needs_retry(model, None)
+
+        assert instrumentation._OPERATION_STATS[('SQS', 'ListQueues')].throttles == 1
+
+    def test_flush_metrics(
+        self,
+        instrumentation: ModuleType,
+        make_mocked_client: Callable,
+        capsys: pytest.CaptureFixture
+    ):
+        '''Test recorded calls are written as EMF and reset'''
+        client = instrumentation.instrument_client(make_mocked_client('sqs'))
+        client.list_queues()
+        capsys.readouterr()
+
+        instrumentation.flush_metrics()
+        documents = _get_emf_documents(capsys.readouterr().out)
+
+        assert len(documents) == 1
+        assert documents[0]['Service'] == 'SQS'
+        assert documents[0]['Operation'] == 'ListQueues'
+        assert documents[0]['ApiCalls'] == [1.0]
+        assert documents[0]['ApiCallThrottles'] == [0.0]
+        assert instrumentation._OPERATION_STATS == {}
+
+    def test_flush_metrics_splits_values(
+        self,
+        instrumentation: ModuleType,
+        make_mocked_client: Callable,
+        capsys: pytest.CaptureFixture,
+        mocker: MockerFixture
+    ):
+        '''Test long latency lists are split across documents'''
+        mocker.patch.object(instrumentation, 'MAX_METRIC_VALUES', 2)
+        client = instrumentation.instrument_client(make_mocked_client('sqs'))
+        for _ in range(3):
+            client.list_queues()
+        capsys.readouterr()
+
+        instrumentation.flush_metrics()
+        documents = _get_emf_documents(capsys.readouterr().out)
+
+        assert len(documents) == 2
+        assert documents[0]['ApiCalls'] == [3.0]
+        assert 'ApiCalls' not in documents[1]
+
+    def test_emit_metrics(self, instrumentation: ModuleType, mocker: MockerFixture):
+        '''Test metrics are flushed when a handler raises'''
+        flush_metrics = mocker.patch.object(instrumentation, 'flush_metrics')
+
+        @instrumentation.emit_metrics
+        def handler(event, context):
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            handler({}, None)
+        flush_metrics.assert_called_once()
@@ -0,0 +1,128 @@
+'''Test handler profiling'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import pstats
+from types import ModuleType
+from typing import Any, Callable, Dict, Generator, List
+
+import pytest
+from pytest_mock import MockerFixture
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+
+@pytest.fixture()
+def mock_bucket_name(make_mocked_client: Callable) -> str:
+    '''Create a mock profile bucket'''
+    bucket_name = 'mock-profile-bucket'
+    make_mocked_client('s3').create_bucket(Bucket=bucket_name)
+    return bucket_name
+
+
+@pytest.fixture()
+def profiling(mock_bucket_name: str, mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the profiling module, enabled for every invocation'''
+    from common.util import profiling
+    mocker.patch.object(profiling, 'PROFILING_ENABLED', True)
+    mocker.patch.object(profiling, 'PROFILING_SAMPLE_RATE', 1.0)
+    mocker.patch.object(profiling, 'PROFILING_TOP_N', 5)
+    mocker.patch.object(profiling, 'PROFILING_BUCKET_NAME', mock_bucket_name)
+    yield profiling
+
+
+@pytest.fixture()
+def mock_handler(profiling: ModuleType) -> Callable[[Dict[str, Any], LambdaContext], Any]:
+    '''Return a profiled handler'''
+    @profiling.profile_handler
+    def _handler(event: Dict[str, Any], context: LambdaContext) -> Any:
+        if event.get('fail'):
+            raise ValueError('handler failed')
+        return sum(i * i for i in range(1000))
+    return _handler
+
+
+def _get_profile_records(info: Any) -> List[Dict[str, Any]]:
+    '''Return the extra fields of logged profiles'''
+    return [c.kwargs['extra'] for c in info.call_args_list if c.args[0] == 'Handler profile']
+
+
+class TestCode:
+    '''Code tests'''
+    def test_profile_handler(
+        self,
+        profiling: ModuleType,
+        mock_handler: Callable,
+        mock_context: Callable[[str], LambdaContext],
+        mock_bucket_name: str,
+        make_mocked_client: Callable,
+        tmp_path,
+        mocker: MockerFixture
+    ):
+        '''Test sampled invocations log their top functions and save the raw profile'''
+        info = mocker.spy(profiling.LOGGER, 'info')
+        assert mock_handler({}, mock_context('MockFunction')) == 332833500
+
+        records = _get_profile_records(info)
+        assert len(records) == 1
+        assert len(records[0]['profile_functions']) <= profiling.PROFILING_TOP_N
+        assert any('_handler' in f['function'] for f in records[0]['profile_functions'])
+        cumulative = [f['cumulative_ms'] for f in records[0]['profile_functions']]
+        assert cumulative == sorted(cumulative, reverse=True)
+
+        key = records[0]['profile_key']
+        assert key == 'profiles/MockFunction/00000000-0000-0000-0000-000000000000.pstats'
+        profile_path = tmp_path / 'profile.pstats'
+        profile_path.write_bytes(
+            make_mocked_client('s3').get_object(Bucket=mock_bucket_name, Key=key)['Body'].read()
+        )
+        assert pstats.Stats(str(profile_path)).total_calls > 0    # type: ignore[attr-defined]
+
+    def test_profile_handler_fails(
+        self,
+        profiling: ModuleType,
+        mock_handler: Callable,
+        mock_context: Callable[[str], LambdaContext],
+        mocker: MockerFixture
+    ):
+        '''Test failed invocations are still profiled'''
+        info = mocker.spy(profiling.LOGGER, 'info')
+        with pytest.raises(ValueError):
+            mock_handler({'fail': True}, mock_context('MockFunction'))
+
+        assert len(_get_profile_records(info)) == 1
+
+    def test_profile_handler_disabled(
+        self,
+        profiling: ModuleType,
+        mock_handler: Callable,
+        mock_context: Callable[[str], LambdaContext],
+        mocker: MockerFixture
+    ):
+        '''Test nothing is profiled when disabled or not sampled'''
+        info = mocker.spy(profiling.LOGGER, 'info')
+        mocker.patch.object(profiling, 'PROFILING_ENABLED', False)
+        mock_handler({}, mock_context('MockFunction'))
+
+        mocker.patch.object(profiling, 'PROFILING_ENABLED', True)
+        mocker.patch.object(profiling, 'PROFILING_SAMPLE_RATE', 0.0)
+        mock_handler({}, mock_context('MockFunction'))
+
+        assert not _get_profile_records(info)
+
+    def test_profile_handler_without_bucket(
+        self,
+        profiling: ModuleType,
+        mock_handler: Callable,
+        mock_context: Callable[[str], LambdaContext],
+        mocker: MockerFixture
+    ):
+        '''Test profiles are only logged without a bucket, and failed saves do not fail the handler'''
+        info = mocker.spy(profiling.LOGGER, 'info')
+        mocker.patch.object(profiling, 'PROFILING_BUCKET_NAME', '')
+        mock_handler({}, mock_context('MockFunction'))
+
+        mocker.patch.object(profiling, 'PROFILING_BUCKET_NAME', 'missing-bucket')
+        mock_handler({}, mock_context('MockFunction'))
+
+        records = _get_profile_records(info)
+        assert [record['profile_key'] for record in records] == [None, None]
@@ -0,0 +1,80 @@
+'''Test jittered sweep scheduling'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from time import time
+from types import ModuleType
+from typing import Any, Callable
+
+import pytest
+
+
+@pytest.fixture()
+def schedule(mocked_aws) -> ModuleType:
+    '''Return the schedule module'''
+    from common.util import schedule
+    return schedule
+
+
+@pytest.fixture()
+def mock_sqs_queue_url(make_mocked_client: Callable) -> str:
+    '''Mock SQS Queue URL'''
+    return make_mocked_client('sqs').create_queue(QueueName='mock-queue')['QueueUrl']
+
+
+@pytest.fixture()
+def mock_account() -> dict[str, Any]:
+    '''Return a mock account'''
+    return {
+        'Id': '123456789012',
+        'Name': 'mock',
+        'Tags': [],
+    }
+
+
+class TestCode:
+    '''Code tests'''
+    def test_get_schedule_offsets(self, schedule: ModuleType):
+        '''Test accounts are started at a steady rate'''
+        account_ids = ['{:012d}'.format(i) for i in range(10)]
+        offsets = schedule.get_schedule_offsets(account_ids, 2, 3600)
+
+        assert sorted(offsets.values()) == [i * 30 for i in range(10)]
+        # Same accounts land in the same slots every sweep.
+        assert schedule.get_schedule_offsets(list(reversed(account_ids)), 2, 3600) == offsets
+
+    def test_get_schedule_offsets_fits_interval(self, schedule: ModuleType):
+        '''Test accounts are compressed into the interval when the rate is too slow'''
+        account_ids = ['{:012d}'.format(i) for i in range(10)]
+        offsets = schedule.get_schedule_offsets(account_ids, 1, 300)
+
+        assert max(offsets.values()) < 300
+
+    def test_defer_until_due(
+        self,
+        schedule: ModuleType,
+        mock_account: dict[str, Any],
+        mock_sqs_queue_url: str,
+        make_mocked_client: Callable,
+    ):
+        '''Test accounts not yet due are re-enqueued with a capped delay'''
+        mock_account['NotBefore'] = int(time()) + 3600
+        assert schedule.defer_until_due(mock_account, mock_sqs_queue_url) is True
+
+        sqs_client = make_mocked_client('sqs')
+        attributes = sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+    def test_defer_until_due_when_due(
+        self,
+        schedule: ModuleType,
+        mock_account: dict[str, Any],
+        mock_sqs_queue_url: str,
+    ):
+        '''Test due and unscheduled accounts are processed immediately'''
+        assert schedule.defer_until_due(mock_account, mock_sqs_queue_url) is False
+
+        mock_account['NotBefore'] = int(time()) - 1
+        assert schedule.defer_until_due(mock_account, mock_sqs_queue_url) is False
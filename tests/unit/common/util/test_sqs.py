@@ -0,0 +1,54 @@
+'''Test SQS messaging'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from types import ModuleType
+from typing import Callable, Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def sqs(mocked_aws, mocker: MockerFixture) -> Generator[ModuleType, None, None]:
+    '''Return the sqs module'''
+    from common.util import sqs
+    mocker.patch.dict(sqs._QUEUE_DEPTH_SAMPLES, clear=True)
+    yield sqs
+
+
+@pytest.fixture()
+def mock_sqs_queue_url(make_mocked_client: Callable) -> str:
+    '''Mock SQS Queue URL'''
+    return make_mocked_client('sqs').create_queue(QueueName='mock-queue')['QueueUrl']
+
+
+class TestCode:
+    '''Code tests'''
+    def test_send_message_clamps_delay(self, sqs: ModuleType, mock_sqs_queue_url: str, mocker: MockerFixture):
+        '''Test delays are clamped to what SQS accepts'''
+        send_message = mocker.spy(sqs.aws.get_client('sqs'), 'send_message')
+        sqs.send_message(mock_sqs_queue_url, 'body', 3600)
+        assert send_message.call_args.kwargs['DelaySeconds'] == sqs.MAX_DELAY_SECONDS
+
+    def test_get_queue_depth(self, sqs: ModuleType, mock_sqs_queue_url: str, mocker: MockerFixture):
+        '''Test queue depth is sampled and cached'''
+        get_queue_attributes = mocker.spy(sqs.aws.get_client('sqs'), 'get_queue_attributes')
+        for _ in range(3):
+            sqs.send_message(mock_sqs_queue_url, 'body')
+
+        assert sqs.get_queue_depth(mock_sqs_queue_url) == 3
+        sqs.send_message(mock_sqs_queue_url, 'body')
+        assert sqs.get_queue_depth(mock_sqs_queue_url) == 3
+        assert get_queue_attributes.call_count == 1
+
+        mocker.patch.object(sqs, 'QUEUE_DEPTH_CACHE_SECONDS', 0)
+        assert sqs.get_queue_depth(mock_sqs_queue_url) == 4
+        assert get_queue_attributes.call_count == 2
+
+    def test_is_backed_up(self, sqs: ModuleType, mock_sqs_queue_url: str):
+        '''Test queues deeper than the threshold are backed up'''
+        for _ in range(3):
+            sqs.send_message(mock_sqs_queue_url, 'body')
+
+        assert sqs.is_backed_up(mock_sqs_queue_url, 3) is False
+        assert sqs.is_backed_up(mock_sqs_queue_url, 2) is True
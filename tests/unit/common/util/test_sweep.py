@@ -0,0 +1,126 @@
+'''Test sweep generation tracking'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from types import ModuleType
+from typing import Any
+
+import pytest
+
+SWEEP_ANNOTATION = 'io.serverlessops/sweep-id'
+
+
+@pytest.fixture()
+def sweep(mocked_aws) -> ModuleType:
+    '''Return the sweep module'''
+    from common.util import sweep
+    return sweep
+
+
+def _mock_entity(sweep_id: Any = None) -> dict:
+    '''Return a minimal entity'''
+    annotations = {} if sweep_id is None else {SWEEP_ANNOTATION: sweep_id}
+    return {
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': {'namespace': 'default', 'name': 'mock', 'annotations': annotations},
+        'spec': {}
+    }
+
+
+class TestCode:
+    '''Code tests'''
+    def test_stamp_entity(self, sweep: ModuleType):
+        '''Test stamp_entity function'''
+        entity = sweep.stamp_entity(_mock_entity(), '100')   # type: ignore
+        assert entity['metadata']['annotations'][sweep.SWEEP_ANNOTATION] == '100'
+        assert sweep.get_entity_generation(entity) == 100
+
+    def test_stamp_entity_without_sweep(self, sweep: ModuleType):
+        '''Test stamp_entity function without a sweep ID'''
+        entity = sweep.stamp_entity(_mock_entity(), None)   # type: ignore
+        assert sweep.SWEEP_ANNOTATION not in entity['metadata']['annotations']
+        assert sweep.get_entity_generation(entity) is None
+
+    def test_get_entity_generation_invalid(self, sweep: ModuleType):
+        '''Test get_entity_generation ignores malformed generations'''
+        assert sweep.get_entity_generation(_mock_entity('not-a-number')) is None   # type: ignore
+
+    def test_complete_account(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test sweep completes once every collector completes every account'''
+        sweep.start_sweep(mock_state_table_name, '100', ['111111111111', '222222222222'], ['A', 'B'])
+
+        assert sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111') is False
+        # Redelivered completions are only counted once
+        assert sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111') is False
+        assert sweep.complete_account(mock_state_table_name, '100', 'B', '111111111111') is False
+        assert sweep.complete_account(mock_state_table_name, '100', 'A', '222222222222') is False
+        assert sweep.get_last_completed(mock_state_table_name) is None
+
+        assert sweep.complete_account(mock_state_table_name, '100', 'B', '222222222222') is True
+        last_sweep = sweep.get_last_completed(mock_state_table_name)
+        assert last_sweep is not None
+        assert last_sweep['Generation'] == 100
+
+    def test_complete_account_counts(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test completions are counted on the sweep rather than listed on it'''
+        from common.util import aws
+        sweep.start_sweep(mock_state_table_name, '100', ['111111111111', '222222222222'], ['A'])
+        sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111')
+        sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111')
+
+        item = aws.get_client('dynamodb').get_item(
+            TableName=mock_state_table_name,
+            Key={'pk': {'S': 'sweep#100'}}
+        )['Item']
+        assert item['Completed'] == {'N': '1'}
+
+    def test_complete_account_unknown_sweep(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test completing an account for a sweep that was never started'''
+        assert sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111') is False
+
+    def test_older_sweep_does_not_replace_newer(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test an older sweep finishing late does not move the last completed generation back'''
+        sweep.start_sweep(mock_state_table_name, '100', ['111111111111'], ['A'])
+        sweep.start_sweep(mock_state_table_name, '200', ['111111111111'], ['A'])
+
+        sweep.complete_account(mock_state_table_name, '200', 'A', '111111111111')
+        sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111')
+
+        last_sweep = sweep.get_last_completed(mock_state_table_name)
+        assert last_sweep is not None
+        assert last_sweep['Generation'] == 200
+
+    def test_partial_sweep(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test a partial sweep records which accounts it scanned'''
+        sweep.start_sweep(
+            mock_state_table_name,
+            '100',
+            ['111111111111'],
+            ['A'],
+            ['111111111111', '222222222222']
+        )
+        sweep.complete_account(mock_state_table_name, '100', 'A', '111111111111')
+
+        last_sweep = sweep.get_last_completed(mock_state_table_name)
+        assert last_sweep is not None
+        assert last_sweep['Accounts'] == ['111111111111']
+        assert sorted(last_sweep['OrgAccounts']) == ['111111111111', '222222222222']
+        assert sweep.get_org_accounts(mock_state_table_name, '100') == {'111111111111', '222222222222'}
+        assert sweep.get_org_accounts(mock_state_table_name, '101') is None
+
+    def test_shared_participants(self, sweep: ModuleType, mock_state_table_name: str):
+        '''Test participants in shared resources are merged across sweeps'''
+        owner = '111111111111'
+        sweep.add_participant(mock_state_table_name, '100', 'vpc', owner, ['vpc-1', 'vpc-2'], '222222222222')
+        sweep.add_participant(mock_state_table_name, '100', 'vpc', owner, ['vpc-1'], '333333333333')
+        sweep.add_participant(mock_state_table_name, '101', 'vpc', owner, ['vpc-1'], '222222222222')
+        sweep.add_participant(mock_state_table_name, '101', 'vpc', owner, [], '444444444444')
+
+        assert sweep.get_participants(mock_state_table_name, ['101'], 'vpc', owner) == {
+            'vpc-1': {'222222222222'},
+        }
+        assert sweep.get_participants(mock_state_table_name, ['101', '100'], 'vpc', owner) == {
+            'vpc-1': {'222222222222', '333333333333'},
+            'vpc-2': {'222222222222'},
+        }
+        assert sweep.get_participants(mock_state_table_name, ['101'], 'vpc', '222222222222') == {}
@@ -0,0 +1,69 @@
+'''Test tag policy'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from types import ModuleType
+from typing import Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def tag_policy() -> Generator[ModuleType, None, None]:
+    '''Return the tag_policy module'''
+    from common.util import tag_policy
+    yield tag_policy
+
+
+class TestCode:
+    '''Code tests'''
+    def test_get_tag_values(self, tag_policy: ModuleType):
+        '''Test tags are read in either key casing'''
+        assert tag_policy.get_tag_values([
+            {'Key': 'org:system', 'Value': 'system'},
+            {'key': 'org:domain', 'value': 'domain'},
+            {'Key': 'empty'},
+        ]) == {'org:system': 'system', 'org:domain': 'domain', 'empty': ''}
+
+    def test_get_account_tag_values(self, tag_policy: ModuleType):
+        '''Test an account's own tags win over inherited ones'''
+        assert tag_policy.get_account_tag_values({
+            'Tags': [{'Key': 'org:system', 'Value': 'account'}],
+            'InheritedTags': [{'Key': 'org:system', 'Value': 'ou'}, {'Key': 'org:owner', 'Value': 'group:ou'}],
+        }) == {'org:system': 'account', 'org:owner': 'group:ou'}
+        assert tag_policy.get_account_tag_values({'Tags': []}) == {}
+
+    def test_resolve(self, tag_policy: ModuleType):
+        '''Test the default policy'''
+        policy = tag_policy.TagPolicy(tag_policy.DEFAULT_TAG_POLICY)
+        assert policy.resolve({'org:system': 'a'}, system='b', lifecycle='available') == ('a', None, 'available')
+        assert policy.resolve({'org:system': ''}, system='b') == ('b', None, None)
+        assert policy.resolve({}) == ('UNKNOWN', None, None)
+
+    def test_resolve_rules(self, tag_policy: ModuleType):
+        '''Test ordered keys, rewrites and defaults'''
+        policy = tag_policy.TagPolicy({
+            'system': {
+                'keys': ['org:system', 'system'],
+                'rewrites': [
+                    {'pattern': r'^\s+|\s+$', 'replacement': ''},
+                    {'pattern': r'[^a-z0-9-]+', 'replacement': '-'},
+                ],
+                'default': 'UNKNOWN'
+            },
+            'owner': {'keys': ['org:owner']},
+            'lifecycle': {'keys': ['org:lifecycle'], 'default': 'production'},
+        })
+        assert policy.resolve({'system': 'b', 'org:system': ' my_system '}) == ('my-system', None, 'production')
+        assert policy.resolve({'system': 'b', 'org:owner': 'group:a'}) == ('b', 'group:a', 'production')
+        assert policy.resolve({'org:lifecycle': 'experimental'}, lifecycle='available') == \
+            ('UNKNOWN', None, 'experimental')
+
+    def test_resolve_memoized(self, tag_policy: ModuleType, mocker: MockerFixture):
+        '''Test resolutions are shared by tag sets that only differ in tags the policy ignores'''
+        policy = tag_policy.TagPolicy(tag_policy.DEFAULT_TAG_POLICY)
+        resolve_values = mocker.spy(policy, '_resolve_values')
+        for i in range(100):
+            policy.resolve({'org:system': 'system-{}'.format(i % 2), 'Name': 'resource-{}'.format(i)})
+
+        assert resolve_values.call_count == 2
@@ -0,0 +1,46 @@
+'''Test bulk tag lookups'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+from types import ModuleType
+from typing import Callable, Generator
+
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture()
+def tags(mocked_aws) -> Generator[ModuleType, None, None]:
+    '''Return the tags module'''
+    from common.util import tags
+    yield tags
+
+
+class TestCode:
+    '''Code tests'''
+    def test_get_tag_index(
+        self,
+        tags: ModuleType,
+        make_mocked_client: Callable,
+        mocker: MockerFixture
+    ):
+        '''Test every tagged resource is indexed by ARN across pages'''
+        mocker.patch.object(tags, 'TAG_INDEX_PAGE_SIZE', 2)
+        s3_client = make_mocked_client('s3')
+        for i in range(5):
+            s3_client.create_bucket(Bucket='bucket-{}'.format(i))
+            if i % 2 == 0:
+                s3_client.put_bucket_tagging(
+                    Bucket='bucket-{}'.format(i),
+                    Tagging={'TagSet': [{'Key': 'org:system', 'Value': 'system-{}'.format(i)}]}
+                )
+
+        client = make_mocked_client('resourcegroupstaggingapi')
+        get_resources = mocker.spy(client, 'get_resources')
+        index = tags.get_tag_index(client, ['s3'])
+
+        assert index == {
+            'arn:aws:s3:::bucket-0': {'org:system': 'system-0'},
+            'arn:aws:s3:::bucket-2': {'org:system': 'system-2'},
+            'arn:aws:s3:::bucket-4': {'org:system': 'system-4'},
+        }
+        assert get_resources.call_count >= 2
@@ -2,7 +2,7 @@
 # pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
 from time import time
 from types import ModuleType
-from typing import Any, Callable, Generator
+from typing import TYPE_CHECKING, Any, Callable, Generator
 import jsonschema
 
 import pytest
@@ -13,6 +13,13 @@ from aws_lambda_powertools.utilities.typing import LambdaContext
 
 from common.model.entity import Entity
 from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
+
+# Plenty of time for a batch.
+REMAINING_TIME_MS = 900000
 
 
 # Requests
@@ -51,6 +58,9 @@ def mock_auth(
 # Function
 @pytest.fixture()
 def mock_fn(
+    lambda_function_name: str,
+    mock_context: Callable[..., LambdaContext],
+    mock_state_table_name: str,
     mock_endpoint: str,
     mock_auth: JwtAuth,
     requests_mocker: requests_mock.Mocker,
@@ -70,6 +80,17 @@ def mock_fn(
         mock_endpoint
     )
 
+    mocker.patch(
+        'src.handlers.AddEntityToCatalog.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    mocker.patch.object(fn.PERSISTENCE_STORE, 'table_name', mock_state_table_name)
+    # Tests calling _main directly still need the in-progress record to expire with the invocation.
+    mocker.patch.object(fn.IDEMPOTENCY_CONFIG, 'lambda_context', mock_context(lambda_function_name, REMAINING_TIME_MS))
+    # Reconfigure so each test starts with an empty local cache.
+    mocker.patch.object(fn.PERSISTENCE_STORE, 'configured', False)
+
     # We can also use requests_mocker within tests too if necessary
     with requests_mocker:
         requests_mocker.register_uri(
@@ -80,6 +101,16 @@ def mock_fn(
         yield fn
 
 
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
 class TestData:
     '''Data validation tests'''
     def test_validate_data(self, mock_event_data: dict[str, Any], mock_event_data_schema: dict[str, Any]):
@@ -154,6 +185,163 @@ class TestCode:
 
         mock_fn._main(mock_event_data)
 
+    def test__main_idempotent(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: Entity,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _main function skips duplicate entity versions'''
+        import copy
+        from common.util import sweep
+
+        mock_fn._main(mock_event_data)
+        mock_fn._main(copy.deepcopy(mock_event_data))
+        assert requests_mocker.call_count == 1
+
+        # A new sweep generation is the same version of the entity; the sweep is recorded as seeing it.
+        stamped_entity = copy.deepcopy(mock_event_data)
+        stamped_entity['metadata']['annotations'] = {}
+        mock_fn._main(sweep.stamp_entity(stamped_entity, '1735935664'))
+        assert requests_mocker.call_count == 1
+        assert sweep.get_seen_generations(
+            mock_fn.STATE_TABLE_NAME,
+            [mock_fn._get_entity_ref(stamped_entity)]
+        ) == {mock_fn._get_entity_ref(stamped_entity): 1735935664}
+
+        # A change to the entity is a new version.
+        changed_entity = copy.deepcopy(stamped_entity)
+        changed_entity['metadata']['description'] = 'changed'
+        mock_fn._main(changed_entity)
+        assert requests_mocker.call_count == 2
+
+    def test__main_retries_failed(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: Entity,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _main function does not record failed entity versions'''
+        requests_mocker.register_uri(
+            requests_mock.PUT,
+            requests_mock.ANY,
+            [{'status_code': 500}, {'status_code': 200}],
+        )
+
+        with pytest.raises(mock_fn.AddEntityToCatalogError):
+            mock_fn._main(mock_event_data)
+        mock_fn._main(mock_event_data)
+        assert requests_mocker.call_count == 2
+
+    def test__process_record(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        mock_deadline: 'Deadline',
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _process_record function unpacks an envelope'''
+        import copy
+        from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+        from common.util.envelope import pack_entities
+
+        other_entity = copy.deepcopy(mock_event_data)
+        other_entity['metadata']['name'] = 'other-entity'
+        record = SQSRecord(mock_event['Records'][0])
+        record._data['body'] = pack_entities([mock_event_data, other_entity])[0]
+        mock_fn._process_record(record, mock_deadline)
+
+        assert requests_mocker.call_count == 2
+
+    def test__process_record_claim_check(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        mock_deadline: 'Deadline',
+        make_mocked_client: Callable,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _process_record function resolves offloaded envelopes'''
+        from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+        from common.util import claim_check
+        from common.util.envelope import pack_entities
+
+        make_mocked_client('s3').create_bucket(Bucket='mock-claim-check-bucket')
+        record = SQSRecord(mock_event['Records'][0])
+        record._data['body'] = claim_check.offload(
+            pack_entities([mock_event_data])[0],
+            'mock-claim-check-bucket',
+            1
+        )
+        assert claim_check.is_pointer(record.body)
+        mock_fn._process_record(record, mock_deadline)
+
+        assert requests_mocker.call_count == 1
+
+    def test__process_record_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        mock_deadline: 'Deadline',
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _process_record function reports failed entities'''
+        import copy
+        from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+        from common.util.envelope import pack_entities
+
+        failing_entity = copy.deepcopy(mock_event_data)
+        failing_entity['metadata']['name'] = 'failing-entity'
+        requests_mocker.register_uri(
+            requests_mock.PUT,
+            '/'.join([
+                mock_fn.CATALOG_ENDPOINT,
+                failing_entity['metadata']['namespace'],
+                failing_entity['kind'].lower(),
+                failing_entity['metadata']['name']
+            ]),
+            status_code=500,
+        )
+
+        record = SQSRecord(mock_event['Records'][0])
+        record._data['body'] = pack_entities([mock_event_data, failing_entity])[0]
+        with pytest.raises(mock_fn.AddEntitiesToCatalogError) as e:
+            mock_fn._process_record(record, mock_deadline)
+
+        assert 'failing-entity' in str(e.value)
+        assert str(e.value).endswith('/failing-entity')
+        assert requests_mocker.call_count == 2
+
+    def test__process_record_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        mocker: MockerFixture,
+    ):
+        '''Test _process_record function leaves entities for retry at the deadline'''
+        import copy
+        from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+        from common.util.envelope import pack_entities
+
+        other_entity = copy.deepcopy(mock_event_data)
+        other_entity['metadata']['name'] = 'other-entity'
+        record = SQSRecord(mock_event['Records'][0])
+        record._data['body'] = pack_entities([mock_event_data, other_entity])[0]
+        deadline = mock_fn.Deadline(mock_context(lambda_function_name, 10000), 1000)
+        mocker.patch.object(deadline, 'expired', side_effect=[False, True])
+        with pytest.raises(mock_fn.AddEntitiesToCatalogError) as e:
+            mock_fn._process_record(record, deadline)
+
+        assert str(e.value).endswith('/other-entity')
+        assert requests_mocker.call_count == 1
+
     def test_handler(
         self,
         lambda_function_name: str,
@@ -165,7 +353,6 @@ class TestCode:
     ):
         '''Test calling handler'''
         import json
-        from aws_lambda_powertools.utilities.data_classes import SQSEvent
 
         # Call the function
         mocker.patch.object(
@@ -176,6 +363,98 @@ class TestCode:
             token='token'
         )
 
-        mock_event_sqs = SQSEvent(mock_event)
-        mock_event_sqs._data['Records'][0]['body'] = json.dumps(mock_event_data)
-        mock_fn.handler(mock_event_sqs, mock_context(lambda_function_name))
\ No newline at end of file
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        response = mock_fn.handler(mock_event, mock_context(lambda_function_name, REMAINING_TIME_MS))
+        assert response == {'batchItemFailures': []}
+
+    def test_handler_reports_failed_records(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test handler reports records with failed entities'''
+        import copy
+        from common.util.envelope import pack_entities
+
+        failing_entity = copy.deepcopy(mock_event_data)
+        failing_entity['metadata']['name'] = 'failing-entity'
+        requests_mocker.register_uri(
+            requests_mock.PUT,
+            requests_mock.ANY,
+            status_code=500,
+        )
+        requests_mocker.register_uri(
+            requests_mock.PUT,
+            '/'.join([
+                mock_fn.CATALOG_ENDPOINT,
+                mock_event_data['metadata']['namespace'],
+                mock_event_data['kind'].lower(),
+                mock_event_data['metadata']['name']
+            ]),
+            status_code=200,
+        )
+
+        failing_record = copy.deepcopy(mock_event['Records'][0])
+        failing_record['messageId'] = 'failing-message'
+        failing_record['body'] = pack_entities([failing_entity])[0]
+        mock_event['Records'][0]['body'] = pack_entities([mock_event_data])[0]
+        mock_event['Records'].append(failing_record)
+
+        response = mock_fn.handler(mock_event, mock_context(lambda_function_name, REMAINING_TIME_MS))
+        assert response == {'batchItemFailures': [{'itemIdentifier': 'failing-message'}]}
+
+    def test_handler_fails_entire_batch(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test handler raises when every record fails'''
+        from aws_lambda_powertools.utilities.batch.exceptions import BatchProcessingError
+        from common.util.envelope import pack_entities
+
+        requests_mocker.register_uri(
+            requests_mock.PUT,
+            requests_mock.ANY,
+            status_code=500,
+        )
+
+        mock_event['Records'][0]['body'] = pack_entities([mock_event_data])[0]
+        with pytest.raises(BatchProcessingError):
+            mock_fn.handler(mock_event, mock_context(lambda_function_name, REMAINING_TIME_MS))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: Entity,
+        mock_event: dict[str, Any],
+        call_counts: CallCounts,
+    ):
+        '''Test calls per entity, including the idempotency record'''
+        import copy
+        from common.util.envelope import pack_entities
+
+        entities = []
+        for i in range(5):
+            entity = copy.deepcopy(mock_event_data)
+            entity['metadata']['name'] = 'entity-{}'.format(i)
+            entities.append(entity)
+        mock_event['Records'][0]['body'] = pack_entities(entities)[0]
+
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, REMAINING_TIME_MS))
+
+        call_counts.assert_within({
+            'catalog.PutEntity': len(entities),
+            # Saving the idempotency record in progress, then its result.
+            'dynamodb': 2 * len(entities),
+        })
@@ -1,6 +1,7 @@
 '''Test ListAccounts'''
 # pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
 
+from time import time
 from types import ModuleType
 from typing import Callable, Any, Generator, List
 import jsonschema
@@ -14,6 +15,8 @@ from mypy_boto3_sns import SNSClient
 
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
+from tests.conftest import CallCounts
+
 ### Fixtures
 # AWS Clients
 #
@@ -86,6 +89,7 @@ def mock_account_tags(
 @pytest.fixture()
 def mock_fn(
     mock_sns_topic_arn: str,
+    mock_state_table_name: str,
     mocker: MockerFixture
 ) -> Generator[ModuleType, None, None]:
     '''Return mocked function'''
@@ -97,6 +101,11 @@ def mock_fn(
         mock_sns_topic_arn
     )
 
+    mocker.patch(
+        'src.handlers.ListAccounts.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
     yield fn
 
 
@@ -122,6 +131,48 @@ class TestCode:
         assert account_with_tags['Tags'] == mock_account_tags
 
 
+    def test__add_inherited_tags(
+        self,
+        mock_fn: ModuleType,
+        mock_orgs_client: OrganizationsClient,
+        mock_account: AccountTypeDef,
+    ):
+        '''Test accounts inherit tags from the nearest OU or root that has them'''
+        root_id = mock_orgs_client.list_roots()['Roots'][0]['Id']
+        mock_orgs_client.tag_resource(
+            ResourceId=root_id,
+            Tags=[{'Key': 'org:owner', 'Value': 'group:root'}, {'Key': 'org:system', 'Value': 'root'}]
+        )
+        parent_ou_id = mock_orgs_client.create_organizational_unit(
+            ParentId=root_id,
+            Name='parent',
+            Tags=[{'Key': 'org:system', 'Value': 'parent'}, {'Key': 'other', 'Value': 'ignored'}]
+        )['OrganizationalUnit']['Id']
+        child_ou_id = mock_orgs_client.create_organizational_unit(
+            ParentId=parent_ou_id,
+            Name='child'
+        )['OrganizationalUnit']['Id']
+        account_id = mock_account.get('Id', '')
+        mock_orgs_client.move_account(AccountId=account_id, SourceParentId=root_id, DestinationParentId=child_ou_id)
+
+        parents, containers = mock_fn._get_org_tree()
+        assert parents[account_id] == child_ou_id
+        assert parents[child_ou_id] == parent_ou_id
+        assert parents[parent_ou_id] == root_id
+        assert set(containers) == {root_id, parent_ou_id, child_ou_id}
+
+        accounts = mock_fn._add_inherited_tags(mock_fn._get_account_tags(mock_fn._list_all_accounts()))
+        inherited_tags = {account['Id']: account['InheritedTags'] for account in accounts}
+        assert inherited_tags[account_id] == [
+            {'Key': 'org:system', 'Value': 'parent'},
+            {'Key': 'org:owner', 'Value': 'group:root'},
+        ]
+        # The management account sits under the root.
+        assert {'Key': 'org:system', 'Value': 'root'} in [
+            tag for tags in inherited_tags.values() for tag in tags
+        ]
+
+
     @pytest.mark.usefixtures("mock_organization")
     def test__list_all_accounts(
         self,
@@ -138,6 +189,25 @@ class TestCode:
         assert mock_account.get('Id') in account_ids
 
 
+    @pytest.mark.usefixtures("mock_organization")
+    def test__list_all_accounts_pages(
+        self,
+        mock_fn: ModuleType,
+        mock_orgs_client: OrganizationsClient,
+    ):
+        '''Test accounts on every page are listed'''
+        for i in range(25):
+            mock_orgs_client.create_account(
+                AccountName='account-{}'.format(i),
+                Email='account-{}@example.com'.format(i)
+            )
+        accounts = mock_fn._list_all_accounts()
+
+        # The management account is listed too.
+        assert len(accounts) == 26
+        assert len({account['Id'] for account in accounts}) == 26
+
+
     def test__publish_accounts(
         self,
         mock_fn: ModuleType,
@@ -149,6 +219,101 @@ class TestCode:
         assert len(response) > 0
 
 
+    def test__start_sweep(
+        self,
+        mock_fn: ModuleType,
+        mock_account: AccountTypeDef,
+        mock_state_table_name: str,
+    ):
+        '''Test _start_sweep function'''
+        from common.util import sweep
+
+        account_with_tags = mock_fn._get_account_tags([mock_account])[0]
+        accounts = mock_fn._start_sweep([account_with_tags], [account_with_tags])
+        sweep_id = accounts[0]['SweepId']
+
+        for collector in mock_fn.SWEEP_COLLECTORS:
+            sweep.complete_account(mock_state_table_name, sweep_id, collector, mock_account.get('Id', ''))
+
+        last_sweep = sweep.get_last_completed(mock_state_table_name)
+        assert last_sweep is not None
+        assert last_sweep['Generation'] == int(sweep_id)
+
+
+    def test__get_account_tier(
+        self,
+        mock_fn: ModuleType,
+        mock_account: AccountTypeDef,
+    ):
+        '''Test _get_account_tier function'''
+        account_with_tags = mock_fn._get_account_tags([mock_account])[0]
+        assert mock_fn._get_account_tier(account_with_tags) == mock_fn.DEFAULT_TIER
+
+        account_with_tags['Tags'].append({'Key': mock_fn.TIER_TAG_KEY, 'Value': 'sandbox'})
+        assert mock_fn._get_account_tier(account_with_tags) == 'sandbox'
+
+        account_with_tags['Status'] = 'SUSPENDED'
+        assert mock_fn._get_account_tier(account_with_tags) == mock_fn.SUSPENDED_TIER
+
+
+    def test__get_due_accounts(
+        self,
+        mock_fn: ModuleType,
+        mock_account: AccountTypeDef,
+        mocker: MockerFixture
+    ):
+        '''Test _get_due_accounts function'''
+        mocker.patch.object(mock_fn, 'TIER_INTERVALS', {'sandbox': 86400})
+        account_with_tags = mock_fn._get_account_tags([mock_account])[0]
+        account_with_tags['Tags'].append({'Key': mock_fn.TIER_TAG_KEY, 'Value': 'sandbox'})
+        account_id = account_with_tags['Id']
+
+        # Never scanned
+        assert mock_fn._get_due_accounts([account_with_tags], {}) == [account_with_tags]
+        # Scanned recently
+        assert mock_fn._get_due_accounts([account_with_tags], {account_id: int(time())}) == []
+        # Scanned a day ago
+        assert mock_fn._get_due_accounts(
+            [account_with_tags],
+            {account_id: int(time()) - 86400}
+        ) == [account_with_tags]
+
+
+    @pytest.mark.usefixtures("mock_organization")
+    def test__main_records_scans(
+        self,
+        mock_fn: ModuleType,
+        mock_account: AccountTypeDef,
+        mocker: MockerFixture
+    ):
+        '''Test _main function only publishes accounts that are due'''
+        mocker.patch.object(mock_fn, 'TIER_INTERVALS', {mock_fn.DEFAULT_TIER: 86400})
+        publish = mocker.spy(mock_fn, '_publish_accounts')
+
+        mock_fn._main()
+        assert mock_account.get('Id') in mock_fn._get_scan_index()
+        assert publish.call_count == 1
+
+        mock_fn._main()
+        assert publish.call_count == 1
+
+
+    def test__schedule_accounts(
+        self,
+        mock_fn: ModuleType,
+        mock_account: AccountTypeDef,
+        mocker: MockerFixture
+    ):
+        '''Test _schedule_accounts function'''
+        account_with_tags = mock_fn._get_account_tags([mock_account])[0]
+        assert 'NotBefore' not in mock_fn._schedule_accounts([account_with_tags])[0]
+
+        mocker.patch.object(mock_fn, 'SCHEDULE_MODE', 'jittered')
+        accounts = mock_fn._schedule_accounts([account_with_tags])
+        assert 'NotBefore' in accounts[0]
+
+
+    @pytest.mark.usefixtures("mock_organization")
     def test__main(
         self,
         mock_fn: ModuleType,
@@ -157,6 +322,7 @@ class TestCode:
         mock_fn._main()
 
 
+    @pytest.mark.usefixtures("mock_organization")
     def test_handler(
         self,
         lambda_function_name: str,
@@ -166,4 +332,39 @@ class TestCode:
     ):
         '''Test calling handler'''
         # Call the function
-        mock_fn.handler(mock_event, mock_context(lambda_function_name))
\ No newline at end of file
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event: dict,
+        mock_orgs_client: OrganizationsClient,
+        call_counts: CallCounts,
+    ):
+        '''Test calls per sweep'''
+        accounts = 5
+        mock_orgs_client.create_organization(FeatureSet='ALL')
+        for i in range(accounts):
+            mock_orgs_client.create_account(
+                AccountName='account-{}'.format(i),
+                Email='account-{}@example.com'.format(i)
+            )
+
+        # The management account is listed too.
+        accounts += 1
+
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+        call_counts.assert_within({
+            'organizations.ListAccounts': 1,
+            'organizations.ListRoots': 1,
+            # The tree costs a call per child type for each OU, here just the root.
+            'organizations.ListChildren': 2,
+            # Organizations has no bulk tag lookup so tags cost one call per account and OU.
+            'organizations.ListTagsForResource': accounts + 1,
+            'dynamodb': 3,
+            'sns.Publish': accounts,
+        })
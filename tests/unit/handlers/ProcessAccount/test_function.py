@@ -16,7 +16,9 @@ from mypy_boto3_sqs import SQSClient
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
 from common.model.account import AccountTypeWithTags
+from common.util.continuation import MAX_DEFERRALS
 from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
 
 
 # AWS
@@ -69,6 +71,7 @@ def mock_auth(
 @pytest.fixture()
 def mock_fn(
     mock_sqs_queue_url,
+    mock_state_table_name,
     mock_endpoint,
     mock_auth,
     requests_mocker: requests_mock.Mocker,
@@ -78,6 +81,8 @@ def mock_fn(
     import src.handlers.ProcessAccount.function as fn
 
     # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+
     mocker.patch(
         'src.handlers.ProcessAccount.function.JWT',
         mock_auth
@@ -93,6 +98,16 @@ def mock_fn(
         mock_sqs_queue_url
     )
 
+    mocker.patch(
+        'src.handlers.ProcessAccount.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessAccount.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
     # We can also use requests_mocker within tests too if necessary
     with requests_mocker:
         requests_mocker.register_uri(
@@ -140,6 +155,16 @@ class TestCode:
         assert entity['spec']['owner'] == 'owner'
         assert entity['spec']['type'] == 'cloud-account'
         assert entity['spec']['lifecycle'] == 'ACTIVE'
+        assert entity['spec']['system'] == 'mock_system'
+
+        # Accounts without a system tag take the one inherited from their OU.
+        untagged_account = AccountTypeWithTags({
+            **mock_event_data,
+            'Tags': [],
+            'InheritedTags': [{'Key': 'org:system', 'Value': 'ou_system'}]
+        })
+        entity = mock_fn._get_entity_data(untagged_account, mock_auth)
+        assert entity['spec']['system'] == 'ou_system'
 
     def test__get_system_owner(
         self,
@@ -231,4 +256,73 @@ class TestCode:
         )
 
         mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
-        mock_fn.handler(mock_event, mock_context(lambda_function_name))
\ No newline at end of file
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+    ):
+        '''Test accounts of the same system share an owner lookup'''
+        accounts = 3
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        record = mock_event['Records'][0]
+        mock_event['Records'] = []
+        for i in range(accounts):
+            mock_event_data['Id'] = '{:012d}'.format(i)
+            mock_event['Records'].append(dict(record, messageId=str(i), body=json.dumps(mock_event_data)))
+
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+        call_counts.assert_within({
+            'catalog.GetSystem': 1,
+            'sqs.SendMessage': accounts,
+        })
+
+    def test_handler_defers_when_backed_up(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test calling handler while the catalog queue is backed up'''
+        main = mocker.patch('src.handlers.ProcessAccount.function._main')
+        mocker.patch('src.handlers.ProcessAccount.function.sqs.is_backed_up', return_value=True)
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+        main.assert_not_called()
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+        # Deferrals are counted, and the account is dropped once it has been deferred too many times.
+        send_message = mocker.spy(mock_fn.sqs, 'send_message')
+        mock_event['Records'][0]['body'] = json.dumps({**mock_event_data, 'Continuation': {'Deferrals': 1}})
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+        assert json.loads(send_message.call_args.args[1])['Continuation'] == {'Deferrals': 2}
+
+        send_message.reset_mock()
+        mock_event['Records'][0]['body'] = json.dumps({**mock_event_data, 'Continuation': {'Deferrals': MAX_DEFERRALS}})
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+        send_message.assert_not_called()
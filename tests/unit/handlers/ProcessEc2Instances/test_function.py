@@ -0,0 +1,446 @@
+'''Test ProcessEc2Instances'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from time import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Generator
+import jsonschema
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from mypy_boto3_ec2 import EC2Client
+from mypy_boto3_ec2.type_defs import InstanceTypeDef
+from mypy_boto3_sqs import SQSClient
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.account import AccountTypeWithTags
+from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
+
+# AWS
+MOCK_IMAGE_ID = 'ami-12c6146b'
+
+@pytest.fixture()
+def mock_ec2_client(make_mocked_client: Callable) -> Generator[EC2Client, None, None]:
+    '''Mock EC2 Client'''
+    yield make_mocked_client('ec2')
+
+@pytest.fixture()
+def mock_instance(mock_ec2_client) -> InstanceTypeDef:
+    '''Return a mock EC2 instance'''
+    return mock_ec2_client.run_instances(
+        ImageId=MOCK_IMAGE_ID,
+        MinCount=1,
+        MaxCount=1,
+        TagSpecifications=[{
+            'ResourceType': 'instance',
+            'Tags': [{'Key': 'org:system', 'Value': 'system-1'}, {'Key': 'Name', 'Value': 'mock-instance'}]
+        }]
+    )['Instances'][0]
+
+@pytest.fixture()
+def mock_sqs_client(make_mocked_client: Callable) -> Generator[SQSClient, None, None]:
+    '''Mock SQS Client'''
+    yield make_mocked_client('sqs')
+
+@pytest.fixture()
+def mock_sqs_queue_url(mock_sqs_client) -> str:
+    '''Mock SQS Queue URL'''
+    queue = mock_sqs_client.create_queue(QueueName='mock-queue')
+    return queue['QueueUrl']
+
+
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
+# Requests
+@pytest.fixture()
+def requests_mocker() -> requests_mock.Mocker:
+    '''Return a requests mock'''
+    # NOTE: Use as a decerator with Python 3 appears broken so use fixture.
+    # ref. https://github.com/pytest-dev/pytest/issues/2749
+    return requests_mock.Mocker()
+
+@pytest.fixture()
+def mock_endpoint() -> str:
+    '''Return a mock endpoint'''
+    return 'https://api.example.com/catalog'
+
+@pytest.fixture()
+def mock_auth(
+    mocker: MockerFixture,
+    requests_mocker: requests_mock.Mocker,
+) -> Generator[JwtAuth, None, None]:
+    '''Yield a JWT Auth object'''
+    requests_mocker.register_uri(
+        requests_mock.POST,
+        AUTH_ENDPOINT,
+        status_code=200,
+        json={'access_token': 'token'}
+    )
+
+    jwt = JwtAuth('clientId', 'clientSecret')
+    mocker.patch.object(jwt, 'token', 'jwt-token')
+    mocker.patch.object(jwt, 'expiration', int(time()) + 600)
+
+    yield jwt
+
+
+# Function
+@pytest.fixture()
+def mock_fn(
+    mock_sqs_queue_url,
+    mock_state_table_name,
+    mock_endpoint,
+    mock_auth,
+    requests_mocker: requests_mock.Mocker,
+    mocker: MockerFixture
+) -> Generator[ModuleType, None, None]:
+    '''Return mocked function'''
+    import src.handlers.ProcessEc2Instances.function as fn
+
+    # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+
+    mocker.patch(
+        'src.handlers.ProcessEc2Instances.function.JWT',
+        mock_auth
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEc2Instances.function.CATALOG_ENDPOINT',
+        mock_endpoint
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEc2Instances.function.SQS_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEc2Instances.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEc2Instances.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    # We can also use requests_mocker within tests too if necessary
+    with requests_mocker:
+        requests_mocker.register_uri(
+            requests_mock.ANY,
+            requests_mock.ANY,
+            status_code=200,
+        )
+        yield fn
+
+
+class TestData:
+    '''Data validation tests'''
+    def test_validate_data(self, mock_event_data: dict[str, Any], mock_event_data_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event_data, mock_event_data_schema)
+
+    def test_validate_event(self, mock_event: dict[str, Any], mock_event_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event, mock_event_schema)
+
+
+class TestCode:
+    '''Code tests'''
+    def test_GetSystemOwnerError(self, mock_fn: ModuleType):
+        '''Test GetSystemOwnerError class'''
+        e = mock_fn.GetSystemOwnerError('TestSystem')
+        assert str(e) == 'Failed to get owner for system: TestSystem'
+
+    def test__create_ec2_instance_entity(
+        self,
+        mock_fn: ModuleType,
+        mock_instance: InstanceTypeDef,
+        mock_auth: JwtAuth,
+        mocker: MockerFixture
+    ):
+        '''Test _create_ec2_instance_entity function'''
+        mocker.patch(
+            'src.handlers.ProcessEc2Instances.function._get_system_owner',
+            return_value='owner'
+        )
+
+        instance_id = mock_instance['InstanceId']
+        account_id = '123456789012'
+        region = 'us-east-1'
+
+        entity = mock_fn._create_ec2_instance_entity(mock_instance, account_id, region, 'MockSystem', mock_auth)
+        assert entity['kind'] == 'Resource'
+        assert entity['metadata']['name'] == 'ec2-instance-{}'.format(instance_id)
+        assert entity['metadata']['title'] == 'mock-instance'
+        assert entity['metadata']['description'] == 'EC2 instance {} in account {}'.format(instance_id, account_id)
+        assert entity['metadata']['annotations']['aws.amazon.com/account-id'] == account_id
+        assert entity['metadata']['annotations']['aws.amazon.com/arn'] == 'arn:aws:ec2:{}:{}:instance/{}'.format(region, account_id, instance_id)
+        assert entity['metadata']['annotations']['aws.amazon.com/image-id'] == MOCK_IMAGE_ID
+        assert entity['metadata']['annotations']['aws.amazon.com/region'] == region
+        assert entity['spec']['system'] == 'system-1'
+        assert entity['spec']['dependsOn'] == ['resource:default/ec2-vpc-{}'.format(mock_instance['VpcId'])]
+
+        # Untagged instances take their account's system and are titled by ID.
+        entity = mock_fn._create_ec2_instance_entity(
+            {**mock_instance, 'Tags': []}, account_id, region, 'MockSystem', mock_auth
+        )
+        assert entity['spec']['system'] == 'MockSystem'
+        assert entity['metadata']['title'] == instance_id
+
+    def test__get_instance_filters(
+        self,
+        mock_fn: ModuleType,
+        mock_instance: InstanceTypeDef,
+        mock_ec2_client: EC2Client,
+        mocker: MockerFixture
+    ):
+        '''Test _get_instance_filters function'''
+        assert mock_fn._get_instance_filters() == [
+            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+        ]
+
+        mocker.patch.object(mock_fn, 'INSTANCE_TAG_FILTERS', {'org:system': ['system-1'], 'Name': []})
+        filters = mock_fn._get_instance_filters()
+        assert filters[1:] == [
+            {'Name': 'tag:org:system', 'Values': ['system-1']},
+            {'Name': 'tag-key', 'Values': ['Name']},
+        ]
+
+        # Filtered instances are left out of the pages.
+        mock_ec2_client.run_instances(ImageId=MOCK_IMAGE_ID, MinCount=1, MaxCount=1)
+        reservations = mock_ec2_client.describe_instances(Filters=filters)['Reservations']
+        assert [instance['InstanceId'] for r in reservations for instance in r['Instances']] == [
+            mock_instance['InstanceId']
+        ]
+
+    def test__get_system_owner(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+        owner = mock_fn._get_system_owner('mock_system', mock_auth,)
+        assert owner == 'owner'
+
+    def test__get_system_owner_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=403,
+        )
+        with pytest.raises(mock_fn.GetSystemOwnerError):
+            mock_fn._get_system_owner('mock_system', mock_auth,)
+
+    def test__send_queue_messages(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+    ):
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
+
+    def test__main(
+        self,
+        mock_fn: ModuleType,
+        mock_instance: InstanceTypeDef,
+        mock_ec2_client: EC2Client,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mocker: MockerFixture
+    ):
+        '''Test _main function'''
+        mocker.patch(
+            'src.handlers.ProcessEc2Instances.function._get_system_owner',
+            return_value='owner'
+        )
+        send_queue_messages = mocker.patch('src.handlers.ProcessEc2Instances.function._send_queue_messages')
+        # Stopped instances are collected, terminated ones are not.
+        terminated_instance_id = mock_ec2_client.run_instances(
+            ImageId=MOCK_IMAGE_ID,
+            MinCount=1,
+            MaxCount=1
+        )['Instances'][0]['InstanceId']
+        mock_ec2_client.terminate_instances(InstanceIds=[terminated_instance_id])
+        mock_ec2_client.stop_instances(InstanceIds=[mock_instance['InstanceId']])
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        entities = send_queue_messages.call_args.args[0]
+        assert [entity['metadata']['annotations']['aws.amazon.com/instance-id'] for entity in entities] == [
+            mock_instance['InstanceId']
+        ]
+        assert entities[0]['spec']['lifecycle'] == 'stopped'
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_instance: InstanceTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline and enqueues a continuation'''
+        mocker.patch('src.handlers.ProcessEc2Instances.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessEc2Instances.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessEc2Instances.function.sweep.complete_account')
+        ec2_client = mocker.patch('src.handlers.ProcessEc2Instances.function._get_cross_account_ec2_client').return_value
+        ec2_client.describe_instances.side_effect = [
+            {'Reservations': [{'Instances': [mock_instance]}], 'NextToken': 'page-2'},
+            {'Reservations': [{'Instances': [mock_instance]}]},
+        ]
+
+        # mock_context reports no remaining time so only the first page is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'NextToken': 'page-2'}
+
+        # The continuation picks up the remaining page and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert ec2_client.describe_instances.call_args.kwargs['NextToken'] == 'page-2'
+        assert ec2_client.describe_instances.call_args.kwargs['Filters'] == mock_fn._get_instance_filters()
+        assert send_queue_messages.call_count == 2
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessEc2Instances.function.sqs.is_backed_up', return_value=True)
+        complete_account = mocker.patch('src.handlers.ProcessEc2Instances.function.sweep.complete_account')
+        client = mocker.patch('src.handlers.ProcessEc2Instances.function._get_cross_account_ec2_client').return_value
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        client.describe_instances.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+    def test_handler(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mocker: MockerFixture
+    ):
+        '''Test calling handler'''
+        # Call the function
+        mocker.patch.object(
+            mock_fn,
+            'JwtAuth',
+            client_id='clientId',
+            client_secret='clientSecret',
+            token='token'
+        )
+
+        mocker.patch(
+            'src.handlers.ProcessEc2Instances.function._get_system_owner',
+            return_value='owner'
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_ec2_client: EC2Client,
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test calls grow with pages of instances and systems, not with instances'''
+        regions = ['us-east-1', 'us-west-2']
+        systems = 3
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', regions)
+        mocker.patch.object(mock_fn, 'INSTANCE_PAGE_SIZE', 5)
+        for i in range(systems):
+            mock_ec2_client.run_instances(
+                ImageId=MOCK_IMAGE_ID,
+                MinCount=4,
+                MaxCount=4,
+                TagSpecifications=[{
+                    'ResourceType': 'instance',
+                    'Tags': [{'Key': 'org:system', 'Value': 'system-{}'.format(i)}]
+                }]
+            )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        # Pages hold whole reservations so count those, plus the empty region.
+        pages = systems + 1
+        call_counts.assert_within({
+            'sts': 1,
+            'ec2.DescribeInstances': pages,
+            'catalog.GetSystem': systems,
+            'sqs.SendMessage': pages,
+        })
+        assert call_counts.count('ec2') == call_counts.count('ec2.DescribeInstances')
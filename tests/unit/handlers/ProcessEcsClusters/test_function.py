@@ -2,9 +2,10 @@
 # pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
 
 import json
+import math
 from time import time
 from types import ModuleType
-from typing import Any, Callable, Generator, List
+from typing import TYPE_CHECKING, Any, Callable, Generator, List
 import jsonschema
 
 import pytest
@@ -18,7 +19,12 @@ from mypy_boto3_sqs import SQSClient
 from aws_lambda_powertools.utilities.typing import LambdaContext
 
 from common.model.account import AccountTypeWithTags
+from common.util.envelope import MAX_ENVELOPE_ENTITIES
 from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
 
 # AWS
 @pytest.fixture()
@@ -58,6 +64,17 @@ def mock_sqs_queue_url(mock_sqs_client) -> str:
     return queue['QueueUrl']
 
 
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
 # Requests
 @pytest.fixture()
 def requests_mocker() -> requests_mock.Mocker:
@@ -95,6 +112,7 @@ def mock_auth(
 @pytest.fixture()
 def mock_fn(
     mock_sqs_queue_url,
+    mock_state_table_name,
     mock_endpoint,
     mock_auth,
     requests_mocker: requests_mock.Mocker,
@@ -104,6 +122,8 @@ def mock_fn(
     import src.handlers.ProcessEcsClusters.function as fn
 
     # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+
     mocker.patch(
         'src.handlers.ProcessEcsClusters.function.JWT',
         mock_auth
@@ -119,6 +139,16 @@ def mock_fn(
         mock_sqs_queue_url
     )
 
+    mocker.patch(
+        'src.handlers.ProcessEcsClusters.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEcsClusters.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
     # We can also use requests_mocker within tests too if necessary
     with requests_mocker:
         requests_mocker.register_uri(
@@ -203,19 +233,26 @@ class TestCode:
         with pytest.raises(mock_fn.GetSystemOwnerError):
             mock_fn._get_system_owner('mock_system', mock_auth,)
 
-    def test__send_queue_message(
+    def test__send_queue_messages(
         self,
         mock_fn: ModuleType,
         mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
     ):
-        '''Test _send_queue_message function'''
-        response = mock_fn._send_queue_message(mock_event_data)
-        assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
 
     def test__main(
         self,
         mock_fn: ModuleType,
         mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
         mocker: MockerFixture
     ):
         '''Test _main function'''
@@ -232,7 +269,68 @@ class TestCode:
             return_value='owner'
         )
 
-        mock_fn._main(mock_event_data)
+        mock_fn._main(mock_event_data, mock_deadline)
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_ecs_cluster: ClusterTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline and enqueues a continuation'''
+        mocker.patch('src.handlers.ProcessEcsClusters.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessEcsClusters.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessEcsClusters.function.sweep.complete_account')
+        ecs_client = mocker.patch('src.handlers.ProcessEcsClusters.function._get_cross_account_ecs_client').return_value
+        ecs_client.list_clusters.side_effect = [
+            {'clusterArns': [mock_ecs_cluster['clusterArn']], 'nextToken': 'page-2'},
+            {'clusterArns': [mock_ecs_cluster['clusterArn']]},
+        ]
+        ecs_client.describe_clusters.return_value = {'clusters': [mock_ecs_cluster]}
+
+        # mock_context reports no remaining time so only the first page is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'NextToken': 'page-2'}
+
+        # The continuation picks up the remaining page and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert ecs_client.list_clusters.call_args.kwargs['nextToken'] == 'page-2'
+        assert send_queue_messages.call_count == 2
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessEcsClusters.function.sqs.is_backed_up', return_value=True)
+        complete_account = mocker.patch('src.handlers.ProcessEcsClusters.function.sweep.complete_account')
+        client = mocker.patch('src.handlers.ProcessEcsClusters.function._get_cross_account_ecs_client').return_value
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        client.list_clusters.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
 
     def test_handler(
         self,
@@ -259,4 +357,48 @@ class TestCode:
         )
 
         mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
-        mock_fn.handler(mock_event, mock_context(lambda_function_name))
\ No newline at end of file
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_ecs_client: ECSClient,
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test calls grow with pages of clusters and systems, not with clusters'''
+        regions = ['us-east-1', 'us-west-2']
+        clusters = 150
+        systems = 3
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', regions)
+        for i in range(clusters):
+            mock_ecs_client.create_cluster(
+                clusterName='cluster-{}'.format(i),
+                tags=[{'key': 'org:system', 'value': 'system-{}'.format(i % systems)}]
+            )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        pages = math.ceil(clusters / mock_fn.CLUSTER_PAGE_SIZE)
+        call_counts.assert_within({
+            'sts': 1,
+            'ecs': len(regions) * (pages + 2),
+            'ecs.ListTagsForResource': 0,
+            'catalog.GetSystem': systems,
+            # Full envelopes plus a partial one a page.
+            'sqs.SendMessage': clusters // MAX_ENVELOPE_ENTITIES + len(regions) * pages,
+        })
+        assert call_counts.count('catalog.GetSystem') == systems
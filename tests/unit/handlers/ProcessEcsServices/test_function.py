@@ -0,0 +1,633 @@
+'''Test ProcessEcsServices'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Generator
+import jsonschema
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from mypy_boto3_ec2 import EC2Client
+from mypy_boto3_ecs import ECSClient
+from mypy_boto3_ecs.type_defs import ServiceTypeDef, TaskDefinitionTypeDef
+from mypy_boto3_sqs import SQSClient
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.account import AccountTypeWithTags
+from common.util.envelope import MAX_ENVELOPE_ENTITIES
+from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
+
+# AWS
+@pytest.fixture()
+def mock_ecs_client(make_mocked_client: Callable) -> Generator[ECSClient, None, None]:
+    '''Mock ECS Client'''
+    yield make_mocked_client('ecs')
+
+@pytest.fixture()
+def mock_ec2_client(make_mocked_client: Callable) -> Generator[EC2Client, None, None]:
+    '''Mock EC2 Client'''
+    yield make_mocked_client('ec2')
+
+@pytest.fixture()
+def mock_subnet(mock_ec2_client) -> dict[str, str]:
+    '''Return a mock subnet and security group for awsvpc services'''
+    vpc_id = mock_ec2_client.create_vpc(CidrBlock='10.0.0.0/24')['Vpc']['VpcId']
+    return {
+        'VpcId': vpc_id,
+        'SubnetId': mock_ec2_client.create_subnet(VpcId=vpc_id, CidrBlock='10.0.0.0/25')['Subnet']['SubnetId'],
+        'GroupId': mock_ec2_client.create_security_group(
+            GroupName='mock-group',
+            Description='mock-group',
+            VpcId=vpc_id
+        )['GroupId'],
+    }
+
+@pytest.fixture()
+def mock_task_definition(mock_ecs_client) -> TaskDefinitionTypeDef:
+    '''Return a mock task definition'''
+    return mock_ecs_client.register_task_definition(
+        family='mock-task',
+        containerDefinitions=[{'name': 'app', 'image': 'app:latest', 'memory': 128}]
+    )['taskDefinition']
+
+@pytest.fixture()
+def mock_ecs_service(mock_ecs_client, mock_task_definition) -> ServiceTypeDef:
+    '''Return a mock ECS service'''
+    mock_ecs_client.create_cluster(clusterName='mock-cluster')
+    mock_ecs_client.create_service(
+        cluster='mock-cluster',
+        serviceName='mock-service',
+        taskDefinition=mock_task_definition['taskDefinitionArn'],
+        desiredCount=1,
+        tags=[{'key': 'org:system', 'value': 'system-1'}]
+    )
+    mock_services = mock_ecs_client.describe_services(
+        cluster='mock-cluster',
+        services=['mock-service'],
+        include=['TAGS']
+    )
+
+    return mock_services.get('services', [])[0]
+
+@pytest.fixture()
+def mock_paged_ecs_client(mock_ecs_client, mocker: MockerFixture) -> ECSClient:
+    '''Return the mock ECS client with ListServices paged, which moto returns whole'''
+    list_services = mock_ecs_client.list_services
+
+    def _list_services(cluster: str, maxResults: int = 100, nextToken: str = '0') -> dict[str, Any]:
+        service_arns = list_services(cluster=cluster)['serviceArns']
+        start = int(nextToken)
+        page: dict[str, Any] = {'serviceArns': service_arns[start:start + maxResults]}
+        if start + maxResults < len(service_arns):
+            page['nextToken'] = str(start + maxResults)
+        return page
+
+    mocker.patch.object(mock_ecs_client, 'list_services', side_effect=_list_services)
+    return mock_ecs_client
+
+@pytest.fixture()
+def mock_sqs_client(make_mocked_client: Callable) -> Generator[SQSClient, None, None]:
+    '''Mock SQS Client'''
+    yield make_mocked_client('sqs')
+
+@pytest.fixture()
+def mock_sqs_queue_url(mock_sqs_client) -> str:
+    '''Mock SQS Queue URL'''
+    queue = mock_sqs_client.create_queue(QueueName='mock-queue')
+    return queue['QueueUrl']
+
+
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
+# Requests
+@pytest.fixture()
+def requests_mocker() -> requests_mock.Mocker:
+    '''Return a requests mock'''
+    # NOTE: Use as a decerator with Python 3 appears broken so use fixture.
+    # ref. https://github.com/pytest-dev/pytest/issues/2749
+    return requests_mock.Mocker()
+
+@pytest.fixture()
+def mock_endpoint() -> str:
+    '''Return a mock endpoint'''
+    return 'https://api.example.com/catalog'
+
+@pytest.fixture()
+def mock_auth(
+    mocker: MockerFixture,
+    requests_mocker: requests_mock.Mocker,
+) -> Generator[JwtAuth, None, None]:
+    '''Yield a JWT Auth object'''
+    requests_mocker.register_uri(
+        requests_mock.POST,
+        AUTH_ENDPOINT,
+        status_code=200,
+        json={'access_token': 'token'}
+    )
+
+    jwt = JwtAuth('clientId', 'clientSecret')
+    mocker.patch.object(jwt, 'token', 'jwt-token')
+    mocker.patch.object(jwt, 'expiration', int(time()) + 600)
+
+    yield jwt
+
+
+# Function
+@pytest.fixture()
+def mock_fn(
+    mock_sqs_queue_url,
+    mock_state_table_name,
+    mock_endpoint,
+    mock_auth,
+    requests_mocker: requests_mock.Mocker,
+    mocker: MockerFixture
+) -> Generator[ModuleType, None, None]:
+    '''Return mocked function'''
+    import src.handlers.ProcessEcsServices.function as fn
+
+    # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+    mocker.patch.dict('src.handlers.ProcessEcsServices.function._TASK_DEFINITION_IMAGES', clear=True)
+
+    mocker.patch(
+        'src.handlers.ProcessEcsServices.function.JWT',
+        mock_auth
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEcsServices.function.CATALOG_ENDPOINT',
+        mock_endpoint
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEcsServices.function.SQS_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEcsServices.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessEcsServices.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    # We can also use requests_mocker within tests too if necessary
+    with requests_mocker:
+        requests_mocker.register_uri(
+            requests_mock.ANY,
+            requests_mock.ANY,
+            status_code=200,
+        )
+        yield fn
+
+
+class TestData:
+    '''Data validation tests'''
+    def test_validate_data(self, mock_event_data: dict[str, Any], mock_event_data_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event_data, mock_event_data_schema)
+
+    def test_validate_event(self, mock_event: dict[str, Any], mock_event_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event, mock_event_schema)
+
+
+class TestCode:
+    '''Code tests'''
+    def test_GetSystemOwnerError(self, mock_fn: ModuleType):
+        '''Test GetSystemOwnerError class'''
+        e = mock_fn.GetSystemOwnerError('TestSystem')
+        assert str(e) == 'Failed to get owner for system: TestSystem'
+
+    def test__create_ecs_service_entity(
+        self,
+        mock_fn: ModuleType,
+        mock_ecs_service: ServiceTypeDef,
+        mock_task_definition: TaskDefinitionTypeDef,
+        mock_auth: JwtAuth,
+        mocker: MockerFixture
+    ):
+        '''Test _create_ecs_service_entity function'''
+        mocker.patch(
+            'src.handlers.ProcessEcsServices.function._get_system_owner',
+            return_value='owner'
+        )
+
+        region, account_id = mock_ecs_service['serviceArn'].split(':')[3:5]
+        entity = mock_fn._create_ecs_service_entity(mock_ecs_service, ['app:latest'], 'MockSystem', mock_auth)
+        assert entity['kind'] == 'Resource'
+        assert entity['metadata']['name'] == mock_fn.catalog.get_entity_name(
+            'ecs-service', 'mock-cluster-mock-service', mock_ecs_service['serviceArn']
+        )
+        assert entity['metadata']['title'] == 'mock-service'
+        assert entity['metadata']['description'] == 'ECS Service mock-service in cluster mock-cluster in account {}'.format(account_id)
+        assert entity['metadata']['annotations']['aws.amazon.com/account-id'] == account_id
+        assert entity['metadata']['annotations']['aws.amazon.com/arn'] == mock_ecs_service['serviceArn']
+        assert entity['metadata']['annotations']['aws.amazon.com/cluster-name'] == 'mock-cluster'
+        assert entity['metadata']['annotations']['aws.amazon.com/region'] == region
+        assert entity['metadata']['annotations']['aws.amazon.com/task-definition'] == mock_task_definition['taskDefinitionArn']
+        assert entity['metadata']['annotations']['aws.amazon.com/container-images'] == 'app:latest'
+        assert entity['spec']['system'] == 'system-1'
+        assert entity['spec']['dependsOn'] == ['resource:default/ecs-cluster-mock-cluster']
+        assert 'aws.amazon.com/vpc-ids' not in entity['metadata']['annotations']
+
+        # awsvpc services relate themselves to the VPCs of their subnets.
+        entity = mock_fn._create_ecs_service_entity(
+            {
+                **mock_ecs_service,
+                'networkConfiguration': {'awsvpcConfiguration': {'subnets': ['subnet-2', 'subnet-1']}}
+            },
+            ['app:latest'],
+            'MockSystem',
+            mock_auth,
+            {'subnet-1': 'vpc-1', 'subnet-2': 'vpc-1'}
+        )
+        assert entity['metadata']['annotations']['aws.amazon.com/subnet-ids'] == 'subnet-1,subnet-2'
+        assert entity['metadata']['annotations']['aws.amazon.com/vpc-ids'] == 'vpc-1'
+        assert entity['spec']['dependsOn'] == [
+            'resource:default/ecs-cluster-mock-cluster',
+            'resource:default/ec2-vpc-vpc-1'
+        ]
+
+        # Untagged services take their account's system.
+        entity = mock_fn._create_ecs_service_entity(
+            {**mock_ecs_service, 'tags': []}, ['app:latest'], 'MockSystem', mock_auth
+        )
+        assert entity['spec']['system'] == 'MockSystem'
+
+    def test__describe_services_page(
+        self,
+        mock_fn: ModuleType,
+        mock_paged_ecs_client: ECSClient,
+        mock_ecs_service: ServiceTypeDef,
+        mock_task_definition: TaskDefinitionTypeDef,
+        mocker: MockerFixture
+    ):
+        '''Test _describe_services_page describes a page of services in batches'''
+        mock_ecs_client = mock_paged_ecs_client
+        mocker.patch.object(mock_fn, 'SERVICE_PAGE_SIZE', mock_fn.DESCRIBE_SERVICES_BATCH_SIZE + 1)
+        for i in range(mock_fn.DESCRIBE_SERVICES_BATCH_SIZE + 1):
+            mock_ecs_client.create_service(
+                cluster='mock-cluster',
+                serviceName='service-{}'.format(i),
+                taskDefinition=mock_task_definition['taskDefinitionArn'],
+                desiredCount=1
+            )
+
+        with ThreadPoolExecutor() as executor:
+            services, next_token = mock_fn._describe_services_page(mock_ecs_client, 'mock-cluster', None, executor)
+            assert len(services) == mock_fn.SERVICE_PAGE_SIZE
+            assert next_token is not None
+
+            services, next_token = mock_fn._describe_services_page(
+                mock_ecs_client, 'mock-cluster', next_token, executor
+            )
+            assert len(services) == 1
+            assert next_token is None
+
+    def test__get_task_definition_images(
+        self,
+        mock_fn: ModuleType,
+        mock_ecs_client: ECSClient,
+        mock_task_definition: TaskDefinitionTypeDef,
+        mocker: MockerFixture
+    ):
+        '''Test only task definition images are kept, and the cache is bounded'''
+        mocker.patch.object(mock_fn, 'TASK_DEFINITION_CACHE_SIZE', 1)
+        arn = mock_task_definition['taskDefinitionArn']
+        other_arn = mock_ecs_client.register_task_definition(
+            family='other-task',
+            containerDefinitions=[{'name': 'app', 'image': 'other:latest', 'memory': 128}]
+        )['taskDefinition']['taskDefinitionArn']
+        describe_task_definition = mocker.spy(mock_ecs_client, 'describe_task_definition')
+
+        with ThreadPoolExecutor() as executor:
+            assert mock_fn._get_task_definition_images(mock_ecs_client, [arn, arn], executor) == {arn: ['app:latest']}
+            assert mock_fn._get_task_definition_images(mock_ecs_client, [arn], executor) == {arn: ['app:latest']}
+            assert describe_task_definition.call_count == 1
+
+            assert mock_fn._get_task_definition_images(mock_ecs_client, [other_arn], executor) == {
+                other_arn: ['other:latest']
+            }
+        assert mock_fn._TASK_DEFINITION_IMAGES == {other_arn: ['other:latest']}
+
+    def test__get_remaining_clusters(self, mock_fn: ModuleType):
+        '''Test clusters resume at the continuation's cluster and page'''
+        clusters = ['cluster-1', 'cluster-2', 'cluster-3']
+
+        assert mock_fn._get_remaining_clusters(clusters, None, None) == (clusters, None)
+        assert mock_fn._get_remaining_clusters(clusters, 'cluster-2', 'page-2') == (clusters[1:], 'page-2')
+        # A cluster deleted since the continuation starts the region over.
+        assert mock_fn._get_remaining_clusters(clusters, 'cluster-4', 'page-2') == (clusters, None)
+
+    def test__get_subnet_vpcs(
+        self,
+        mock_fn: ModuleType,
+        mock_ec2_client: EC2Client,
+        mock_subnet: dict[str, str]
+    ):
+        '''Test _get_subnet_vpcs function'''
+        subnet_vpcs = mock_fn._get_subnet_vpcs(mock_ec2_client, [mock_subnet['SubnetId']] * 2)
+        assert subnet_vpcs == {mock_subnet['SubnetId']: mock_subnet['VpcId']}
+
+    def test__get_system_owner(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+        owner = mock_fn._get_system_owner('mock_system', mock_auth,)
+        assert owner == 'owner'
+
+    def test__get_system_owner_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=403,
+        )
+        with pytest.raises(mock_fn.GetSystemOwnerError):
+            mock_fn._get_system_owner('mock_system', mock_auth,)
+
+    def test__send_queue_messages(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+    ):
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
+
+    def test__main(
+        self,
+        mock_fn: ModuleType,
+        mock_ecs_service: ServiceTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mocker: MockerFixture
+    ):
+        '''Test _main function'''
+        mocker.patch(
+            'src.handlers.ProcessEcsServices.function._get_system_owner',
+            return_value='owner'
+        )
+        send_queue_messages = mocker.patch('src.handlers.ProcessEcsServices.function._send_queue_messages')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        entities = send_queue_messages.call_args.args[0]
+        assert [entity['metadata']['title'] for entity in entities] == ['mock-service']
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_paged_ecs_client: ECSClient,
+        mock_ecs_service: ServiceTypeDef,
+        mock_task_definition: TaskDefinitionTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline within a cluster and enqueues a continuation'''
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', ['us-east-1'])
+        mocker.patch.object(mock_fn, 'SERVICE_PAGE_SIZE', 1)
+        mocker.patch.object(mock_fn, '_get_cross_account_ecs_client', return_value=mock_paged_ecs_client)
+        mocker.patch('src.handlers.ProcessEcsServices.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessEcsServices.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessEcsServices.function.sweep.complete_account')
+        mock_paged_ecs_client.create_service(
+            cluster='mock-cluster',
+            serviceName='other-service',
+            taskDefinition=mock_task_definition['taskDefinitionArn'],
+            desiredCount=1
+        )
+
+        # mock_context reports no remaining time so only the first page is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {
+            'Region': 'us-east-1',
+            'Cluster': mock_ecs_service['clusterArn'],
+            'NextToken': '1'
+        }
+
+        # The continuation picks up the cluster's remaining page and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 2
+        titles = [call.args[0][0]['metadata']['title'] for call in send_queue_messages.call_args_list]
+        assert sorted(titles) == ['mock-service', 'other-service']
+        complete_account.assert_called_once()
+
+    def test__main_continues_at_first_unfinished_cluster(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_paged_ecs_client: ECSClient,
+        mock_ecs_service: ServiceTypeDef,
+        mock_task_definition: TaskDefinitionTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function collects clusters at once and continues at the first that did not finish'''
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', ['us-east-1'])
+        mocker.patch.object(mock_fn, 'SERVICE_PAGE_SIZE', 1)
+        mocker.patch.object(mock_fn, '_get_cross_account_ecs_client', return_value=mock_paged_ecs_client)
+        mocker.patch('src.handlers.ProcessEcsServices.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessEcsServices.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessEcsServices.function.sweep.complete_account')
+        other_cluster_arn = mock_paged_ecs_client.create_cluster(clusterName='other-cluster')['cluster']['clusterArn']
+        for cluster, service in [('mock-cluster', 'other-service'), ('other-cluster', 'third-service')]:
+            mock_paged_ecs_client.create_service(
+                cluster=cluster,
+                serviceName=service,
+                taskDefinition=mock_task_definition['taskDefinitionArn'],
+                desiredCount=1
+            )
+        deadline = mock_fn.Deadline(mock_context(lambda_function_name), 1)
+
+        # The first cluster's first page is due; the other cluster stops before its first page.
+        mock_fn._main(mock_event_data, deadline)
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {
+            'Region': 'us-east-1',
+            'Cluster': mock_ecs_service['clusterArn'],
+            'NextToken': '1'
+        }
+        mock_sqs_client.delete_message(QueueUrl=mock_sqs_queue_url, ReceiptHandle=messages[0]['ReceiptHandle'])
+
+        mock_fn._main(continued_account_info, deadline)
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'Cluster': other_cluster_arn}
+        complete_account.assert_not_called()
+
+        mock_fn._main(continued_account_info, deadline)
+        titles = [call.args[0][0]['metadata']['title'] for call in send_queue_messages.call_args_list]
+        assert titles == ['mock-service', 'other-service', 'third-service']
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_ecs_service: ServiceTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessEcsServices.function.sqs.is_backed_up', return_value=True)
+        complete_account = mocker.patch('src.handlers.ProcessEcsServices.function.sweep.complete_account')
+        describe_services_page = mocker.patch('src.handlers.ProcessEcsServices.function._describe_services_page')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        describe_services_page.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+    def test_handler(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mocker: MockerFixture
+    ):
+        '''Test calling handler'''
+        # Call the function
+        mocker.patch.object(
+            mock_fn,
+            'JwtAuth',
+            client_id='clientId',
+            client_secret='clientSecret',
+            token='token'
+        )
+
+        mocker.patch(
+            'src.handlers.ProcessEcsServices.function._get_system_owner',
+            return_value='owner'
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_ecs_client: ECSClient,
+        mock_subnet: dict[str, str],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test calls grow with pages and batches of services, and task definitions are described once'''
+        regions = ['us-east-1', 'us-west-2']
+        clusters = 3
+        services = 12
+        systems = 3
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', regions)
+        task_definition_arn = mock_ecs_client.register_task_definition(
+            family='mock-task',
+            containerDefinitions=[{'name': 'app', 'image': 'app:latest', 'memory': 128}]
+        )['taskDefinition']['taskDefinitionArn']
+        for i in range(clusters):
+            mock_ecs_client.create_cluster(clusterName='cluster-{}'.format(i))
+            for j in range(services):
+                mock_ecs_client.create_service(
+                    cluster='cluster-{}'.format(i),
+                    serviceName='service-{}'.format(j),
+                    taskDefinition=task_definition_arn,
+                    desiredCount=1,
+                    networkConfiguration={'awsvpcConfiguration': {
+                        'subnets': [mock_subnet['SubnetId']],
+                        'securityGroups': [mock_subnet['GroupId']]
+                    }},
+                    tags=[{'key': 'org:system', 'value': 'system-{}'.format(j % systems)}]
+                )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        batches = -(-services // mock_fn.DESCRIBE_SERVICES_BATCH_SIZE)
+        call_counts.assert_within({
+            'sts': 1,
+            'ecs.ListClusters': len(regions),
+            'ecs.ListServices': clusters,
+            'ecs.DescribeServices': clusters * batches,
+            'ecs.DescribeTaskDefinition': 1,
+            'ecs.ListTagsForResource': 0,
+            # Service subnets are resolved to VPCs together, once per region with services.
+            'ec2.DescribeSubnets': 1,
+            'catalog.GetSystem': systems,
+            # Envelopes are sent per page of services, and each cluster's services fit one page.
+            'sqs.SendMessage': clusters * -(-services // MAX_ENVELOPE_ENTITIES),
+        })
+        assert call_counts.count('ecs.DescribeServices') == clusters * batches
@@ -0,0 +1,522 @@
+'''Test ProcessLambdaFunctions'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import io
+import json
+import math
+import zipfile
+from time import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Generator
+import jsonschema
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from botocore.exceptions import ClientError
+from mypy_boto3_lambda import LambdaClient
+from mypy_boto3_lambda.type_defs import FunctionConfigurationTypeDef
+from mypy_boto3_sqs import SQSClient
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.account import AccountTypeWithTags
+from common.util.envelope import MAX_ENVELOPE_ENTITIES
+from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
+
+# AWS
+@pytest.fixture()
+def mock_lambda_client(make_mocked_client: Callable) -> Generator[LambdaClient, None, None]:
+    '''Mock Lambda Client'''
+    yield make_mocked_client('lambda')
+
+@pytest.fixture()
+def make_mock_function(make_mocked_client: Callable, mock_lambda_client) -> Callable[..., FunctionConfigurationTypeDef]:
+    '''Return a function that creates a mock Lambda function'''
+    role_arn = make_mocked_client('iam').create_role(
+        RoleName='mock-function-role',
+        AssumeRolePolicyDocument=json.dumps({'Version': '2012-10-17', 'Statement': []})
+    )['Role']['Arn']
+    code = io.BytesIO()
+    with zipfile.ZipFile(code, 'w') as code_zip:
+        code_zip.writestr('function.py', 'def handler(event, context):\n    return\n')
+
+    def _make_mock_function(function_name: str, **kwargs: Any) -> FunctionConfigurationTypeDef:
+        return mock_lambda_client.create_function(
+            FunctionName=function_name,
+            Runtime='python3.12',
+            Role=role_arn,
+            Handler='function.handler',
+            Code={'ZipFile': code.getvalue()},
+            **kwargs
+        )
+    return _make_mock_function
+
+@pytest.fixture()
+def mock_function(make_mock_function) -> FunctionConfigurationTypeDef:
+    '''Return a mock Lambda function'''
+    return make_mock_function('mock-function', Tags={'org:system': 'system-1'})
+
+@pytest.fixture()
+def mock_paged_lambda_client(mock_lambda_client, mocker: MockerFixture) -> LambdaClient:
+    '''Return the mock Lambda client with ListFunctions paged, which moto returns whole'''
+    list_functions = mock_lambda_client.list_functions
+
+    def _list_functions(MaxItems: int = 50, Marker: str = '0') -> dict[str, Any]:
+        functions = list_functions()['Functions']
+        start = int(Marker)
+        page: dict[str, Any] = {'Functions': functions[start:start + MaxItems]}
+        if start + MaxItems < len(functions):
+            page['NextMarker'] = str(start + MaxItems)
+        return page
+
+    mocker.patch.object(mock_lambda_client, 'list_functions', side_effect=_list_functions)
+    return mock_lambda_client
+
+@pytest.fixture()
+def mock_sqs_client(make_mocked_client: Callable) -> Generator[SQSClient, None, None]:
+    '''Mock SQS Client'''
+    yield make_mocked_client('sqs')
+
+@pytest.fixture()
+def mock_sqs_queue_url(mock_sqs_client) -> str:
+    '''Mock SQS Queue URL'''
+    queue = mock_sqs_client.create_queue(QueueName='mock-queue')
+    return queue['QueueUrl']
+
+
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
+# Requests
+@pytest.fixture()
+def requests_mocker() -> requests_mock.Mocker:
+    '''Return a requests mock'''
+    # NOTE: Use as a decerator with Python 3 appears broken so use fixture.
+    # ref. https://github.com/pytest-dev/pytest/issues/2749
+    return requests_mock.Mocker()
+
+@pytest.fixture()
+def mock_endpoint() -> str:
+    '''Return a mock endpoint'''
+    return 'https://api.example.com/catalog'
+
+@pytest.fixture()
+def mock_auth(
+    mocker: MockerFixture,
+    requests_mocker: requests_mock.Mocker,
+) -> Generator[JwtAuth, None, None]:
+    '''Yield a JWT Auth object'''
+    requests_mocker.register_uri(
+        requests_mock.POST,
+        AUTH_ENDPOINT,
+        status_code=200,
+        json={'access_token': 'token'}
+    )
+
+    jwt = JwtAuth('clientId', 'clientSecret')
+    mocker.patch.object(jwt, 'token', 'jwt-token')
+    mocker.patch.object(jwt, 'expiration', int(time()) + 600)
+
+    yield jwt
+
+
+# Function
+@pytest.fixture()
+def mock_fn(
+    mock_sqs_queue_url,
+    mock_state_table_name,
+    mock_endpoint,
+    mock_auth,
+    requests_mocker: requests_mock.Mocker,
+    mocker: MockerFixture
+) -> Generator[ModuleType, None, None]:
+    '''Return mocked function'''
+    import src.handlers.ProcessLambdaFunctions.function as fn
+
+    # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+
+    mocker.patch(
+        'src.handlers.ProcessLambdaFunctions.function.JWT',
+        mock_auth
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessLambdaFunctions.function.CATALOG_ENDPOINT',
+        mock_endpoint
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessLambdaFunctions.function.SQS_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessLambdaFunctions.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessLambdaFunctions.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    # We can also use requests_mocker within tests too if necessary
+    with requests_mocker:
+        requests_mocker.register_uri(
+            requests_mock.ANY,
+            requests_mock.ANY,
+            status_code=200,
+        )
+        yield fn
+
+
+class TestData:
+    '''Data validation tests'''
+    def test_validate_data(self, mock_event_data: dict[str, Any], mock_event_data_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event_data, mock_event_data_schema)
+
+    def test_validate_event(self, mock_event: dict[str, Any], mock_event_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event, mock_event_schema)
+
+
+class TestCode:
+    '''Code tests'''
+    def test_GetSystemOwnerError(self, mock_fn: ModuleType):
+        '''Test GetSystemOwnerError class'''
+        e = mock_fn.GetSystemOwnerError('TestSystem')
+        assert str(e) == 'Failed to get owner for system: TestSystem'
+
+    def test__create_lambda_function_entity(
+        self,
+        mock_fn: ModuleType,
+        mock_function: FunctionConfigurationTypeDef,
+        mock_auth: JwtAuth,
+        mocker: MockerFixture
+    ):
+        '''Test _create_lambda_function_entity function'''
+        mocker.patch(
+            'src.handlers.ProcessLambdaFunctions.function._get_system_owner',
+            return_value='owner'
+        )
+
+        region, account_id = mock_function['FunctionArn'].split(':')[3:5]
+        entity = mock_fn._create_lambda_function_entity(
+            mock_function, {'org:system': 'system-1'}, 'MockSystem', mock_auth
+        )
+        assert entity['kind'] == 'Resource'
+        assert entity['metadata']['name'] == mock_fn.catalog.get_entity_name(
+            'lambda-function', 'mock-function', mock_function['FunctionArn']
+        )
+        assert entity['metadata']['title'] == 'mock-function'
+        assert entity['metadata']['description'] == 'Lambda function mock-function in account {}'.format(account_id)
+        assert entity['metadata']['annotations']['aws.amazon.com/account-id'] == account_id
+        assert entity['metadata']['annotations']['aws.amazon.com/arn'] == mock_function['FunctionArn']
+        assert entity['metadata']['annotations']['aws.amazon.com/region'] == region
+        assert entity['metadata']['annotations']['aws.amazon.com/runtime'] == 'python3.12'
+        assert entity['spec']['system'] == 'system-1'
+
+        # Untagged functions take their account's system.
+        entity = mock_fn._create_lambda_function_entity(mock_function, {}, 'MockSystem', mock_auth)
+        assert entity['spec']['system'] == 'MockSystem'
+
+    def test__list_region_functions(
+        self,
+        mock_fn: ModuleType,
+        mock_function: FunctionConfigurationTypeDef,
+        make_mock_function: Callable[..., FunctionConfigurationTypeDef],
+        mocker: MockerFixture
+    ):
+        '''Test _list_region_functions function'''
+        untagged_function = make_mock_function('untagged-function')
+        credentials = mock_fn._get_cross_account_credentials('123456789012', 'mock-role')
+
+        listing = mock_fn._list_region_functions(credentials, 'us-east-1', None, lambda: False)
+        assert sorted(function['FunctionName'] for function in listing['Functions']) == [
+            'mock-function', 'untagged-function'
+        ]
+        assert listing['Tags'] == {mock_function['FunctionArn']: {'org:system': 'system-1'}}
+        assert listing['Continuation'] is None
+
+        # Tags are listed per function when the index can't be read.
+        mocker.patch(
+            'src.handlers.ProcessLambdaFunctions.function.tags.get_tag_index',
+            side_effect=ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'GetResources')
+        )
+        listing = mock_fn._list_region_functions(credentials, 'us-east-1', None, lambda: False)
+        assert listing['Tags'] == {
+            mock_function['FunctionArn']: {'org:system': 'system-1'},
+            untagged_function['FunctionArn']: {},
+        }
+
+    def test__list_region_functions_stops(
+        self,
+        mock_fn: ModuleType,
+        mock_paged_lambda_client: LambdaClient,
+        mock_function: FunctionConfigurationTypeDef,
+        make_mock_function: Callable[..., FunctionConfigurationTypeDef],
+        mocker: MockerFixture
+    ):
+        '''Test _list_region_functions stops between pages when told to, with a continuation'''
+        mocker.patch.object(mock_fn, 'FUNCTION_PAGE_SIZE', 1)
+        mocker.patch.object(mock_fn, '_get_cross_account_lambda_client', return_value=mock_paged_lambda_client)
+        make_mock_function('other-function')
+        credentials = mock_fn._get_cross_account_credentials('123456789012', 'mock-role')
+
+        # A due first page is listed even when told to stop.
+        listing = mock_fn._list_region_functions(credentials, 'us-east-1', None, lambda: True, True)
+        assert len(listing['Functions']) == 1
+        assert listing['Continuation'] == {'Region': 'us-east-1', 'NextToken': '1'}
+
+        listing = mock_fn._list_region_functions(credentials, 'us-east-1', '1', lambda: True)
+        assert listing['Functions'] == []
+        assert listing['Continuation'] == {'Region': 'us-east-1', 'NextToken': '1'}
+
+        listing = mock_fn._list_region_functions(credentials, 'us-east-1', '1', lambda: False)
+        assert len(listing['Functions']) == 1
+        assert listing['Continuation'] is None
+
+    def test__get_system_owner(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+        owner = mock_fn._get_system_owner('mock_system', mock_auth,)
+        assert owner == 'owner'
+
+    def test__get_system_owner_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=403,
+        )
+        with pytest.raises(mock_fn.GetSystemOwnerError):
+            mock_fn._get_system_owner('mock_system', mock_auth,)
+
+    def test__send_queue_messages(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+    ):
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
+
+    def test__main(
+        self,
+        mock_fn: ModuleType,
+        mock_function: FunctionConfigurationTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mocker: MockerFixture
+    ):
+        '''Test _main function'''
+        mocker.patch(
+            'src.handlers.ProcessLambdaFunctions.function._get_system_owner',
+            return_value='owner'
+        )
+        send_queue_messages = mocker.patch('src.handlers.ProcessLambdaFunctions.function._send_queue_messages')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        entities = send_queue_messages.call_args.args[0]
+        assert [entity['metadata']['title'] for entity in entities] == ['mock-function']
+        assert entities[0]['spec']['system'] == 'system-1'
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_function: FunctionConfigurationTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline and enqueues a continuation'''
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', ['us-east-1', 'us-west-2'])
+        mocker.patch('src.handlers.ProcessLambdaFunctions.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessLambdaFunctions.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessLambdaFunctions.function.sweep.complete_account')
+
+        # mock_context reports no remaining time so only the first region is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-west-2'}
+
+        # The continuation picks up the remaining region, which has no functions, and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_called_once()
+
+    def test__main_continues_within_region(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_paged_lambda_client: LambdaClient,
+        mock_function: FunctionConfigurationTypeDef,
+        make_mock_function: Callable[..., FunctionConfigurationTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops listing a region at the deadline and continues at its next page'''
+        mocker.patch.object(mock_fn, 'FUNCTION_PAGE_SIZE', 1)
+        mocker.patch.object(mock_fn, '_get_cross_account_lambda_client', return_value=mock_paged_lambda_client)
+        mocker.patch('src.handlers.ProcessLambdaFunctions.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessLambdaFunctions.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessLambdaFunctions.function.sweep.complete_account')
+        make_mock_function('other-function')
+
+        # mock_context reports no remaining time so only the first page is listed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'NextToken': '1'}
+
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 2
+        titles = [call.args[0][0]['metadata']['title'] for call in send_queue_messages.call_args_list]
+        assert sorted(titles) == ['mock-function', 'other-function']
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessLambdaFunctions.function.sqs.is_backed_up', return_value=True)
+        complete_account = mocker.patch('src.handlers.ProcessLambdaFunctions.function.sweep.complete_account')
+        send_queue_messages = mocker.patch('src.handlers.ProcessLambdaFunctions.function._send_queue_messages')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        send_queue_messages.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+    def test_handler(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mocker: MockerFixture
+    ):
+        '''Test calling handler'''
+        # Call the function
+        mocker.patch.object(
+            mock_fn,
+            'JwtAuth',
+            client_id='clientId',
+            client_secret='clientSecret',
+            token='token'
+        )
+
+        mocker.patch(
+            'src.handlers.ProcessLambdaFunctions.function._get_system_owner',
+            return_value='owner'
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        make_mock_function: Callable[..., FunctionConfigurationTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test calls grow with pages of functions and systems, not with functions'''
+        regions = ['us-east-1', 'us-west-2']
+        functions = 60
+        systems = 3
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', regions)
+        for i in range(functions):
+            make_mock_function(
+                'function-{}'.format(i),
+                Tags={'org:system': 'system-{}'.format(i % systems)}
+            )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        pages = math.ceil(functions / mock_fn.FUNCTION_PAGE_SIZE)
+        tag_pages = math.ceil(functions / mock_fn.tags.TAG_INDEX_PAGE_SIZE)
+        call_counts.assert_within({
+            'sts': 1,
+            'lambda.ListFunctions': len(regions) * pages,
+            'lambda.ListTags': 0,
+            'resource-groups-tagging-api.GetResources': len(regions) * tag_pages,
+            'catalog.GetSystem': systems,
+            # Full envelopes plus a partial one a region.
+            'sqs.SendMessage': functions // MAX_ENVELOPE_ENTITIES + len(regions),
+        })
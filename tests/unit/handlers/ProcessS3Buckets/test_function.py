@@ -0,0 +1,460 @@
+'''Test ProcessS3Buckets'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import json
+import math
+from time import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Any, Callable, Generator, List
+import jsonschema
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from mypy_boto3_s3 import S3Client
+from mypy_boto3_s3.type_defs import BucketTypeDef
+from mypy_boto3_sqs import SQSClient
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.account import AccountTypeWithTags
+from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
+
+# AWS
+@pytest.fixture()
+def mock_s3_client(make_mocked_client: Callable) -> Generator[S3Client, None, None]:
+    '''Mock S3 Client'''
+    yield make_mocked_client('s3')
+
+@pytest.fixture()
+def mock_buckets(mock_s3_client) -> List[BucketTypeDef]:
+    '''Return mock buckets, one tagged with a system and one untagged in another region'''
+    mock_s3_client.create_bucket(Bucket='bucket-a')
+    mock_s3_client.put_bucket_tagging(
+        Bucket='bucket-a',
+        Tagging={'TagSet': [{'Key': 'org:system', 'Value': 'mock-system'}]}
+    )
+    mock_s3_client.create_bucket(
+        Bucket='bucket-b',
+        CreateBucketConfiguration={'LocationConstraint': 'us-west-2'}
+    )
+    return mock_s3_client.list_buckets()['Buckets']
+
+
+@pytest.fixture()
+def mock_sqs_client(make_mocked_client: Callable) -> Generator[SQSClient, None, None]:
+    '''Mock SQS Client'''
+    yield make_mocked_client('sqs')
+
+@pytest.fixture()
+def mock_sqs_queue_url(mock_sqs_client) -> str:
+    '''Mock SQS Queue URL'''
+    queue = mock_sqs_client.create_queue(QueueName='mock-queue')
+    return queue['QueueUrl']
+
+
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
+# Requests
+@pytest.fixture()
+def requests_mocker() -> requests_mock.Mocker:
+    '''Return a requests mock'''
+    # NOTE: Use as a decerator with Python 3 appears broken so use fixture.
+    # ref. https://github.com/pytest-dev/pytest/issues/2749
+    return requests_mock.Mocker()
+
+@pytest.fixture()
+def mock_endpoint() -> str:
+    '''Return a mock endpoint'''
+    return 'https://api.example.com/catalog'
+
+@pytest.fixture()
+def mock_auth(
+    mocker: MockerFixture,
+    requests_mocker: requests_mock.Mocker,
+) -> Generator[JwtAuth, None, None]:
+    '''Yield a JWT Auth object'''
+    requests_mocker.register_uri(
+        requests_mock.POST,
+        AUTH_ENDPOINT,
+        status_code=200,
+        json={'access_token': 'token'}
+    )
+
+    jwt = JwtAuth('clientId', 'clientSecret')
+    mocker.patch.object(jwt, 'token', 'jwt-token')
+    mocker.patch.object(jwt, 'expiration', int(time()) + 600)
+
+    yield jwt
+
+
+# Function
+@pytest.fixture()
+def mock_fn(
+    mock_sqs_queue_url,
+    mock_state_table_name,
+    mock_endpoint,
+    mock_auth,
+    requests_mocker: requests_mock.Mocker,
+    mocker: MockerFixture
+) -> Generator[ModuleType, None, None]:
+    '''Return mocked function'''
+    import src.handlers.ProcessS3Buckets.function as fn
+
+    # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+    mocker.patch.dict('src.handlers.ProcessS3Buckets.function._BUCKET_REGIONS', clear=True)
+
+    mocker.patch(
+        'src.handlers.ProcessS3Buckets.function.JWT',
+        mock_auth
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessS3Buckets.function.CATALOG_ENDPOINT',
+        mock_endpoint
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessS3Buckets.function.SQS_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessS3Buckets.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessS3Buckets.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    # We can also use requests_mocker within tests too if necessary
+    with requests_mocker:
+        requests_mocker.register_uri(
+            requests_mock.ANY,
+            requests_mock.ANY,
+            status_code=200,
+        )
+        yield fn
+
+
+class TestData:
+    '''Data validation tests'''
+    def test_validate_data(self, mock_event_data: dict[str, Any], mock_event_data_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event_data, mock_event_data_schema)
+
+    def test_validate_event(self, mock_event: dict[str, Any], mock_event_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event, mock_event_schema)
+
+
+class TestCode:
+    '''Code tests'''
+    def test_GetSystemOwnerError(self, mock_fn: ModuleType):
+        '''Test GetSystemOwnerError class'''
+        e = mock_fn.GetSystemOwnerError('TestSystem')
+        assert str(e) == 'Failed to get owner for system: TestSystem'
+
+    def test__get_bucket_region(
+        self,
+        mock_fn: ModuleType,
+        mock_buckets: List[BucketTypeDef],
+        mock_s3_client: S3Client,
+        mocker: MockerFixture
+    ):
+        '''Test _get_bucket_region function'''
+        get_bucket_location = mocker.spy(mock_s3_client, 'get_bucket_location')
+
+        assert mock_fn._get_bucket_region(mock_buckets[0], mock_s3_client) == 'us-east-1'
+        assert mock_fn._get_bucket_region(mock_buckets[1], mock_s3_client) == 'us-west-2'
+        assert get_bucket_location.call_count == 2
+
+        # Regions are cached, and taken from the listing when it has them.
+        assert mock_fn._get_bucket_region(mock_buckets[0], mock_s3_client) == 'us-east-1'
+        assert mock_fn._get_bucket_region({'Name': 'bucket-c', 'BucketRegion': 'eu-west-1'}, mock_s3_client) == 'eu-west-1'
+        assert get_bucket_location.call_count == 2
+
+    def test__create_s3_bucket_entity(
+        self,
+        mock_fn: ModuleType,
+        mock_buckets: List[BucketTypeDef],
+        mock_auth: JwtAuth,
+        mocker: MockerFixture
+    ):
+        '''Test _create_s3_bucket_entity function'''
+        mocker.patch(
+            'src.handlers.ProcessS3Buckets.function._get_system_owner',
+            return_value='owner'
+        )
+
+        account_id = '123456789012'
+        region = 'us-east-1'
+
+        entity = mock_fn._create_s3_bucket_entity(
+            mock_buckets[0],
+            {'org:system': 'mock-system'},
+            account_id,
+            region,
+            'MockSystem',
+            mock_auth
+        )
+        assert entity['kind'] == 'Resource'
+        assert entity['metadata']['name'] == mock_fn.catalog.get_entity_name(
+            's3-bucket', 'bucket-a', 'arn:aws:s3:::bucket-a'
+        )
+        assert entity['metadata']['title'] == 'bucket-a'
+        assert entity['metadata']['description'] == 'S3 bucket bucket-a in account {}'.format(account_id)
+        assert entity['metadata']['annotations']['aws.amazon.com/account-id'] == account_id
+        assert entity['metadata']['annotations']['aws.amazon.com/arn'] == 'arn:aws:s3:::bucket-a'
+        assert entity['metadata']['annotations']['aws.amazon.com/region'] == region
+        assert entity['spec']['system'] == 'mock-system'
+
+        # Untagged buckets take their account's system.
+        entity = mock_fn._create_s3_bucket_entity(mock_buckets[1], {}, account_id, 'us-west-2', 'MockSystem', mock_auth)
+        assert entity['spec']['system'] == 'MockSystem'
+
+    def test__get_system_owner(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+        owner = mock_fn._get_system_owner('mock_system', mock_auth,)
+        assert owner == 'owner'
+
+    def test__get_system_owner_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: AccountTypeWithTags,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _get_system_owner function'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=403,
+        )
+        with pytest.raises(mock_fn.GetSystemOwnerError):
+            mock_fn._get_system_owner('mock_system', mock_auth,)
+
+    def test__send_queue_messages(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+    ):
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
+
+    def test__main(
+        self,
+        mock_fn: ModuleType,
+        mock_buckets: List[BucketTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mocker: MockerFixture
+    ):
+        '''Test _main function'''
+        mocker.patch(
+            'src.handlers.ProcessS3Buckets.function._get_system_owner',
+            return_value='owner'
+        )
+        send_queue_messages = mocker.patch('src.handlers.ProcessS3Buckets.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessS3Buckets.function.sweep.complete_account')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+
+        entities = send_queue_messages.call_args.args[0]
+        assert [
+            (e['metadata']['title'], e['metadata']['annotations']['aws.amazon.com/region'], e['spec']['system'])
+            for e in entities
+        ] == [
+            ('bucket-a', 'us-east-1', 'mock-system'),
+            ('bucket-b', 'us-west-2', 'mock_system'),
+        ]
+        complete_account.assert_called_once()
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_buckets: List[BucketTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline and enqueues a continuation'''
+        mocker.patch('src.handlers.ProcessS3Buckets.function._get_system_owner', return_value='owner')
+        mocker.patch.object(mock_fn, 'BUCKET_BATCH_SIZE', 1)
+        send_queue_messages = mocker.patch('src.handlers.ProcessS3Buckets.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessS3Buckets.function.sweep.complete_account')
+
+        # mock_context reports no remaining time so only the first batch is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'NextToken': 'bucket-a'}
+
+        # The continuation picks up the remaining bucket and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_args.args[0][0]['metadata']['title'] == 'bucket-b'
+        assert send_queue_messages.call_count == 2
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_buckets: List[BucketTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessS3Buckets.function.sqs.is_backed_up', return_value=True)
+        send_queue_messages = mocker.patch('src.handlers.ProcessS3Buckets.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessS3Buckets.function.sweep.complete_account')
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        send_queue_messages.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
+
+    def test_handler(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_buckets: List[BucketTypeDef],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mocker: MockerFixture
+    ):
+        '''Test calling handler'''
+        mocker.patch(
+            'src.handlers.ProcessS3Buckets.function._get_system_owner',
+            return_value='owner'
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_s3_client: S3Client,
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test one listing per account, one location lookup per bucket and tags by region'''
+        mocker.patch.object(mock_fn, 'BUCKET_BATCH_SIZE', 4)
+        regions = ['us-east-1', 'us-west-2']
+        buckets = 10
+        for i in range(buckets):
+            region = regions[i % len(regions)]
+            mock_s3_client.create_bucket(
+                Bucket='bucket-{}'.format(i),
+                **{'CreateBucketConfiguration': {'LocationConstraint': region}} if region != 'us-east-1' else {}
+            )
+            mock_s3_client.put_bucket_tagging(
+                Bucket='bucket-{}'.format(i),
+                Tagging={'TagSet': [{'Key': 'org:system', 'Value': 'system-{}'.format(i % 2)}]}
+            )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        batches = math.ceil(buckets / mock_fn.BUCKET_BATCH_SIZE)
+        call_counts.assert_within({
+            'sts': 1,
+            's3.ListBuckets': 1,
+            's3.GetBucketLocation': buckets,
+            's3.GetBucketTagging': 0,
+            # One page of tags for each region.
+            'resourcegroupstaggingapi': len(regions),
+            'catalog.GetSystem': 2,
+            'sqs.SendMessage': batches,
+        })
+
+        # Bucket regions are kept for the next sweep.
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+        assert call_counts.count('s3.GetBucketLocation') == 0
+
+    def test_handler_defers_account_not_due(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test calling handler with an account scheduled in the future'''
+        main = mocker.patch('src.handlers.ProcessS3Buckets.function._main')
+
+        mock_event_data['NotBefore'] = int(time()) + 3600
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+        main.assert_not_called()
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
@@ -2,9 +2,10 @@
 # pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
 
 import json
+import math
 from time import time
 from types import ModuleType
-from typing import Any, Callable, Generator
+from typing import TYPE_CHECKING, Any, Callable, Generator
 import jsonschema
 
 import pytest
@@ -19,6 +20,10 @@ from aws_lambda_powertools.utilities.typing import LambdaContext
 
 from common.model.account import AccountTypeWithTags
 from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+if TYPE_CHECKING:
+    from common.util.continuation import Deadline
 
 # AWS
 @pytest.fixture()
@@ -55,6 +60,17 @@ def mock_sqs_queue_url(mock_sqs_client) -> str:
     return queue['QueueUrl']
 
 
+@pytest.fixture()
+def mock_deadline(
+    lambda_function_name: str,
+    mock_context: Callable[[str], LambdaContext],
+    mocked_aws
+) -> 'Deadline':
+    '''Return a deadline that never expires'''
+    from common.util.continuation import Deadline
+    return Deadline(mock_context(lambda_function_name), 0)
+
+
 # Requests
 @pytest.fixture()
 def requests_mocker() -> requests_mock.Mocker:
@@ -92,6 +108,7 @@ def mock_auth(
 @pytest.fixture()
 def mock_fn(
     mock_sqs_queue_url,
+    mock_state_table_name,
     mock_endpoint,
     mock_auth,
     requests_mocker: requests_mock.Mocker,
@@ -101,6 +118,8 @@ def mock_fn(
     import src.handlers.ProcessVpcs.function as fn
 
     # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch.dict('common.util.catalog._SYSTEM_OWNERS', clear=True)
+
     mocker.patch(
         'src.handlers.ProcessVpcs.function.JWT',
         mock_auth
@@ -116,6 +135,16 @@ def mock_fn(
         mock_sqs_queue_url
     )
 
+    mocker.patch(
+        'src.handlers.ProcessVpcs.function.SOURCE_QUEUE_URL',
+        mock_sqs_queue_url
+    )
+
+    mocker.patch(
+        'src.handlers.ProcessVpcs.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
     # We can also use requests_mocker within tests too if necessary
     with requests_mocker:
         requests_mocker.register_uri(
@@ -170,6 +199,117 @@ class TestCode:
         assert entity['metadata']['annotations']['aws.amazon.com/arn'] == 'arn:aws:ec2:{}:{}:vpc/{}'.format(region, account_id, vpc_id)
         assert entity['metadata']['annotations']['aws.amazon.com/owner-account-id'] == mock_vpc.get('OwnerId', 'UNKNOWN')
         assert entity['metadata']['annotations']['aws.amazon.com/region'] == region
+        assert entity['spec']['system'] == 'mock-system'
+
+        # Untagged VPCs take their account's system.
+        entity = mock_fn._create_vpc_entity({**mock_vpc, 'Tags': []}, account_id, region, 'MockSystem', mock_auth)
+        assert entity['spec']['system'] == 'MockSystem'
+
+        topology = mock_fn.VpcTopology(
+            Subnets={'subnet-1', 'subnet-2'},
+            AvailabilityZones={'us-east-1b', 'us-east-1a'},
+            RouteTables={'rtb-1'}
+        )
+        entity = mock_fn._create_vpc_entity(mock_vpc, account_id, region, 'MockSystem', mock_auth, topology)
+        assert entity['metadata']['annotations']['aws.amazon.com/subnet-count'] == '2'
+        assert entity['metadata']['annotations']['aws.amazon.com/availability-zones'] == 'us-east-1a,us-east-1b'
+        assert entity['metadata']['annotations']['aws.amazon.com/route-tables'] == 'rtb-1'
+        assert 'aws.amazon.com/participant-account-ids' not in entity['metadata']['annotations']
+
+        entity = mock_fn._create_vpc_entity(
+            mock_vpc, account_id, region, 'MockSystem', mock_auth, None, {'222222222222', '111111111111'}
+        )
+        assert entity['metadata']['annotations']['aws.amazon.com/participant-account-ids'] == '111111111111,222222222222'
+
+    def test__get_vpc_participants(
+        self,
+        mock_fn: ModuleType,
+        mock_state_table_name: str
+    ):
+        '''Test VPC participants are recorded by participant accounts and read by the owner'''
+        from common.util import sweep
+        owner_account_id = '210987654321'
+        shared_vpcs = [{'VpcId': 'vpc-1', 'OwnerId': owner_account_id}]
+
+        mock_fn._record_shared_vpcs(shared_vpcs, '111111111111', '100')
+        # Participants from the last completed sweep are kept until they record themselves again.
+        sweep.start_sweep(mock_state_table_name, '100', ['111111111111'], [mock_fn.SWEEP_COLLECTOR])
+        sweep.complete_account(mock_state_table_name, '100', mock_fn.SWEEP_COLLECTOR, '111111111111')
+        mock_fn._record_shared_vpcs(shared_vpcs, '222222222222', '101')
+
+        assert mock_fn._get_vpc_participants(owner_account_id, '101') == {
+            'vpc-1': {'111111111111', '222222222222'}
+        }
+        assert mock_fn._get_vpc_participants(owner_account_id, None) == {}
+
+    def test__main_skips_shared_vpcs(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_ec2_client: EC2Client,
+        mock_state_table_name: str,
+        mocker: MockerFixture
+    ):
+        '''Test VPCs shared with an account are left to their owner when the owner is collected'''
+        from common.util import sweep
+        mocker.patch(
+            'src.handlers.ProcessVpcs.function._get_system_owner',
+            return_value='owner'
+        )
+        mocker.patch.object(mock_fn, '_get_cross_account_ec2_client', return_value=mock_ec2_client)
+        owned_vpc = {'VpcId': 'vpc-1', 'OwnerId': mock_event_data['Id'], 'Tags': []}
+        shared_vpc = {'VpcId': 'vpc-2', 'OwnerId': '210987654321', 'Tags': []}
+        external_vpc = {'VpcId': 'vpc-3', 'OwnerId': '999999999999', 'Tags': []}
+        mocker.patch.object(
+            mock_ec2_client,
+            'describe_vpcs',
+            return_value={'Vpcs': [owned_vpc, shared_vpc, external_vpc]}
+        )
+        send_queue_messages = mocker.patch.object(mock_fn, '_send_queue_messages')
+        sweep.start_sweep(
+            mock_state_table_name,
+            mock_event_data['SweepId'],
+            [mock_event_data['Id']],
+            [mock_fn.SWEEP_COLLECTOR],
+            [mock_event_data['Id'], '210987654321']
+        )
+
+        mock_fn._main(mock_event_data, mock_deadline)
+
+        entities = [entity for call in send_queue_messages.call_args_list for entity in call.args[0]]
+        # The VPC owned outside the organization is emitted by the participant, under its owner.
+        assert [entity['metadata']['title'] for entity in entities] == (
+            ['vpc-1', 'vpc-3'] * len(mock_fn.COLLECTOR_REGIONS)
+        )
+        assert entities[1]['metadata']['annotations']['aws.amazon.com/account-id'] == '999999999999'
+        assert mock_fn._get_vpc_participants('210987654321', mock_event_data['SweepId']) == {
+            'vpc-2': {mock_event_data['Id']}
+        }
+        assert mock_fn._get_vpc_participants('999999999999', mock_event_data['SweepId']) == {}
+
+    def test__get_vpc_topology(
+        self,
+        mock_fn: ModuleType,
+        mock_vpc: VpcTypeDef,
+        mock_ec2_client: EC2Client
+    ):
+        '''Test _get_vpc_topology function'''
+        vpc_id = mock_vpc['VpcId']
+        subnet_id = mock_ec2_client.create_subnet(
+            VpcId=vpc_id,
+            CidrBlock='10.0.0.0/25',
+            AvailabilityZone='us-east-1a'
+        )['Subnet']['SubnetId']
+
+        topology = mock_fn._get_vpc_topology(mock_ec2_client, [vpc_id])
+        # Only the page's VPCs are described.
+        assert list(topology) == [vpc_id]
+        assert topology[vpc_id]['Subnets'] == {subnet_id}
+        assert topology[vpc_id]['AvailabilityZones'] == {'us-east-1a'}
+        assert len(topology[vpc_id]['RouteTables']) == 1
+
+        assert mock_fn._get_vpc_topology(mock_ec2_client, []) == {}
 
     def test__get_system_owner(
         self,
@@ -202,19 +342,26 @@ class TestCode:
         with pytest.raises(mock_fn.GetSystemOwnerError):
             mock_fn._get_system_owner('mock_system', mock_auth,)
 
-    def test__send_queue_message(
+    def test__send_queue_messages(
         self,
         mock_fn: ModuleType,
         mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
     ):
-        '''Test _send_queue_message function'''
-        response = mock_fn._send_queue_message(mock_event_data)
-        assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+        '''Test _send_queue_messages function'''
+        responses = mock_fn._send_queue_messages([mock_event_data, mock_event_data])
+        assert len(responses) == 1
+        assert responses[0]['ResponseMetadata']['HTTPStatusCode'] == 200
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        assert len(json.loads(messages[0]['Body'])['Entities']) == 2
 
     def test__main(
         self,
         mock_fn: ModuleType,
         mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
         mocker: MockerFixture
     ):
         '''Test _main function'''
@@ -231,7 +378,67 @@ class TestCode:
             return_value='owner'
         )
 
-        mock_fn._main(mock_event_data)
+        mock_fn._main(mock_event_data, mock_deadline)
+
+    def test__main_continues_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_vpc: VpcTypeDef,
+        mock_event_data: AccountTypeWithTags,
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function stops at the deadline and enqueues a continuation'''
+        mocker.patch('src.handlers.ProcessVpcs.function._get_system_owner', return_value='owner')
+        send_queue_messages = mocker.patch('src.handlers.ProcessVpcs.function._send_queue_messages')
+        complete_account = mocker.patch('src.handlers.ProcessVpcs.function.sweep.complete_account')
+        ec2_client = mocker.patch('src.handlers.ProcessVpcs.function._get_cross_account_ec2_client').return_value
+        ec2_client.describe_vpcs.side_effect = [
+            {'Vpcs': [mock_vpc], 'NextToken': 'page-2'},
+            {'Vpcs': [mock_vpc]},
+        ]
+
+        # mock_context reports no remaining time so only the first page is processed.
+        mock_fn._main(mock_event_data, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert send_queue_messages.call_count == 1
+        complete_account.assert_not_called()
+
+        messages = mock_sqs_client.receive_message(QueueUrl=mock_sqs_queue_url)['Messages']
+        continued_account_info = json.loads(messages[0]['Body'])
+        assert continued_account_info['Continuation'] == {'Region': 'us-east-1', 'NextToken': 'page-2'}
+
+        # The continuation picks up the remaining page and completes the account.
+        mock_fn._main(continued_account_info, mock_fn.Deadline(mock_context(lambda_function_name), 1))
+        assert ec2_client.describe_vpcs.call_args.kwargs['NextToken'] == 'page-2'
+        assert send_queue_messages.call_count == 2
+        complete_account.assert_called_once()
+
+    def test__main_defers_when_backed_up(
+        self,
+        mock_fn: ModuleType,
+        mock_event_data: AccountTypeWithTags,
+        mock_deadline: 'Deadline',
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test _main function defers the account while the catalog queue is backed up'''
+        mocker.patch('src.handlers.ProcessVpcs.function.sqs.is_backed_up', return_value=True)
+        complete_account = mocker.patch('src.handlers.ProcessVpcs.function.sweep.complete_account')
+        client = mocker.patch('src.handlers.ProcessVpcs.function._get_cross_account_ec2_client').return_value
+
+        mock_fn._main(mock_event_data, mock_deadline)
+        client.describe_vpcs.assert_not_called()
+        complete_account.assert_not_called()
+
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
 
     def test_handler(
         self,
@@ -258,4 +465,74 @@ class TestCode:
         )
 
         mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
-        mock_fn.handler(mock_event, mock_context(lambda_function_name))
\ No newline at end of file
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_ec2_client: EC2Client,
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+        mocker: MockerFixture
+    ):
+        '''Test calls grow with pages of VPCs, not with VPCs'''
+        regions = ['us-east-1', 'us-west-2']
+        mocker.patch.object(mock_fn, 'COLLECTOR_REGIONS', regions)
+        mocker.patch.object(mock_fn, 'VPC_PAGE_SIZE', 5)
+        for i in range(4):
+            mock_ec2_client.create_vpc(CidrBlock='10.{}.0.0/16'.format(i))
+        vpcs = len(mock_ec2_client.describe_vpcs()['Vpcs'])
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=200,
+            json={'spec': {'owner': 'owner'}}
+        )
+
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        pages = math.ceil(vpcs / mock_fn.VPC_PAGE_SIZE) + 1
+        call_counts.assert_within({
+            'sts': 1,
+            # Subnets and route tables are listed once per page of VPCs.
+            'ec2': len(regions) * pages * 3,
+            'ecs': 0,
+            # Shared VPC participants are read once, from this sweep and the last one, and the
+            # organization's accounts once.
+            'dynamodb.GetItem': 2,
+            'dynamodb.BatchGetItem': 1,
+            # VPCs take their account's system.
+            'catalog.GetSystem': 1,
+            'sqs.SendMessage': len(regions) * pages,
+        })
+
+    def test_handler_defers_account_not_due(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event_data: AccountTypeWithTags,
+        mock_event: dict[str, Any],
+        mock_sqs_client: SQSClient,
+        mock_sqs_queue_url: str,
+        mocker: MockerFixture
+    ):
+        '''Test calling handler with an account scheduled in the future'''
+        main = mocker.patch('src.handlers.ProcessVpcs.function._main')
+
+        mock_event_data['NotBefore'] = int(time()) + 3600
+        mock_event['Records'][0]['body'] = json.dumps(mock_event_data)
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+        main.assert_not_called()
+        attributes = mock_sqs_client.get_queue_attributes(
+            QueueUrl=mock_sqs_queue_url,
+            AttributeNames=['ApproximateNumberOfMessagesDelayed']
+        )['Attributes']
+        assert attributes['ApproximateNumberOfMessagesDelayed'] == '1'
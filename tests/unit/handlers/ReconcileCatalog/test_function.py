@@ -0,0 +1,376 @@
+'''Test ReconcileCatalog'''
+# pylint: disable=redefined-outer-name, protected-access, import-outside-toplevel, unused-argument
+
+import math
+from time import time
+from types import ModuleType
+from typing import Any, Callable, Generator, List
+import jsonschema
+
+import pytest
+from pytest_mock import MockerFixture
+import requests_mock
+
+from aws_lambda_powertools.utilities.typing import LambdaContext
+
+from common.model.entity import Entity
+from common.util.jwt import AUTH_ENDPOINT, JwtAuth
+from tests.conftest import CallCounts
+
+
+SWEEP_ANNOTATION = 'io.serverlessops/sweep-id'
+
+
+def _make_entity(name: str, sweep_id: str | None) -> Entity:
+    '''Return a mock entity'''
+    annotations = {'io.serverlessops/cloud-provider': 'aws'}
+    if sweep_id is not None:
+        annotations[SWEEP_ANNOTATION] = sweep_id
+    return Entity({
+        'apiVersion': 'backstage.io/v1alpha1',
+        'kind': 'Resource',
+        'metadata': {
+            'namespace': 'default',
+            'name': name,
+            'title': name,
+            'description': name,
+            'annotations': annotations,
+        },
+        'spec': {
+            'owner': 'owner',
+            'system': 'system',
+            'type': 'ec2-vpc',
+            'lifecycle': 'available',
+        }
+    })
+
+
+@pytest.fixture()
+def mock_entities() -> List[Entity]:
+    '''Return catalog entities from several sweeps'''
+    return [
+        _make_entity('stale', '100'),
+        _make_entity('current', '200'),
+        _make_entity('unmanaged', None),
+    ]
+
+
+@pytest.fixture()
+def mock_completed_sweep(mock_state_table_name: str) -> str:
+    '''Complete a sweep'''
+    from common.util import sweep
+
+    sweep.start_sweep(mock_state_table_name, '200', ['123456789012'], ['MockCollector'])
+    sweep.complete_account(mock_state_table_name, '200', 'MockCollector', '123456789012')
+    return '200'
+
+
+# Requests
+@pytest.fixture()
+def requests_mocker() -> requests_mock.Mocker:
+    '''Return a requests mock'''
+    # NOTE: Use as a decerator with Python 3 appears broken so use fixture.
+    # ref. https://github.com/pytest-dev/pytest/issues/2749
+    return requests_mock.Mocker()
+
+@pytest.fixture()
+def mock_endpoint() -> str:
+    '''Return a mock endpoint'''
+    return 'https://api.example.com/catalog'
+
+@pytest.fixture()
+def mock_auth(
+    mocker: MockerFixture,
+    requests_mocker: requests_mock.Mocker,
+) -> Generator[JwtAuth, None, None]:
+    '''Yield a JWT Auth object'''
+    requests_mocker.register_uri(
+        requests_mock.POST,
+        AUTH_ENDPOINT,
+        status_code=200,
+        json={'access_token': 'token'}
+    )
+
+    jwt = JwtAuth('clientId', 'clientSecret')
+    mocker.patch.object(jwt, 'token', 'jwt-token')
+    mocker.patch.object(jwt, 'expiration', int(time()) + 600)
+
+    yield jwt
+
+
+# Function
+@pytest.fixture()
+def mock_fn(
+    mock_state_table_name: str,
+    mock_endpoint: str,
+    mock_auth: JwtAuth,
+    mock_entities: List[Entity],
+    requests_mocker: requests_mock.Mocker,
+    mocker: MockerFixture
+) -> Generator[ModuleType, None, None]:
+    '''Return mocked function'''
+    import src.handlers.ReconcileCatalog.function as fn
+
+    # NOTE: use mocker to mock any top-level variables outside of the handler function.
+    mocker.patch(
+        'src.handlers.ReconcileCatalog.function.JWT',
+        mock_auth
+    )
+
+    mocker.patch(
+        'src.handlers.ReconcileCatalog.function.CATALOG_ENDPOINT',
+        mock_endpoint
+    )
+
+    mocker.patch(
+        'src.handlers.ReconcileCatalog.function.STATE_TABLE_NAME',
+        mock_state_table_name
+    )
+
+    mocker.patch(
+        'src.handlers.ReconcileCatalog.function.RECONCILE_GRACE_SECONDS',
+        0
+    )
+
+    # We can also use requests_mocker within tests too if necessary
+    with requests_mocker:
+        requests_mocker.register_uri(
+            requests_mock.ANY,
+            requests_mock.ANY,
+            status_code=200,
+        )
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            '{}/default/resource'.format(mock_endpoint),
+            status_code=200,
+            json=mock_entities
+        )
+        yield fn
+
+
+class TestData:
+    '''Data validation tests'''
+    def test_validate_event(self, mock_event: dict[str, Any], mock_event_schema: dict[str, Any]):
+        '''Test event against schema'''
+        jsonschema.Draft7Validator(mock_event, mock_event_schema)
+
+
+class TestCode:
+    '''Code tests'''
+    def test_ListEntitiesError(self, mock_fn: ModuleType):
+        '''Test ListEntitiesError class'''
+        e = mock_fn.ListEntitiesError('resource')
+        assert str(e) == 'Failed to list catalog entities of kind: resource'
+
+    def test_DeleteEntityError(self, mock_fn: ModuleType):
+        '''Test DeleteEntityError class'''
+        e = mock_fn.DeleteEntityError('mock')
+        assert str(e) == 'Failed to delete entity from catalog: mock'
+
+    def test__list_entities(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: JwtAuth,
+        mock_entities: List[Entity],
+    ):
+        '''Test _list_entities function'''
+        assert mock_fn._list_entities(mock_auth) == mock_entities
+
+    def test__list_entities_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: JwtAuth,
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _list_entities function fails'''
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            requests_mock.ANY,
+            status_code=403,
+        )
+        with pytest.raises(mock_fn.ListEntitiesError):
+            mock_fn._list_entities(mock_auth)
+
+    def test__delete_entity(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: JwtAuth,
+        mock_endpoint: str,
+        mock_entities: List[Entity],
+    ):
+        '''Test _delete_entity function'''
+        r = mock_fn._delete_entity(mock_entities[0], mock_auth)
+        assert r.request.method == 'DELETE'
+        assert r.request.url == '{}/default/resource/stale'.format(mock_endpoint)
+
+    def test__delete_entity_fails(
+        self,
+        mock_fn: ModuleType,
+        mock_auth: JwtAuth,
+        mock_entities: List[Entity],
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _delete_entity function fails'''
+        requests_mocker.register_uri(
+            requests_mock.DELETE,
+            requests_mock.ANY,
+            status_code=500,
+        )
+        with pytest.raises(mock_fn.DeleteEntityError):
+            mock_fn._delete_entity(mock_entities[0], mock_auth)
+        assert mock_fn._try_delete_entity(mock_entities[0], mock_auth) is False
+
+    def test__get_stale_entities(
+        self,
+        mock_fn: ModuleType,
+        mock_entities: List[Entity],
+    ):
+        '''Test _get_stale_entities function'''
+        stale = mock_fn._get_stale_entities(mock_entities, {'Generation': 200, 'CompletedAt': 0})
+        assert [entity['metadata']['name'] for entity in stale] == ['stale']
+
+    def test__get_stale_entities_seen(
+        self,
+        mock_fn: ModuleType,
+        mock_entities: List[Entity],
+    ):
+        '''Test entities seen by a sweep that did not write them are kept'''
+        from common.util import sweep
+        sweep.mark_seen(mock_fn.STATE_TABLE_NAME, mock_fn._get_entity_ref(mock_entities[0]), '200')
+
+        assert mock_fn._get_stale_entities(mock_entities, {'Generation': 200, 'CompletedAt': 0}) == []
+
+    def test__get_stale_entities_partial_sweep(
+        self,
+        mock_fn: ModuleType,
+    ):
+        '''Test entities of accounts skipped by a partial sweep are kept'''
+        entities = [_make_entity('scanned', '100'), _make_entity('skipped', '100'), _make_entity('closed', '100')]
+        for entity, account_id in zip(entities, ['111111111111', '222222222222', '333333333333']):
+            entity['metadata']['annotations']['aws.amazon.com/account-id'] = account_id
+
+        last_sweep = {
+            'Generation': 200,
+            'CompletedAt': 0,
+            'Accounts': ['111111111111'],
+            'OrgAccounts': ['111111111111', '222222222222'],
+        }
+        stale = mock_fn._get_stale_entities(entities, last_sweep)
+        assert [entity['metadata']['name'] for entity in stale] == ['scanned', 'closed']
+
+    def test__delete_entities_stops_at_deadline(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_auth: JwtAuth,
+        mock_context: Callable[[str], LambdaContext],
+        requests_mocker: requests_mock.Mocker,
+        mocker: MockerFixture
+    ):
+        '''Test _delete_entities only starts new batches while time remains'''
+        mocker.patch.object(mock_fn, 'RECONCILE_BATCH_SIZE', 2)
+        entities = [_make_entity('stale-{}'.format(i), '100') for i in range(5)]
+
+        # mock_context reports no remaining time so only the first batch runs.
+        deleted = mock_fn._delete_entities(entities, mock_auth, mock_context(lambda_function_name))
+        assert deleted == 2
+
+    @pytest.mark.usefixtures('mock_completed_sweep')
+    def test__main(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _main function deletes only stale entities'''
+        mock_fn._main(mock_context(lambda_function_name))
+
+        deletes = [r for r in requests_mocker.request_history if r.method == 'DELETE']
+        assert [r.path.split('/')[-1] for r in deletes] == ['stale']
+
+    @pytest.mark.usefixtures('mock_completed_sweep')
+    def test__main_respects_cap(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        requests_mocker: requests_mock.Mocker,
+        mocker: MockerFixture
+    ):
+        '''Test _main function never deletes more than the cap'''
+        mocker.patch.object(mock_fn, 'RECONCILE_MAX_DELETES', 0)
+        mock_fn._main(mock_context(lambda_function_name))
+
+        assert not [r for r in requests_mocker.request_history if r.method == 'DELETE']
+
+    @pytest.mark.usefixtures('mock_completed_sweep')
+    def test__main_within_grace_period(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        requests_mocker: requests_mock.Mocker,
+        mocker: MockerFixture
+    ):
+        '''Test _main function waits for in-flight writes to drain'''
+        mocker.patch.object(mock_fn, 'RECONCILE_GRACE_SECONDS', 600)
+        mock_fn._main(mock_context(lambda_function_name))
+
+        assert requests_mocker.call_count == 0
+
+    def test__main_without_completed_sweep(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        requests_mocker: requests_mock.Mocker,
+    ):
+        '''Test _main function does nothing before a sweep completes'''
+        mock_fn._main(mock_context(lambda_function_name))
+
+        assert requests_mocker.call_count == 0
+
+    def test_handler(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[[str], LambdaContext],
+        mock_event: dict,
+    ):
+        '''Test calling handler'''
+        # Call the function
+        mock_fn.handler(mock_event, mock_context(lambda_function_name))
+
+    @pytest.mark.usefixtures('mock_completed_sweep')
+    def test_handler_call_budget(
+        self,
+        lambda_function_name: str,
+        mock_fn: ModuleType,
+        mock_context: Callable[..., LambdaContext],
+        mock_endpoint: str,
+        mock_event: dict,
+        requests_mocker: requests_mock.Mocker,
+        call_counts: CallCounts,
+    ):
+        '''Test calls per reconciliation'''
+        stale = 10
+        requests_mocker.register_uri(
+            requests_mock.GET,
+            '{}/default/resource'.format(mock_endpoint),
+            status_code=200,
+            json=[_make_entity('stale-{}'.format(i), '100') for i in range(stale)]
+                + [_make_entity('current-{}'.format(i), '200') for i in range(20)]
+        )
+
+        call_counts.clear()
+        mock_fn.handler(mock_event, mock_context(lambda_function_name, 900000))
+
+        call_counts.assert_within({
+            'catalog.ListEntities': 1,
+            'catalog.DeleteEntity': stale,
+            # The last completed sweep, then the sweeps that saw the stale entities.
+            'dynamodb.GetItem': 1,
+            'dynamodb.BatchGetItem': math.ceil(stale / mock_fn.sweep.BATCH_GET_MAX_KEYS),
+        })
+        assert call_counts.count('catalog.DeleteEntity') == stale